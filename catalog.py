@@ -0,0 +1,137 @@
+import threading
+from decimal import Decimal, InvalidOperation
+
+
+def parse_price(value):
+    """
+    Преобразует цену из каталога OpenRouter (строка за токен в долларах) в Decimal.
+
+    Returns:
+        Decimal: Цена (None, если цена не указана или определяется провайдером при запросе)
+    """
+    if value is None or value == "":
+        return None
+    try:
+        price = Decimal(str(value))
+    except (InvalidOperation, ValueError):
+        return None
+    # Отрицательная цена означает, что она определяется выбранной провайдером моделью
+    return price if price.is_finite() and price >= 0 else None
+
+
+def is_free_model(model_id, prompt_price, completion_price):
+    """Проверяет, бесплатная ли модель (цены - уже разобранные значения Decimal)."""
+    return model_id.endswith(":free") or (prompt_price == 0 and completion_price == 0)
+
+
+class ModelRecord:
+    """
+    Неизменяемая запись каталога моделей: цены разобраны в Decimal, флаги - bool,
+    ключ сортировки вычислен заранее. Записи общие для всех обработчиков.
+    """
+
+    __slots__ = ("id", "name", "description", "context_length", "prompt_price", "completion_price",
+                 "cache_read_price", "cache_write_price", "is_free", "top_model", "prompt_cache", "sort_key")
+
+    def __init__(self, model_id, name, description=None, context_length=None, prompt_price=None,
+                 completion_price=None, cache_read_price=None, cache_write_price=None, top_model=False):
+        """
+        Args:
+            model_id: ID модели
+            name: Название модели
+            description: Описание для отображения (русское, если есть)
+            context_length: Максимальная длина контекста в токенах
+            prompt_price, completion_price, cache_read_price, cache_write_price: Цены за токен
+                в виде строк каталога или Decimal
+            top_model: Отмечена ли модель как топовая
+        """
+        prompt_price = parse_price(prompt_price)
+        completion_price = parse_price(completion_price)
+        cache_read_price = parse_price(cache_read_price)
+        cache_write_price = parse_price(cache_write_price)
+        top_model = bool(top_model)
+
+        # Режим кэширования промпта: "explicit" - провайдер тарифицирует запись в кэш и требует
+        # разметки cache_control, "implicit" - кэширует префикс автоматически, None - не поддерживает
+        if cache_write_price is not None:
+            prompt_cache = "explicit"
+        elif cache_read_price is not None:
+            prompt_cache = "implicit"
+        else:
+            prompt_cache = None
+
+        set_slot = object.__setattr__
+        set_slot(self, "id", model_id)
+        set_slot(self, "name", name or model_id)
+        set_slot(self, "description", description)
+        set_slot(self, "context_length", context_length or 0)
+        set_slot(self, "prompt_price", prompt_price)
+        set_slot(self, "completion_price", completion_price)
+        set_slot(self, "cache_read_price", cache_read_price)
+        set_slot(self, "cache_write_price", cache_write_price)
+        set_slot(self, "is_free", is_free_model(model_id, prompt_price, completion_price))
+        set_slot(self, "top_model", top_model)
+        set_slot(self, "prompt_cache", prompt_cache)
+        # Сначала топовые, затем по названию
+        set_slot(self, "sort_key", (not top_model, self.name, model_id))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Запись каталога моделей неизменяема")
+
+    def __delattr__(self, name):
+        raise AttributeError("Запись каталога моделей неизменяема")
+
+    def __repr__(self):
+        return f"ModelRecord({self.id!r})"
+
+
+class ModelCatalog:
+    """
+    Каталог моделей в памяти. Записи загружаются из БД один раз и перечитываются только
+    после изменения таблицы models (DBHandler.models_version), поэтому выбор модели,
+    проверка доступа, отображение цен и маршрутизация запросов не обращаются к БД.
+    """
+
+    def __init__(self, db):
+        """
+        Args:
+            db: Экземпляр DBHandler
+        """
+        self.db = db
+        self.version = None
+        self.lock = threading.Lock()
+        # Снимок каталога заменяется целиком: (все записи, записи по ID, бесплатные, топовые)
+        self.snapshot = ((), {}, (), ())
+
+    def _current(self):
+        version = self.db.models_version
+        if version != self.version:
+            with self.lock:
+                if version != self.version:
+                    self._rebuild(version)
+        return self.snapshot
+
+    def _rebuild(self, version):
+        records = tuple(sorted(self.db.get_models(), key=lambda record: record.sort_key))
+        self.snapshot = (
+            records,
+            {record.id: record for record in records},
+            tuple(record for record in records if record.is_free),
+            tuple(record for record in records if record.top_model)
+        )
+        self.version = version
+
+    def get(self, model_id):
+        """Возвращает запись модели (None, если модели нет в каталоге)."""
+        return self._current()[1].get(model_id)
+
+    def models(self, only_free=False, only_top=False):
+        """Возвращает записи моделей в порядке отображения с возможностью фильтрации."""
+        records, _, free_records, top_records = self._current()
+        if only_free and only_top:
+            return tuple(record for record in top_records if record.is_free)
+        if only_free:
+            return free_records
+        if only_top:
+            return top_records
+        return records
@@ -13,6 +13,137 @@ SITE_NAME = "OpenRouter Telegram Bot"
 # Настройки обновления сообщений
 STREAM_UPDATE_INTERVAL = 1.5  # Интервал обновления сообщений в секундах при потоковой передаче
 
+# Кэширование промпта
+PROMPT_CACHE_MIN_TOKENS = 1024  # Минимальный размер истории (в токенах) для разметки cache_control
+
+# Режим контекста по умолчанию: "recent" - последние сообщения, "retrieval" - поиск по истории (FTS5)
+CONTEXT_MODE = "recent"
+RETRIEVAL_RECENT_TURNS = 4  # Количество последних обменов сообщениями в режиме поиска
+RETRIEVAL_TOP_K = 4  # Количество найденных релевантных обменов из более ранней истории
+
+# Перевод описаний моделей
+TRANSLATION_CONCURRENCY = 4  # Количество одновременных запросов на перевод
+TRANSLATION_REQUESTS_PER_MINUTE = 20  # Лимит запросов в минуту к одной модели-переводчику
+TRANSLATION_BURST = 4  # Допустимый всплеск запросов к одной модели-переводчику
+TRANSLATION_MAX_ATTEMPTS = 3  # Количество попыток перевода одного описания (с переключением модели)
+TRANSLATION_PROGRESS_INTERVAL = 3  # Минимальный интервал обновления сообщения о прогрессе (сек)
+
+# Фоновые задачи администраторов (перевод описаний, обновление каталога)
+JOB_WORKERS = 2  # Количество воркеров фоновых задач
+JOB_POLL_INTERVAL = 5  # Интервал опроса очереди задач в секундах
+
+# Параллельная обработка обновлений (порядок внутри одного чата сохраняется)
+MAX_CONCURRENT_UPDATES = 32  # Максимальное количество одновременно обрабатываемых обновлений
+
+# Режим получения обновлений: "polling" - опрос Telegram, "webhook" - встроенный HTTP-сервер
+RUN_MODE = "polling"
+WEBHOOK_LISTEN = "0.0.0.0"  # Адрес, на котором слушает HTTP-сервер
+WEBHOOK_PORT = 8443  # Порт HTTP-сервера
+WEBHOOK_URL_PATH = "telegram"  # Путь вебхука на сервере
+WEBHOOK_URL = ""  # Публичный URL вебхука (например, "https://bot.example.com/telegram")
+WEBHOOK_SECRET_TOKEN = ""  # Секретный токен для проверки запросов от Telegram (A-Z, a-z, 0-9, _ и -)
+WEBHOOK_MAX_CONNECTIONS = 40  # Максимальное количество одновременных соединений от Telegram
+
+# Хранилище состояния пользователей и активных генераций:
+# "sqlite" - в БД бота (переживает перезапуск), "memory" - в памяти процесса, "redis" - в Redis
+STATE_BACKEND = "sqlite"
+REDIS_URL = "redis://localhost:6379/0"  # Адрес Redis для STATE_BACKEND = "redis"
+STATE_FLUSH_INTERVAL = 5  # Интервал сохранения измененного состояния пользователей в БД (сек)
+
+# Сохранение частично сгенерированных ответов
+ANSWER_CHECKPOINT_INTERVAL = 10  # Интервал сохранения частичного ответа в БД во время генерации (сек)
+DB_FLUSH_INTERVAL = 2  # Интервал пакетной записи отложенных изменений в БД (сек)
+INTERRUPTED_ANSWER_TIMEOUT = 600  # Через сколько секунд незавершенная генерация считается прерванной
+
+# Остановка бота
+SHUTDOWN_DRAIN_TIMEOUT = 30  # Сколько секунд ждать завершения активных генераций перед их отменой
+SHUTDOWN_CANCEL_TIMEOUT = 5  # Сколько секунд ждать остановки отмененных генераций и отправки сообщений
+
+# Очередь генераций
+GENERATION_MAX_CONCURRENT = 16  # Максимальное количество одновременных генераций
+GENERATION_MAX_PER_USER = 1  # Максимальное количество одновременных генераций одного пользователя
+# Веса полос приоритета во взвешенной справедливой очереди (доля слотов пропорциональна весу)
+GENERATION_LANE_WEIGHTS = {"admin": 4, "premium": 2, "default": 1}
+GENERATION_QUEUE_UPDATE_INTERVAL = 3  # Интервал обновления сообщений о позиции в очереди (сек)
+GENERATION_QUEUE_EDITS_PER_UPDATE = 20  # Максимальное количество таких сообщений, обновляемых за раз
+
+# Очередь запросов чата
+PROMPT_DEBOUNCE_SECONDS = 1.0  # Сообщения, пришедшие подряд в пределах этого времени, объединяются в один запрос
+
+# Ограничение частоты запросов: {роль: {вид: {период: лимит}}}, роли "default", "premium" и "admin".
+# Виды: "message" - сообщения, "reload" - перезагрузки ответа, "tokens" - токены (оценка при приеме
+# запроса, затем фактический расход). Периоды: "minute" и "day". Пустой словарь - без ограничений.
+RATE_LIMITS = {
+    "default": {
+        "message": {"minute": 10, "day": 300},
+        "reload": {"minute": 3, "day": 50},
+        "tokens": {"minute": 30000, "day": 500000},
+    },
+    "premium": {
+        "message": {"minute": 30, "day": 1500},
+        "reload": {"minute": 10, "day": 300},
+        "tokens": {"minute": 100000, "day": 3000000},
+    },
+    "admin": {},
+}
+# Общие лимиты группового чата (для всех его участников вместе)
+CHAT_RATE_LIMITS = {"message": {"minute": 30}, "reload": {"minute": 10}, "tokens": {"minute": 100000}}
+RATE_LIMIT_FLUSH_INTERVAL = 30  # Интервал сохранения состояния лимитов в БД (сек)
+PREMIUM_USERS_REFRESH_INTERVAL = 300  # Интервал обновления кэша премиум-пользователей из БД (сек)
+
+# Статистика работы моделей и переключение на запасные бесплатные модели
+MODEL_HEALTH_WINDOW = 50  # Количество последних запросов к модели, по которым считается статистика
+MODEL_HEALTH_MAX_AGE = 3600  # Запросы старше этого времени (сек) не учитываются
+MODEL_HEALTH_MIN_SAMPLES = 3  # Минимальное количество запросов, чтобы признать модель неисправной
+MODEL_MAX_ERROR_RATE = 0.5  # Доля ошибок, выше которой модель считается неисправной
+MODEL_MAX_TTFT = 20  # Медианное время до первого токена (сек), выше которого модель считается медленной
+MODEL_FAILOVER_ATTEMPTS = 3  # Сколько моделей (включая выбранную) пробовать для одного запроса
+MODEL_HEALTH_FLUSH_INTERVAL = 60  # Интервал сохранения статистики моделей в БД (сек)
+
+# Автоматическое отключение недоступных моделей и повтор запросов
+BREAKER_FAILURE_THRESHOLD = 3  # Количество ошибок подряд, после которого модель временно отключается
+BREAKER_COOLDOWN = 30  # Начальное время отключения модели (сек), удваивается при повторных неудачах
+BREAKER_MAX_COOLDOWN = 300  # Максимальное время отключения модели (сек)
+MODEL_RETRY_ATTEMPTS = 2  # Количество повторов запроса к модели до начала ответа (ошибки 429 и 5xx)
+MODEL_RETRY_BASE_DELAY = 1  # Начальная задержка перед повтором (сек), растет экспоненциально со случайным разбросом
+MODEL_RETRY_MAX_DELAY = 8  # Если провайдер просит ждать дольше (Retry-After), запрос не повторяется
+
+# Дублирование медленных запросов к бесплатным моделям (hedged requests)
+HEDGE_REQUESTS = False  # Значение по умолчанию; пользователь меняет его командой /hedging
+HEDGE_DELAY_PERCENTILE = 0.9  # Перцентиль времени до первого токена модели, после которого запрос дублируется
+HEDGE_MIN_DELAY = 2  # Минимальная задержка перед дублирующим запросом (сек)
+HEDGE_MAX_DELAY = 10  # Максимальная задержка (сек); используется, пока по модели нет статистики
+HEDGE_MAX_MODELS = 2  # Сколько моделей (включая выбранную) могут одновременно генерировать ответ
+
+# Статистика расхода
+USAGE_FLUSH_INTERVAL = 60  # Интервал записи накопленного расхода в таблицу usage_daily (сек)
+
+# Бюджеты расходов на платные модели (в долларах; отсутствующий период - без ограничения)
+SPEND_BUDGETS = {
+    "user": {"day": 1.0, "month": 10.0},
+    "global": {"day": 5.0, "month": 50.0},
+}
+MAX_COMPLETION_TOKENS = 4096  # Ограничение длины ответа платной модели (токенов), по нему резервируется бюджет
+BUDGET_MIN_COMPLETION_TOKENS = 256  # Если остаток бюджета позволяет ответ короче, запрос не выполняется платной моделью
+BUDGET_DOWNGRADE_TO_FREE = True  # При исчерпании бюджета передавать запрос бесплатной модели (иначе - отклонять)
+
+# Поиск моделей (/find и инлайн-режим)
+MODEL_SEARCH_LIMIT = 8  # Максимальное количество моделей в результатах поиска
+
+# Отправка очень длинных ответов файлом
+LONG_ANSWER_DOCUMENT_THRESHOLD = 12000  # Длина ответа (символов), начиная с которой он отправляется файлом (0 - отключено)
+LONG_ANSWER_DOCUMENT_FORMAT = "md"  # Формат файла с ответом: "md" (исходный Markdown) или "html"
+LONG_ANSWER_PREVIEW_LENGTH = 1000  # Длина превью ответа в сообщении (символов)
+
+# Экспорт диалогов (/export, /export_all)
+EXPORT_PAGE_SIZE = 500  # Количество записей, читаемых из БД за один запрос при экспорте
+EXPORT_MAX_FILE_SIZE = 50 * 1024 * 1024  # Максимальный размер файла экспорта (ограничение Bot API на отправку файлов)
+
+# Поиск по истории диалогов (/search)
+HISTORY_SEARCH_PAGE_SIZE = 5  # Количество результатов на странице
+HISTORY_SEARCH_SNIPPET_TOKENS = 16  # Максимальное количество слов во фрагменте с совпадением
+HISTORY_SEARCH_SESSIONS = 5  # Сколько последних поисков пользователя можно листать кнопкой "Показать еще"
+
 # Добавляем поле для ID администраторов (список строк)
 ADMIN_IDS = ["1", "2", "3"]
 # ADMIN_IDS = ["YOUR_ADMIN_ID_2"]
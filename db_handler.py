@@ -1,8 +1,15 @@
 import os
+import re
+import json
+import hashlib
 import sqlite3
 import logging
+import threading
+from pathlib import Path
 from datetime import datetime
 
+from catalog import ModelRecord, parse_price, is_free_model
+
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
@@ -13,6 +20,17 @@ class DBHandler:
         self.db_path = db_path
         self.conn = None
 
+        # Доступен ли полнотекстовый индекс по диалогам (требует поддержки FTS5 в SQLite)
+        self.fts_enabled = False
+
+        # Отложенные записи, выполняемые пакетом в flush_writes: ключ -> (sql, params).
+        # Для одного ключа хранится только последняя запись.
+        self.pending_writes = {}
+        self.pending_lock = threading.Lock()
+
+        # Увеличивается при каждом изменении таблицы models (по нему ModelCatalog перечитывает каталог)
+        self.models_version = 0
+
         # Создаем директорию для базы данных, если она не существует
         os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
 
@@ -25,6 +43,9 @@ class DBHandler:
         # Обновление схемы базы данных, если необходимо
         self.update_schema()
 
+        # Полнотекстовый индекс по истории диалогов
+        self.create_search_index()
+
     def connect(self):
         """Подключение к базе данных SQLite."""
         try:
@@ -33,6 +54,15 @@ class DBHandler:
         except Exception as e:
             logger.error(f"Ошибка подключения к базе данных: {e}")
 
+    def connect_read_only(self):
+        """
+        Открывает отдельное подключение к базе данных только для чтения.
+
+        Используется длительными чтениями в других потоках (экспорт диалогов), чтобы не
+        обращаться к общему подключению вне цикла событий. Закрывается вызывающим.
+        """
+        return sqlite3.connect(f"{Path(os.path.abspath(self.db_path)).as_uri()}?mode=ro", uri=True)
+
     def create_tables(self):
         """Создание необходимых таблиц."""
         try:
@@ -66,6 +96,14 @@ class DBHandler:
                 model_answer TEXT,
                 ask_date DATETIME DEFAULT CURRENT_TIMESTAMP,
                 displayed INTEGER DEFAULT 1,
+                prompt_tokens INTEGER,
+                cached_tokens INTEGER,
+                generation_state TEXT,
+                served_model_id TEXT,
+                completion_tokens INTEGER,
+                cost REAL,
+                generation_id TEXT,
+                answer_updated_at DATETIME,
                 FOREIGN KEY (id_chat, id_user) REFERENCES users (id_chat, id_user)
             )
             ''')
@@ -86,6 +124,8 @@ class DBHandler:
                 completion_price TEXT,
                 image_price TEXT,
                 request_price TEXT,
+                input_cache_read_price TEXT,
+                input_cache_write_price TEXT,
                 provider_context_length INTEGER,
                 is_moderated INTEGER,
                 is_free INTEGER,
@@ -94,6 +134,93 @@ class DBHandler:
             )
             ''')
 
+            # Создание таблицы кэша переводов (ключ - хэш исходного текста и язык перевода)
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS translation_cache (
+                source_hash TEXT NOT NULL,
+                target_lang TEXT NOT NULL,
+                translation TEXT NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (source_hash, target_lang)
+            )
+            ''')
+
+            # Создание таблицы состояния пользователей (выбранная модель, текущий диалог и т.д.)
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_sessions (
+                id_user INTEGER NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id_user, key)
+            )
+            ''')
+
+            # Создание таблицы фоновых задач администраторов
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                params TEXT,
+                status TEXT NOT NULL DEFAULT 'queued',
+                dedup_key TEXT,
+                progress INTEGER DEFAULT 0,
+                total INTEGER DEFAULT 0,
+                checkpoint TEXT,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER DEFAULT 0,
+                created_by INTEGER,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                finished_at DATETIME
+            )
+            ''')
+
+            # Одинаковая задача не может быть одновременно в очереди или в работе дважды
+            cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active_dedup
+            ON jobs (dedup_key) WHERE status IN ('queued', 'running')
+            ''')
+
+            # Создание таблицы статистики работы моделей (последние запросы в JSON)
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS model_health (
+                model_id TEXT PRIMARY KEY,
+                samples TEXT NOT NULL,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+            ''')
+
+            # Создание таблицы корзин ограничения частоты запросов (хранятся только неполные корзины)
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                scope TEXT NOT NULL,
+                subject_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                period TEXT NOT NULL,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                capacity REAL NOT NULL,
+                PRIMARY KEY (scope, subject_id, kind, period)
+            )
+            ''')
+
+            # Создание таблицы суммарного расхода по пользователям, моделям и дням (UTC)
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS usage_daily (
+                day TEXT NOT NULL,
+                id_user INTEGER NOT NULL,
+                model_id TEXT NOT NULL,
+                requests INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                cached_tokens INTEGER NOT NULL DEFAULT 0,
+                cost REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, id_user, model_id)
+            )
+            ''')
+
             self.conn.commit()
         except Exception as e:
             logger.error(f"Ошибка создания таблиц: {e}")
@@ -135,6 +262,8 @@ class DBHandler:
                     completion_price TEXT,
                     image_price TEXT,
                     request_price TEXT,
+                    input_cache_read_price TEXT,
+                    input_cache_write_price TEXT,
                     provider_context_length INTEGER,
                     is_moderated INTEGER,
                     is_free INTEGER,
@@ -157,9 +286,191 @@ class DBHandler:
                 cursor.execute("UPDATE users SET is_premium = 0 WHERE is_premium IS NULL")
                 self.conn.commit()
 
+            # Проверяем, существует ли таблица счетчиков диалогов
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='user_dialog_counters'")
+            if not cursor.fetchone():
+                logger.info("Создание таблицы 'user_dialog_counters'")
+                cursor.execute('''
+                CREATE TABLE user_dialog_counters (
+                    id_user INTEGER PRIMARY KEY,
+                    last_dialog INTEGER NOT NULL
+                )
+                ''')
+
+                # Заполняем счетчики по уже существующим диалогам
+                cursor.execute('''
+                INSERT INTO user_dialog_counters (id_user, last_dialog)
+                SELECT id_user, MAX(number_dialog) FROM dialogs GROUP BY id_user
+                ''')
+                self.conn.commit()
+
+            # Колонки с ценами кэширования промпта в таблице 'models'
+            cursor.execute("PRAGMA table_info(models)")
+            columns = [column[1] for column in cursor.fetchall()]
+
+            for column in ('input_cache_read_price', 'input_cache_write_price'):
+                if column not in columns:
+                    logger.info(f"Добавление колонки '{column}' в таблицу 'models'")
+                    cursor.execute(f"ALTER TABLE models ADD COLUMN {column} TEXT")
+                    self.conn.commit()
+
+            # Колонки со статистикой токенов в таблице 'dialogs'
+            cursor.execute("PRAGMA table_info(dialogs)")
+            columns = [column[1] for column in cursor.fetchall()]
+
+            for column in ('prompt_tokens', 'cached_tokens'):
+                if column not in columns:
+                    logger.info(f"Добавление колонки '{column}' в таблицу 'dialogs'")
+                    cursor.execute(f"ALTER TABLE dialogs ADD COLUMN {column} INTEGER")
+                    self.conn.commit()
+
+            if 'generation_state' not in columns:
+                logger.info("Добавление колонки 'generation_state' в таблицу 'dialogs'")
+                cursor.execute("ALTER TABLE dialogs ADD COLUMN generation_state TEXT")
+                self.conn.commit()
+
+            if 'served_model_id' not in columns:
+                logger.info("Добавление колонки 'served_model_id' в таблицу 'dialogs'")
+                cursor.execute("ALTER TABLE dialogs ADD COLUMN served_model_id TEXT")
+                self.conn.commit()
+
+            # Колонки с расходом запроса в таблице 'dialogs'
+            for column, column_type in (('completion_tokens', 'INTEGER'), ('cost', 'REAL'), ('generation_id', 'TEXT')):
+                if column not in columns:
+                    logger.info(f"Добавление колонки '{column}' в таблицу 'dialogs'")
+                    cursor.execute(f"ALTER TABLE dialogs ADD COLUMN {column} {column_type}")
+                    self.conn.commit()
+
+            # Время последней контрольной точки ответа (по нему определяются прерванные генерации)
+            if 'answer_updated_at' not in columns:
+                logger.info("Добавление колонки 'answer_updated_at' в таблицу 'dialogs'")
+                cursor.execute("ALTER TABLE dialogs ADD COLUMN answer_updated_at DATETIME")
+                self.conn.commit()
+
+            # Индекс для постраничного чтения диалогов пользователя (экспорт, история)
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_dialogs_user_dialog ON dialogs (id_user, number_dialog, id)"
+            )
+            self.conn.commit()
+
         except Exception as e:
             logger.error(f"Ошибка обновления схемы базы данных: {e}")
 
+    def create_search_index(self):
+        """
+        Создает полнотекстовый индекс FTS5 по запросам и ответам в таблице 'dialogs'.
+
+        Индекс хранит только токены (external content), сами тексты остаются в 'dialogs'.
+        Синхронизация выполняется триггерами, при первом создании индекс заполняется
+        существующими записями. Столбец id_user индексируется, чтобы поиск по истории
+        пользователя отбирал его записи внутри индекса, а не после ранжирования всех совпадений.
+        """
+        try:
+            cursor = self.conn.cursor()
+
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='dialogs_fts'")
+            index_exists = cursor.fetchone() is not None
+
+            if index_exists:
+                cursor.execute("PRAGMA table_info(dialogs_fts)")
+                if 'id_user' not in [column[1] for column in cursor.fetchall()]:
+                    # Индекс старой схемы (без id_user) пересоздается вместе с триггерами
+                    logger.info("Пересоздание полнотекстового индекса 'dialogs_fts' со столбцом 'id_user'")
+                    for trigger in ("dialogs_fts_insert", "dialogs_fts_delete", "dialogs_fts_update"):
+                        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+                    cursor.execute("DROP TABLE dialogs_fts")
+                    index_exists = False
+
+            cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS dialogs_fts USING fts5(
+                user_ask,
+                model_answer,
+                id_user,
+                content='dialogs',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+            ''')
+
+            cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS dialogs_fts_insert AFTER INSERT ON dialogs BEGIN
+                INSERT INTO dialogs_fts (rowid, user_ask, model_answer, id_user)
+                VALUES (new.id, new.user_ask, new.model_answer, new.id_user);
+            END
+            ''')
+
+            cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS dialogs_fts_delete AFTER DELETE ON dialogs BEGIN
+                INSERT INTO dialogs_fts (dialogs_fts, rowid, user_ask, model_answer, id_user)
+                VALUES ('delete', old.id, old.user_ask, old.model_answer, old.id_user);
+            END
+            ''')
+
+            cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS dialogs_fts_update AFTER UPDATE OF user_ask, model_answer ON dialogs BEGIN
+                INSERT INTO dialogs_fts (dialogs_fts, rowid, user_ask, model_answer, id_user)
+                VALUES ('delete', old.id, old.user_ask, old.model_answer, old.id_user);
+                INSERT INTO dialogs_fts (rowid, user_ask, model_answer, id_user)
+                VALUES (new.id, new.user_ask, new.model_answer, new.id_user);
+            END
+            ''')
+
+            if not index_exists:
+                logger.info("Заполнение полнотекстового индекса 'dialogs_fts'")
+                cursor.execute("INSERT INTO dialogs_fts (dialogs_fts) VALUES ('rebuild')")
+
+            self.conn.commit()
+            self.fts_enabled = True
+        except Exception as e:
+            logger.warning(f"Полнотекстовый индекс по диалогам недоступен: {e}")
+            self.fts_enabled = False
+
+    def buffer_write(self, key, sql, params):
+        """
+        Откладывает запись до следующего вызова flush_writes.
+
+        Args:
+            key: Ключ записи - более поздняя запись с тем же ключом заменяет предыдущую
+            sql: SQL-запрос
+            params: Параметры запроса
+        """
+        with self.pending_lock:
+            self.pending_writes[key] = (sql, params)
+
+    def discard_write(self, key):
+        """Отменяет отложенную запись с указанным ключом."""
+        with self.pending_lock:
+            self.pending_writes.pop(key, None)
+
+    def flush_writes(self):
+        """
+        Выполняет накопленные отложенные записи одной транзакцией.
+
+        Returns:
+            int: Количество выполненных записей
+        """
+        with self.pending_lock:
+            writes, self.pending_writes = self.pending_writes, {}
+
+        if not writes:
+            return 0
+
+        try:
+            cursor = self.conn.cursor()
+            for sql, params in writes.values():
+                cursor.execute(sql, params)
+            self.conn.commit()
+            return len(writes)
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Ошибка при пакетной записи в базу данных: {e}")
+
+            # Возвращаем записи в буфер, если их не заменили более новые
+            with self.pending_lock:
+                for key, write in writes.items():
+                    self.pending_writes.setdefault(key, write)
+            return 0
+
     def close(self):
         """Закрытие соединения с базой данных."""
         if self.conn:
@@ -203,9 +514,12 @@ class DBHandler:
         """Логирует диалог."""
         try:
             cursor = self.conn.cursor()
+            # Запись без ответа ожидает завершения генерации
+            generation_state = "streaming" if model_answer is None else "done"
+
             cursor.execute(
-                "INSERT INTO dialogs (id_chat, id_user, number_dialog, model, model_id, user_ask, model_answer, displayed) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (id_chat, id_user, number_dialog, model, model_id, user_ask, model_answer, displayed)
+                "INSERT INTO dialogs (id_chat, id_user, number_dialog, model, model_id, user_ask, model_answer, displayed, generation_state) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (id_chat, id_user, number_dialog, model, model_id, user_ask, model_answer, displayed, generation_state)
             )
             self.conn.commit()
             return cursor.lastrowid  # Возвращаем ID вставленной записи
@@ -216,34 +530,173 @@ class DBHandler:
     def update_model_answer(self, dialog_id, model_answer, displayed=1):
         """Обновляет ответ модели в существующей записи диалога."""
         try:
+            # Финальный ответ заменяет еще не записанную контрольную точку
+            self.discard_write(("answer_checkpoint", dialog_id))
+
             cursor = self.conn.cursor()
             cursor.execute(
-                "UPDATE dialogs SET model_answer = ?, displayed = ? WHERE id = ?",
+                "UPDATE dialogs SET model_answer = ?, displayed = ?, generation_state = 'done' WHERE id = ?",
                 (model_answer, displayed, dialog_id)
             )
             self.conn.commit()
         except Exception as e:
             logger.error(f"Ошибка при обновлении ответа модели: {e}")
 
+    def delete_unanswered_dialog(self, dialog_id):
+        """Удаляет запись запроса, для которого генерация так и не была запущена."""
+        try:
+            self.discard_write(("answer_checkpoint", dialog_id))
+
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "DELETE FROM dialogs WHERE id = ? AND generation_state = 'streaming'",
+                (dialog_id,)
+            )
+            self.conn.commit()
+        except Exception as e:
+            logger.error(f"Ошибка при удалении записи диалога: {e}")
+
+    def checkpoint_model_answer(self, dialog_id, partial_answer):
+        """
+        Откладывает сохранение частично сгенерированного ответа (записывается пакетом в flush_writes).
+
+        Контрольная точка применяется, только пока генерация не завершена, поэтому
+        запоздавшая запись не затрет финальный ответ.
+        """
+        self.buffer_write(
+            ("answer_checkpoint", dialog_id),
+            "UPDATE dialogs SET model_answer = ?, answer_updated_at = CURRENT_TIMESTAMP "
+            "WHERE id = ? AND generation_state = 'streaming'",
+            (partial_answer, dialog_id)
+        )
+
+    def finalize_interrupted_answers(self, marker, older_than_seconds=None, live_dialog_ids=()):
+        """
+        Завершает генерации, прерванные остановкой бота, добавляя к сохраненному ответу пометку.
+
+        Возраст записи отсчитывается от последней контрольной точки ответа (или от времени запроса,
+        если их еще не было). Записи генераций, которые этот процесс еще выполняет или держит
+        в очереди, не завершаются: для них время активности обновляется, чтобы их не завершили
+        и другие процессы, использующие ту же БД.
+
+        Args:
+            marker: Текст пометки о прерывании
+            older_than_seconds: Завершать только записи, неактивные дольше указанного времени
+                (None = все незавершенные записи)
+            live_dialog_ids: ID записей диалогов активных и ожидающих генераций этого процесса
+
+        Returns:
+            int: Количество завершенных записей
+        """
+        try:
+            cursor = self.conn.cursor()
+            live_dialog_ids = list(live_dialog_ids)
+            placeholders = ", ".join("?" * len(live_dialog_ids))
+
+            if live_dialog_ids:
+                cursor.execute(
+                    f"UPDATE dialogs SET answer_updated_at = CURRENT_TIMESTAMP "
+                    f"WHERE generation_state = 'streaming' AND id IN ({placeholders})",
+                    live_dialog_ids
+                )
+
+            query = """
+            UPDATE dialogs SET
+                model_answer = CASE
+                    WHEN model_answer IS NULL OR model_answer = '' THEN ?
+                    ELSE model_answer || '\n\n' || ?
+                END,
+                generation_state = 'interrupted'
+            WHERE generation_state = 'streaming'
+            """
+            params = [marker, marker]
+
+            if live_dialog_ids:
+                query += f" AND id NOT IN ({placeholders})"
+                params.extend(live_dialog_ids)
+
+            if older_than_seconds is not None:
+                query += " AND COALESCE(answer_updated_at, ask_date) < datetime('now', ?)"
+                params.append(f"-{int(older_than_seconds)} seconds")
+
+            cursor.execute(query, params)
+            self.conn.commit()
+
+            if cursor.rowcount:
+                logger.info(f"Завершено прерванных генераций: {cursor.rowcount}")
+            return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Ошибка при завершении прерванных генераций: {e}")
+            return 0
+
+    def update_dialog_usage(self, dialog_id, prompt_tokens=None, cached_tokens=None, completion_tokens=None,
+                            cost=None, generation_id=None):
+        """
+        Сохраняет расход запроса для записи диалога: токены промпта (в том числе из кэша),
+        токены ответа, стоимость в долларах и ID генерации OpenRouter.
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                """
+                UPDATE dialogs SET prompt_tokens = ?, cached_tokens = ?, completion_tokens = ?, cost = ?,
+                    generation_id = ?
+                WHERE id = ?
+                """,
+                (prompt_tokens, cached_tokens, completion_tokens, cost, generation_id, dialog_id)
+            )
+            self.conn.commit()
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении статистики токенов диалога {dialog_id}: {e}")
+
+    def update_served_model(self, dialog_id, served_model_id):
+        """Сохраняет ID модели, которая фактически сгенерировала ответ (при переключении на запасную модель)."""
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("UPDATE dialogs SET served_model_id = ? WHERE id = ?", (served_model_id, dialog_id))
+            self.conn.commit()
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении модели ответа для записи диалога {dialog_id}: {e}")
+
     def get_next_dialog_number(self, id_user):
-        """Получает следующий номер диалога для пользователя."""
+        """
+        Открывает новый диалог пользователя и возвращает его номер.
+
+        Номер выдается атомарным увеличением счетчика в таблице user_dialog_counters.
+        Пока в последнем выданном диалоге нет ни одного сообщения, счетчик не увеличивается
+        и возвращается тот же номер, поэтому повторные /new_dialog и смена модели
+        не оставляют пропусков в нумерации.
+
+        Raises:
+            sqlite3.Error: Если номер не удалось получить (номер 1 мог бы смешать
+                новые сообщения с первым диалогом пользователя)
+        """
         try:
             cursor = self.conn.cursor()
             cursor.execute(
-                "SELECT MAX(number_dialog) FROM dialogs WHERE id_user = ?",
+                """
+                INSERT INTO user_dialog_counters (id_user, last_dialog) VALUES (?, 1)
+                ON CONFLICT (id_user) DO UPDATE SET last_dialog = last_dialog + 1
+                WHERE EXISTS (
+                    SELECT 1 FROM dialogs
+                    WHERE dialogs.id_user = user_dialog_counters.id_user
+                      AND dialogs.number_dialog = user_dialog_counters.last_dialog
+                )
+                RETURNING last_dialog
+                """,
                 (id_user,)
             )
-            result = cursor.fetchone()[0]
+            result = cursor.fetchone()
+            self.conn.commit()
 
-            # Если это первый диалог пользователя
             if result is None:
-                return 1
-
-            # Иначе увеличиваем номер диалога на 1
-            return result + 1
+                # Последний выданный диалог еще пуст - продолжаем его
+                cursor.execute("SELECT last_dialog FROM user_dialog_counters WHERE id_user = ?", (id_user,))
+                result = cursor.fetchone()
+            return result[0]
         except Exception as e:
             logger.error(f"Ошибка при получении номера диалога: {e}")
-            return 1  # В случае ошибки возвращаем 1
+            raise
 
     def mark_last_message(self, id_user, number_dialog):
         """Отмечает, что текущий диалог завершен."""
@@ -297,18 +750,20 @@ class DBHandler:
             completion_price = pricing.get("completion")
             image_price = pricing.get("image")
             request_price = pricing.get("request")
+            input_cache_read_price = pricing.get("input_cache_read")
+            input_cache_write_price = pricing.get("input_cache_write")
 
             top_provider = model_data.get("top_provider", {})
             provider_context_length = top_provider.get("context_length")
             is_moderated = 1 if top_provider.get("is_moderated") else 0
 
-            # Проверяем, является ли модель бесплатной
-            is_free = 1 if model_id.endswith(":free") or (prompt_price == "0" and completion_price == "0") else 0
+            # Проверяем, является ли модель бесплатной (цены сравниваются как числа: "0.0" тоже бесплатно)
+            is_free = 1 if is_free_model(model_id, parse_price(prompt_price), parse_price(completion_price)) else 0
 
             cursor = self.conn.cursor()
 
             # Проверяем, есть ли уже такая модель в БД
-            cursor.execute("SELECT id, rus_description, top_model FROM models WHERE id = ?", (model_id,))
+            cursor.execute("SELECT id, rus_description, top_model, description FROM models WHERE id = ?", (model_id,))
             existing = cursor.fetchone()
 
             if existing:
@@ -316,12 +771,18 @@ class DBHandler:
                 rus_description = existing[1]
                 top_model = existing[2]
 
+                # Если английское описание изменилось, прежний перевод устарел:
+                # берем готовый перевод нового текста из кэша или сбрасываем его для повторного перевода
+                if description != existing[3]:
+                    rus_description = self.get_cached_translation(description)
+
                 # Обновляем существующую запись, сохраняя rus_description и top_model
                 cursor.execute("""
                 UPDATE models SET 
                     name = ?, 
                     created = ?, 
                     description = ?,
+                    rus_description = ?,
                     context_length = ?,
                     modality = ?,
                     tokenizer = ?,
@@ -330,15 +791,18 @@ class DBHandler:
                     completion_price = ?,
                     image_price = ?,
                     request_price = ?,
+                    input_cache_read_price = ?,
+                    input_cache_write_price = ?,
                     provider_context_length = ?,
                     is_moderated = ?,
                     is_free = ?,
                     updated_at = CURRENT_TIMESTAMP
                 WHERE id = ?
                 """, (
-                    name, created, description, context_length, modality, tokenizer,
+                    name, created, description, rus_description, context_length, modality, tokenizer,
                     instruct_type, prompt_price, completion_price, image_price,
-                    request_price, provider_context_length, is_moderated, is_free,
+                    request_price, input_cache_read_price, input_cache_write_price,
+                    provider_context_length, is_moderated, is_free,
                     model_id
                 ))
             else:
@@ -348,15 +812,18 @@ class DBHandler:
                     id, name, created, description, rus_description,
                     context_length, modality, tokenizer, instruct_type,
                     prompt_price, completion_price, image_price, request_price,
+                    input_cache_read_price, input_cache_write_price,
                     provider_context_length, is_moderated, is_free, top_model
-                ) VALUES (?, ?, ?, ?, NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
                 """, (
-                    model_id, name, created, description, context_length, modality, tokenizer,
+                    model_id, name, created, description, self.get_cached_translation(description), context_length, modality, tokenizer,
                     instruct_type, prompt_price, completion_price, image_price,
-                    request_price, provider_context_length, is_moderated, is_free
+                    request_price, input_cache_read_price, input_cache_write_price,
+                    provider_context_length, is_moderated, is_free
                 ))
 
             self.conn.commit()
+            self.models_version += 1
             return True
 
         except Exception as e:
@@ -364,13 +831,24 @@ class DBHandler:
             return False
 
     def get_models(self, only_free=False, only_top=False):
-        """Получает список моделей из БД с возможностью фильтрации."""
+        """
+        Получает записи каталога моделей из БД с возможностью фильтрации.
+
+        Обработчики бота используют каталог в памяти (ModelCatalog), который вызывает этот метод
+        только после изменения таблицы models.
+
+        Returns:
+            list: Записи ModelRecord (сначала топовые, затем по названию)
+        """
         try:
             cursor = self.conn.cursor()
 
-            query = "SELECT id, name, description, rus_description, context_length, is_free, top_model FROM models"
+            query = """
+            SELECT id, name, description, rus_description, context_length, prompt_price, completion_price,
+                input_cache_read_price, input_cache_write_price, top_model
+            FROM models
+            """
             conditions = []
-            params = []
 
             if only_free:
                 conditions.append("is_free = 1")
@@ -384,21 +862,21 @@ class DBHandler:
             # Сортировка: сначала топовые, затем по имени
             query += " ORDER BY top_model DESC, name ASC"
 
-            cursor.execute(query, params)
-
-            models = []
-            for row in cursor.fetchall():
-                model = {
-                    "id": row[0],
-                    "name": row[1],
-                    "description": row[3] if row[3] else row[2],  # Используем rus_description, если есть
-                    "context_length": row[4],
-                    "is_free": bool(row[5]),
-                    "top_model": bool(row[6])
-                }
-                models.append(model)
-
-            return models
+            cursor.execute(query)
+
+            return [
+                ModelRecord(
+                    row[0], row[1],
+                    description=row[3] if row[3] else row[2],  # Используем rus_description, если есть
+                    context_length=row[4],
+                    prompt_price=row[5],
+                    completion_price=row[6],
+                    cache_read_price=row[7],
+                    cache_write_price=row[8],
+                    top_model=row[9]
+                )
+                for row in cursor.fetchall()
+            ]
 
         except Exception as e:
             logger.error(f"Ошибка при получении списка моделей: {e}")
@@ -413,6 +891,7 @@ class DBHandler:
                 (rus_description, model_id)
             )
             self.conn.commit()
+            self.models_version += 1
             return True
         except Exception as e:
             logger.error(f"Ошибка при обновлении русского описания модели {model_id}: {e}")
@@ -436,6 +915,7 @@ class DBHandler:
                 )
 
             self.conn.commit()
+            self.models_version += 1
             return True
 
         except Exception as e:
@@ -448,11 +928,78 @@ class DBHandler:
             cursor = self.conn.cursor()
             cursor.execute("UPDATE models SET top_model = 0")
             self.conn.commit()
+            self.models_version += 1
             return True
         except Exception as e:
             logger.error(f"Ошибка при сбросе статуса топ-моделей: {e}")
             return False
 
+    @staticmethod
+    def translation_hash(source_text):
+        """Вычисляет ключ кэша переводов: SHA-256 текста с нормализованными пробелами."""
+        normalized = re.sub(r"\s+", " ", source_text.strip())
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def get_cached_translation(self, source_text, target_lang="ru"):
+        """
+        Ищет готовый перевод текста в кэше переводов.
+
+        Args:
+            source_text: Исходный текст
+            target_lang: Язык перевода
+
+        Returns:
+            str: Перевод или None, если текст еще не переводился
+        """
+        if not source_text:
+            return None
+
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "SELECT translation FROM translation_cache WHERE source_hash = ? AND target_lang = ?",
+                (self.translation_hash(source_text), target_lang)
+            )
+            result = cursor.fetchone()
+            return result[0] if result else None
+        except Exception as e:
+            logger.error(f"Ошибка при чтении кэша переводов: {e}")
+            return None
+
+    def save_cached_translation(self, source_text, translation, target_lang="ru"):
+        """Сохраняет перевод текста в кэш переводов."""
+        if not source_text or not translation:
+            return False
+
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "INSERT OR REPLACE INTO translation_cache (source_hash, target_lang, translation) VALUES (?, ?, ?)",
+                (self.translation_hash(source_text), target_lang, translation)
+            )
+            self.conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении перевода в кэш: {e}")
+            return False
+
+    def apply_cached_translations(self, target_lang="ru"):
+        """
+        Заполняет русские описания моделей готовыми переводами из кэша.
+
+        Returns:
+            int: Количество моделей, получивших перевод из кэша
+        """
+        applied = 0
+        for model_id, description in self.get_models_for_translation():
+            translation = self.get_cached_translation(description, target_lang)
+            if translation and self.set_model_description_ru(model_id, translation):
+                applied += 1
+
+        if applied:
+            logger.info(f"Из кэша переводов применено {applied} описаний моделей")
+        return applied
+
     def get_models_for_translation(self, model_id=None):
         """
         Получает список моделей для перевода.
@@ -484,6 +1031,438 @@ class DBHandler:
             logger.error(f"Ошибка при получении моделей для перевода: {e}")
             return []
 
+    # Методы для работы с состоянием пользователей
+    def load_user_session(self, id_user):
+        """
+        Загружает сохраненное состояние пользователя.
+
+        Args:
+            id_user: ID пользователя
+
+        Returns:
+            dict: Состояние пользователя (значения десериализованы из JSON)
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT key, value FROM user_sessions WHERE id_user = ?", (id_user,))
+            return {key: json.loads(value) for key, value in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке состояния пользователя {id_user}: {e}")
+            return {}
+
+    def save_user_session_changes(self, changes):
+        """
+        Сохраняет изменения состояния пользователей одной транзакцией.
+
+        Args:
+            changes: Список кортежей (id_user, key, value, deleted)
+
+        Returns:
+            bool: True при успешном сохранении
+        """
+        if not changes:
+            return True
+
+        try:
+            cursor = self.conn.cursor()
+            cursor.executemany(
+                """
+                INSERT INTO user_sessions (id_user, key, value, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT (id_user, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+                """,
+                [(id_user, key, json.dumps(value)) for id_user, key, value, deleted in changes if not deleted]
+            )
+            cursor.executemany(
+                "DELETE FROM user_sessions WHERE id_user = ? AND key = ?",
+                [(id_user, key) for id_user, key, value, deleted in changes if deleted]
+            )
+            self.conn.commit()
+            return True
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Ошибка при сохранении состояния пользователей: {e}")
+            return False
+
+    # Методы для работы со статистикой моделей
+    def load_model_health(self):
+        """
+        Загружает сохраненную статистику работы моделей.
+
+        Returns:
+            list: Кортежи (model_id, samples в JSON)
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT model_id, samples FROM model_health")
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке статистики моделей: {e}")
+            return []
+
+    def save_model_health(self, rows):
+        """
+        Сохраняет статистику работы моделей одной транзакцией.
+
+        Args:
+            rows: Кортежи (model_id, samples в JSON)
+
+        Returns:
+            bool: True при успешном сохранении
+        """
+        if not rows:
+            return True
+
+        try:
+            cursor = self.conn.cursor()
+            cursor.executemany(
+                """
+                INSERT INTO model_health (model_id, samples, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT (model_id) DO UPDATE SET samples = excluded.samples, updated_at = excluded.updated_at
+                """,
+                rows
+            )
+            self.conn.commit()
+            return True
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Ошибка при сохранении статистики моделей: {e}")
+            return False
+
+    # Методы для работы с ограничением частоты запросов
+    def load_rate_limit_buckets(self):
+        """
+        Загружает сохраненные корзины ограничения частоты запросов.
+
+        Returns:
+            list: Кортежи (scope, subject_id, kind, period, tokens, updated_at, capacity)
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "SELECT scope, subject_id, kind, period, tokens, updated_at, capacity FROM rate_limit_buckets"
+            )
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке ограничений частоты запросов: {e}")
+            return []
+
+    def save_rate_limit_buckets(self, rows, deleted_keys):
+        """
+        Сохраняет измененные корзины ограничения частоты запросов одной транзакцией.
+
+        Args:
+            rows: Кортежи (scope, subject_id, kind, period, tokens, updated_at, capacity) для сохранения
+            deleted_keys: Кортежи (scope, subject_id, kind, period) заполнившихся корзин для удаления
+
+        Returns:
+            bool: True при успешном сохранении
+        """
+        if not rows and not deleted_keys:
+            return True
+
+        try:
+            cursor = self.conn.cursor()
+            cursor.executemany(
+                """
+                INSERT INTO rate_limit_buckets (scope, subject_id, kind, period, tokens, updated_at, capacity)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (scope, subject_id, kind, period)
+                DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at, capacity = excluded.capacity
+                """,
+                rows
+            )
+            cursor.executemany(
+                "DELETE FROM rate_limit_buckets WHERE scope = ? AND subject_id = ? AND kind = ? AND period = ?",
+                deleted_keys
+            )
+            self.conn.commit()
+            return True
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Ошибка при сохранении ограничений частоты запросов: {e}")
+            return False
+
+    # Методы для работы со статистикой расхода
+    def save_usage_daily(self, rows):
+        """
+        Прибавляет накопленный расход к суммарной статистике одной транзакцией.
+
+        Args:
+            rows: Кортежи (day, id_user, model_id, requests, prompt_tokens, completion_tokens, cached_tokens, cost)
+
+        Returns:
+            bool: True при успешном сохранении
+        """
+        if not rows:
+            return True
+
+        try:
+            cursor = self.conn.cursor()
+            cursor.executemany(
+                """
+                INSERT INTO usage_daily (day, id_user, model_id, requests, prompt_tokens, completion_tokens,
+                    cached_tokens, cost)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (day, id_user, model_id) DO UPDATE SET
+                    requests = requests + excluded.requests,
+                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                    completion_tokens = completion_tokens + excluded.completion_tokens,
+                    cached_tokens = cached_tokens + excluded.cached_tokens,
+                    cost = cost + excluded.cost
+                """,
+                rows
+            )
+            self.conn.commit()
+            return True
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Ошибка при сохранении статистики расхода: {e}")
+            return False
+
+    def get_usage_costs(self, since_day):
+        """
+        Получает стоимость запросов по дням и пользователям начиная с указанного дня.
+
+        Returns:
+            list: Кортежи (day, id_user, cost)
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "SELECT day, id_user, SUM(cost) FROM usage_daily WHERE day >= ? GROUP BY day, id_user",
+                (since_day,)
+            )
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Ошибка при получении стоимости запросов: {e}")
+            return []
+
+    def get_usage_by_model(self, since_day):
+        """
+        Получает суммарный расход по моделям начиная с указанного дня.
+
+        Args:
+            since_day: Первый день периода в формате YYYY-MM-DD (UTC)
+
+        Returns:
+            list: Словари model_id, requests, users, prompt_tokens, completion_tokens, cached_tokens, cost
+                (по убыванию стоимости)
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                """
+                SELECT model_id, SUM(requests), COUNT(DISTINCT id_user), SUM(prompt_tokens),
+                    SUM(completion_tokens), SUM(cached_tokens), SUM(cost)
+                FROM usage_daily WHERE day >= ?
+                GROUP BY model_id
+                ORDER BY SUM(cost) DESC, SUM(requests) DESC
+                """,
+                (since_day,)
+            )
+            return [
+                {
+                    "model_id": row[0],
+                    "requests": row[1],
+                    "users": row[2],
+                    "prompt_tokens": row[3],
+                    "completion_tokens": row[4],
+                    "cached_tokens": row[5],
+                    "cost": row[6]
+                }
+                for row in cursor.fetchall()
+            ]
+        except Exception as e:
+            logger.error(f"Ошибка при получении статистики расхода по моделям: {e}")
+            return []
+
+    def get_usage_by_user(self, since_day, limit=10):
+        """
+        Получает пользователей с наибольшим расходом начиная с указанного дня.
+
+        Returns:
+            list: Словари id_user, requests, tokens, cost (по убыванию стоимости)
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                """
+                SELECT id_user, SUM(requests), SUM(prompt_tokens + completion_tokens), SUM(cost)
+                FROM usage_daily WHERE day >= ?
+                GROUP BY id_user
+                ORDER BY SUM(cost) DESC, SUM(prompt_tokens + completion_tokens) DESC
+                LIMIT ?
+                """,
+                (since_day, limit)
+            )
+            return [
+                {"id_user": row[0], "requests": row[1], "tokens": row[2], "cost": row[3]}
+                for row in cursor.fetchall()
+            ]
+        except Exception as e:
+            logger.error(f"Ошибка при получении статистики расхода по пользователям: {e}")
+            return []
+
+    # Методы для работы с фоновыми задачами
+    def enqueue_job(self, kind, params=None, dedup_key=None, created_by=None):
+        """
+        Ставит фоновую задачу в очередь.
+
+        Args:
+            kind: Тип задачи
+            params: Параметры задачи (сериализуются в JSON)
+            dedup_key: Ключ для защиты от повторного запуска (None = без защиты)
+            created_by: ID пользователя, создавшего задачу
+
+        Returns:
+            (job_id, created): ID задачи и флаг, была ли она создана (False - такая задача уже активна)
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "INSERT INTO jobs (kind, params, dedup_key, created_by) VALUES (?, ?, ?, ?)",
+                (kind, json.dumps(params or {}), dedup_key, created_by)
+            )
+            self.conn.commit()
+            return cursor.lastrowid, True
+        except sqlite3.IntegrityError:
+            self.conn.rollback()
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "SELECT id FROM jobs WHERE dedup_key = ? AND status IN ('queued', 'running')",
+                (dedup_key,)
+            )
+            result = cursor.fetchone()
+            return (result[0] if result else None), False
+        except Exception as e:
+            logger.error(f"Ошибка при постановке задачи {kind} в очередь: {e}")
+            return None, False
+
+    def claim_next_job(self):
+        """
+        Атомарно забирает из очереди самую старую задачу и переводит ее в статус 'running'.
+
+        Returns:
+            dict: Данные задачи или None, если очередь пуста
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                """
+                UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+                WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1)
+                RETURNING id, kind, params, progress, total, checkpoint, attempts, created_by
+                """
+            )
+            row = cursor.fetchone()
+            self.conn.commit()
+
+            if not row:
+                return None
+
+            return {
+                "id": row[0],
+                "kind": row[1],
+                "params": json.loads(row[2]) if row[2] else {},
+                "progress": row[3],
+                "total": row[4],
+                "checkpoint": json.loads(row[5]) if row[5] else {},
+                "attempts": row[6],
+                "created_by": row[7]
+            }
+        except Exception as e:
+            logger.error(f"Ошибка при получении задачи из очереди: {e}")
+            return None
+
+    def checkpoint_job(self, job_id, progress, total, checkpoint=None):
+        """Сохраняет прогресс задачи, чтобы после перезапуска продолжить с этого места."""
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "UPDATE jobs SET progress = ?, total = ?, checkpoint = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (progress, total, json.dumps(checkpoint or {}), job_id)
+            )
+            self.conn.commit()
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении прогресса задачи {job_id}: {e}")
+
+    def finish_job(self, job_id, status, result=None, error=None):
+        """
+        Завершает задачу.
+
+        Args:
+            job_id: ID задачи
+            status: Итоговый статус ('done' или 'failed')
+            result: Текстовый итог выполнения
+            error: Текст ошибки
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                """
+                UPDATE jobs SET status = ?, result = ?, error = ?,
+                    updated_at = CURRENT_TIMESTAMP, finished_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+                """,
+                (status, result, error, job_id)
+            )
+            self.conn.commit()
+        except Exception as e:
+            logger.error(f"Ошибка при завершении задачи {job_id}: {e}")
+
+    def requeue_running_jobs(self):
+        """
+        Возвращает в очередь задачи, прерванные перезапуском бота.
+
+        Returns:
+            int: Количество возвращенных задач
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("UPDATE jobs SET status = 'queued', updated_at = CURRENT_TIMESTAMP WHERE status = 'running'")
+            self.conn.commit()
+            if cursor.rowcount:
+                logger.info(f"Возвращено в очередь прерванных задач: {cursor.rowcount}")
+            return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Ошибка при возврате прерванных задач в очередь: {e}")
+            return 0
+
+    def get_jobs(self, limit=10):
+        """
+        Получает последние фоновые задачи.
+
+        Returns:
+            Список словарей с информацией о задачах (сначала новые)
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                """
+                SELECT id, kind, status, progress, total, attempts, error, result, created_at, updated_at
+                FROM jobs ORDER BY id DESC LIMIT ?
+                """,
+                (limit,)
+            )
+            return [
+                {
+                    "id": row[0],
+                    "kind": row[1],
+                    "status": row[2],
+                    "progress": row[3],
+                    "total": row[4],
+                    "attempts": row[5],
+                    "error": row[6],
+                    "result": row[7],
+                    "created_at": row[8],
+                    "updated_at": row[9]
+                }
+                for row in cursor.fetchall()
+            ]
+        except Exception as e:
+            logger.error(f"Ошибка при получении списка задач: {e}")
+            return []
+
     def get_dialog_history(self, id_user, number_dialog, limit=None):
         """
         Получает историю диалога пользователя.
@@ -537,6 +1516,193 @@ class DBHandler:
             logger.error(f"Ошибка при получении истории диалога: {e}")
             return []
 
+    def iter_dialog_turns(self, id_user=None, number_dialog=None, page_size=500, conn=None):
+        """
+        Постранично читает отображаемые обмены сообщениями в порядке (пользователь, диалог, id).
+
+        Каждая страница выбирается отдельным запросом с продолжением после последней
+        прочитанной записи (keyset), поэтому в памяти находится не больше page_size записей,
+        а чтение не удерживает курсор открытым между страницами.
+
+        Args:
+            id_user: ID пользователя (None = все пользователи)
+            number_dialog: Номер диалога (None = все диалоги)
+            page_size: Количество записей на странице
+            conn: Подключение для чтения (None = общее подключение self.conn)
+
+        Yields:
+            Кортежи (id, id_user, number_dialog, ask_date, model, model_id, user_ask, model_answer)
+        """
+        conditions = ["displayed = 1"]
+        params = []
+        if id_user is not None:
+            conditions.append("id_user = ?")
+            params.append(id_user)
+        if number_dialog is not None:
+            conditions.append("number_dialog = ?")
+            params.append(number_dialog)
+
+        base_query = f"""
+        SELECT id, id_user, number_dialog, ask_date, model, model_id, user_ask, model_answer
+        FROM dialogs
+        WHERE {" AND ".join(conditions)}
+        """
+        order = " ORDER BY id_user, number_dialog, id LIMIT ?"
+
+        # Продолжение сравнивается только по незафиксированным столбцам ключа,
+        # чтобы SQLite выполнял поиск по индексу idx_dialogs_user_dialog, а не просмотр
+        key_columns = [column for column, value in (("id_user", id_user), ("number_dialog", number_dialog))
+                       if value is None] + ["id"]
+        key_positions = {"id_user": 1, "number_dialog": 2, "id": 0}
+        keyset = f" AND ({', '.join(key_columns)}) > ({', '.join('?' * len(key_columns))})"
+
+        conn = conn or self.conn
+        last_key = None
+        while True:
+            try:
+                cursor = conn.cursor()
+                if last_key is None:
+                    cursor.execute(base_query + order, params + [page_size])
+                else:
+                    cursor.execute(base_query + keyset + order, params + last_key + [page_size])
+                rows = cursor.fetchall()
+            except Exception as e:
+                logger.error(f"Ошибка при чтении диалогов для экспорта: {e}")
+                raise
+
+            yield from rows
+
+            if len(rows) < page_size:
+                return
+            last_key = [rows[-1][key_positions[column]] for column in key_columns]
+
+    def get_recent_dialog_turns(self, id_user, number_dialog, limit):
+        """
+        Получает последние обмены сообщениями диалога.
+
+        Args:
+            id_user: ID пользователя
+            number_dialog: Номер диалога
+            limit: Количество последних обменов
+
+        Returns:
+            Список кортежей (id, user_ask, model_answer) в хронологическом порядке
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                """
+                SELECT id, user_ask, model_answer
+                FROM dialogs
+                WHERE id_user = ? AND number_dialog = ? AND displayed = 1
+                ORDER BY id DESC
+                LIMIT ?
+                """,
+                (id_user, number_dialog, limit)
+            )
+            return list(reversed(cursor.fetchall()))
+        except Exception as e:
+            logger.error(f"Ошибка при получении последних сообщений диалога: {e}")
+            return []
+
+    def search_dialog_turns(self, id_user, number_dialog, match_query, before_id=None, limit=4):
+        """
+        Ищет в диалоге наиболее релевантные запросу обмены сообщениями (ранжирование BM25).
+
+        Args:
+            id_user: ID пользователя
+            number_dialog: Номер диалога
+            match_query: Запрос в синтаксисе FTS5 MATCH
+            before_id: Искать только среди записей с id меньше указанного (None = среди всех)
+            limit: Максимальное количество найденных обменов
+
+        Returns:
+            Список кортежей (id, user_ask, model_answer) в хронологическом порядке
+        """
+        if not self.fts_enabled:
+            return []
+
+        try:
+            cursor = self.conn.cursor()
+
+            query = """
+            SELECT d.id, d.user_ask, d.model_answer
+            FROM dialogs_fts
+            JOIN dialogs d ON d.id = dialogs_fts.rowid
+            WHERE dialogs_fts MATCH ? AND d.id_user = ? AND d.number_dialog = ? AND d.displayed = 1
+            """
+            params = [self.user_match_query(id_user, match_query), id_user, number_dialog]
+
+            if before_id is not None:
+                query += " AND d.id < ?"
+                params.append(before_id)
+
+            query += " ORDER BY bm25(dialogs_fts) LIMIT ?"
+            params.append(limit)
+
+            cursor.execute(query, params)
+            return sorted(cursor.fetchall(), key=lambda row: row[0])
+        except Exception as e:
+            logger.error(f"Ошибка при поиске по истории диалога: {e}")
+            return []
+
+    @staticmethod
+    def user_match_query(id_user, match_query):
+        """Ограничивает запрос FTS5 записями пользователя и текстовыми столбцами индекса."""
+        return f'id_user : "{int(id_user)}" AND {{user_ask model_answer}} : ({match_query})'
+
+    def search_user_history(self, id_user, match_query, after=None, limit=5, highlight=("[", "]"),
+                            snippet_tokens=12):
+        """
+        Ищет по всем диалогам пользователя (ранжирование BM25) и возвращает фрагменты с совпадениями.
+
+        Результаты упорядочены по (rank, rowid) индекса; страницы продолжаются по этому ключу
+        последнего результата предыдущей страницы, поэтому следующая страница не требует
+        пропуска уже показанных результатов (OFFSET), а равные rank различаются по rowid.
+
+        Args:
+            id_user: ID пользователя
+            match_query: Запрос в синтаксисе FTS5 MATCH
+            after: Ключ (rank, rowid) последнего результата предыдущей страницы в том виде,
+                в каком его вернул этот метод (None = первая страница)
+            limit: Количество результатов на странице
+            highlight: Строки, которыми в фрагментах выделяются найденные слова
+            snippet_tokens: Максимальное количество слов во фрагменте
+
+        Returns:
+            Список кортежей (id, number_dialog, ask_date, rank, фрагмент запроса, фрагмент ответа)
+            (id записи диалога совпадает с rowid индекса)
+        """
+        if not self.fts_enabled:
+            return []
+
+        try:
+            cursor = self.conn.cursor()
+
+            query = """
+            SELECT dialogs_fts.rowid, d.number_dialog, d.ask_date, dialogs_fts.rank,
+                   snippet(dialogs_fts, 0, ?, ?, '…', ?),
+                   snippet(dialogs_fts, 1, ?, ?, '…', ?)
+            FROM dialogs_fts
+            JOIN dialogs d ON d.id = dialogs_fts.rowid
+            WHERE dialogs_fts MATCH ? AND d.id_user = ? AND d.displayed = 1
+            """
+            params = [*highlight, snippet_tokens, *highlight, snippet_tokens,
+                      self.user_match_query(id_user, match_query), id_user]
+
+            if after is not None:
+                query += " AND (dialogs_fts.rank > ? OR (dialogs_fts.rank = ? AND dialogs_fts.rowid > ?))"
+                params.extend([after[0], after[0], after[1]])
+
+            query += " ORDER BY dialogs_fts.rank, dialogs_fts.rowid LIMIT ?"
+            params.append(limit)
+
+            cursor.execute(query, params)
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Ошибка при поиске по истории пользователя: {e}")
+            return []
+
     def set_premium_status(self, user_id, is_premium=True):
         """
         Устанавливает или снимает премиум-статус пользователя.
@@ -584,6 +1750,21 @@ class DBHandler:
             logger.error(f"Ошибка при проверке премиум-статуса пользователя {user_id}: {e}")
             return False
 
+    def get_premium_user_ids(self):
+        """
+        Возвращает ID всех премиум-пользователей.
+
+        Returns:
+            set: ID пользователей с премиум-статусом
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT DISTINCT id_user FROM users WHERE is_premium = 1")
+            return {row[0] for row in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"Ошибка при получении списка премиум-пользователей: {e}")
+            return set()
+
     def check_user_exists_by_id(self, user_id):
         """
         Проверяет, существует ли пользователь с указанным ID.
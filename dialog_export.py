@@ -0,0 +1,97 @@
+import io
+import os
+import gzip
+import json
+import tempfile
+from contextlib import closing
+
+# Поддерживаемые форматы экспорта
+EXPORT_FORMATS = ("jsonl", "md")
+
+
+def format_jsonl_turn(row):
+    """Преобразует запись диалога в строку JSONL."""
+    dialog_row_id, id_user, number_dialog, ask_date, model, model_id, user_ask, model_answer = row
+    return json.dumps({
+        "id": dialog_row_id,
+        "user_id": id_user,
+        "dialog": number_dialog,
+        "date": ask_date,
+        "model": model,
+        "model_id": model_id,
+        "user": user_ask,
+        "assistant": model_answer
+    }, ensure_ascii=False) + "\n"
+
+
+def format_markdown_turn(row, previous_row):
+    """Преобразует запись диалога в Markdown (с заголовком при смене пользователя или диалога)."""
+    dialog_row_id, id_user, number_dialog, ask_date, model, model_id, user_ask, model_answer = row
+
+    text = ""
+    if previous_row is None or previous_row[1:3] != row[1:3]:
+        text += f"\n# Пользователь {id_user}, диалог {number_dialog}\n\n"
+
+    text += f"### Пользователь ({ask_date})\n\n{user_ask or ''}\n\n"
+    text += f"### {model or model_id}\n\n{model_answer or ''}\n\n---\n"
+    return text
+
+
+def write_dialog_export(rows, fileobj, export_format="jsonl"):
+    """
+    Записывает записи диалогов в файл, сжимая их gzip по мере чтения.
+
+    Args:
+        rows: Итератор записей (DBHandler.iter_dialog_turns)
+        fileobj: Файл, открытый для записи в двоичном режиме
+        export_format: "jsonl" или "md"
+
+    Returns:
+        int: Количество записанных обменов сообщениями
+    """
+    count = 0
+    previous_row = None
+
+    with gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=6) as compressed:
+        # Текст кодируется и передается в gzip блоками размера буфера
+        with io.TextIOWrapper(compressed, encoding="utf-8", write_through=False) as writer:
+            for row in rows:
+                if export_format == "md":
+                    writer.write(format_markdown_turn(row, previous_row))
+                else:
+                    writer.write(format_jsonl_turn(row))
+                previous_row = row
+                count += 1
+
+    return count
+
+
+def export_dialogs_to_file(db, export_format="jsonl", id_user=None, number_dialog=None, page_size=500):
+    """
+    Экспортирует диалоги во временный файл .gz.
+
+    Записи читаются из БД постранично и сразу записываются в сжатый файл на диске,
+    поэтому потребление памяти не зависит от объема истории. Функция выполняется в отдельном
+    потоке, поэтому читает через собственное подключение только для чтения, а не через общее.
+
+    Args:
+        db: Экземпляр DBHandler
+        export_format: "jsonl" или "md"
+        id_user: ID пользователя (None = все пользователи)
+        number_dialog: Номер диалога (None = все диалоги)
+        page_size: Количество записей, читаемых из БД за один запрос
+
+    Returns:
+        (path, count): Путь к файлу (удаляется вызывающим) и количество экспортированных обменов
+    """
+    fd, path = tempfile.mkstemp(prefix="dialogs_", suffix=f".{export_format}.gz")
+    try:
+        with os.fdopen(fd, "wb") as fileobj, closing(db.connect_read_only()) as conn:
+            count = write_dialog_export(
+                db.iter_dialog_turns(id_user, number_dialog, page_size, conn), fileobj, export_format
+            )
+    except Exception:
+        os.remove(path)
+        raise
+
+    return path, count
@@ -0,0 +1,258 @@
+import json
+import time
+import logging
+import threading
+from collections import deque
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+class ModelHealthTracker:
+    """
+    Скользящая статистика работы моделей: время до первого токена (TTFT), скорость генерации,
+    доля ошибок и доля ответов 429. Обновляется из потоков генерации и запросов перевода,
+    поэтому все методы потокобезопасны.
+
+    Для каждой модели хранятся последние window запросов; запросы старше max_age секунд
+    не учитываются, поэтому модель, которая давно не использовалась, снова считается исправной.
+    """
+
+    def __init__(self, window=50, max_age=3600, min_samples=3, max_error_rate=0.5, max_ttft=20):
+        """
+        Args:
+            window: Количество последних запросов, хранимых для каждой модели
+            max_age: Время (сек), после которого запрос не учитывается в статистике
+            min_samples: Минимальное количество запросов, чтобы признать модель неисправной
+            max_error_rate: Доля ошибок, выше которой модель считается неисправной
+            max_ttft: Медианное время до первого токена (сек), выше которого модель считается медленной
+        """
+        self.window = window
+        self.max_age = max_age
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.max_ttft = max_ttft
+
+        # model_id -> deque[(время, статус, ttft, токенов в секунду)], статус: "ok", "error", "rate_limited"
+        self.samples = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def _record(self, model_id, sample):
+        with self.lock:
+            self.samples.setdefault(model_id, deque(maxlen=self.window)).append(sample)
+            self.dirty.add(model_id)
+
+    def record_success(self, model_id, ttft, tokens_per_second=None):
+        """Записывает успешный запрос: время до первого токена и скорость генерации."""
+        self._record(model_id, (time.time(), "ok", ttft, tokens_per_second))
+
+    def record_failure(self, model_id, status_code=None):
+        """Записывает неудачный запрос (status_code - HTTP-статус ответа, если он был)."""
+        status = "rate_limited" if status_code == 429 else "error"
+        self._record(model_id, (time.time(), status, None, None))
+
+    def stats(self, model_id):
+        """
+        Возвращает статистику модели за последнее время.
+
+        Returns:
+            dict: requests, error_rate, rate_limited_rate, ttft_p50, ttft_p95, tokens_per_second
+                (None, если по модели нет свежих запросов)
+        """
+        min_time = time.time() - self.max_age
+        with self.lock:
+            samples = [sample for sample in self.samples.get(model_id, ()) if sample[0] >= min_time]
+
+        if not samples:
+            return None
+
+        ttfts = sorted(sample[2] for sample in samples if sample[1] == "ok" and sample[2] is not None)
+        speeds = [sample[3] for sample in samples if sample[1] == "ok" and sample[3]]
+        return {
+            "requests": len(samples),
+            "error_rate": sum(1 for sample in samples if sample[1] != "ok") / len(samples),
+            "rate_limited_rate": sum(1 for sample in samples if sample[1] == "rate_limited") / len(samples),
+            "ttft_p50": ttfts[len(ttfts) // 2] if ttfts else None,
+            "ttft_p95": ttfts[min(len(ttfts) - 1, int(len(ttfts) * 0.95))] if ttfts else None,
+            "tokens_per_second": sum(speeds) / len(speeds) if speeds else None
+        }
+
+    def ttft_percentile(self, model_id, fraction):
+        """Возвращает перцентиль времени до первого токена модели (None, если успешных запросов нет)."""
+        min_time = time.time() - self.max_age
+        with self.lock:
+            ttfts = sorted(sample[2] for sample in self.samples.get(model_id, ())
+                           if sample[0] >= min_time and sample[1] == "ok" and sample[2] is not None)
+        if not ttfts:
+            return None
+        return ttfts[min(len(ttfts) - 1, int(len(ttfts) * fraction))]
+
+    def is_healthy(self, model_id):
+        """Проверяет, что у модели нет частых ошибок и она отвечает достаточно быстро."""
+        stats = self.stats(model_id)
+        if stats is None or stats["requests"] < self.min_samples:
+            return True
+        if stats["error_rate"] > self.max_error_rate:
+            return False
+        return stats["ttft_p50"] is None or stats["ttft_p50"] <= self.max_ttft
+
+    def score(self, model_id):
+        """Оценка модели для выбора запасной (меньше - лучше): медианный TTFT с поправкой на ошибки."""
+        stats = self.stats(model_id)
+        if stats is None or stats["ttft_p50"] is None:
+            # Модели без статистики ставим между быстрыми и медленными
+            ttft = self.max_ttft / 2
+            error_rate = stats["error_rate"] if stats else 0.0
+        else:
+            ttft = stats["ttft_p50"]
+            error_rate = stats["error_rate"]
+        return ttft * (1 + 4 * error_rate)
+
+    def rank(self, model_ids):
+        """Возвращает исправные модели из списка, отсортированные от лучшей к худшей."""
+        healthy = [model_id for model_id in model_ids if self.is_healthy(model_id)]
+        return sorted(healthy, key=self.score)
+
+    def load(self, rows):
+        """Загружает сохраненную статистику: список (model_id, samples в JSON)."""
+        with self.lock:
+            for model_id, samples in rows:
+                try:
+                    self.samples[model_id] = deque((tuple(sample) for sample in json.loads(samples)),
+                                                   maxlen=self.window)
+                except (TypeError, ValueError) as e:
+                    logger.error(f"Некорректная статистика модели {model_id}: {e}")
+
+    def flush(self, db):
+        """
+        Записывает статистику измененных моделей в БД.
+
+        Returns:
+            int: Количество записанных моделей
+        """
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            rows = [(model_id, json.dumps(list(self.samples[model_id]))) for model_id in dirty]
+
+        if not db.save_model_health(rows):
+            # Не удалось записать - повторим при следующем сохранении
+            with self.lock:
+                self.dirty |= dirty
+            return 0
+
+        return len(rows)
+
+
+class CircuitBreakers:
+    """
+    Автоматические выключатели (circuit breaker) для моделей.
+
+    closed - запросы к модели проходят; после failure_threshold ошибок подряд или ответа
+    429/503 с заголовком Retry-After выключатель переходит в open.
+    open - запросы отклоняются сразу, без обращения к API, до истечения времени ожидания
+    (Retry-After или cooldown, удваивающийся при повторных неудачах до max_cooldown).
+    half_open - после ожидания пропускается один пробный запрос: успех замыкает выключатель,
+    ошибка снова размыкает его.
+    """
+
+    def __init__(self, failure_threshold=3, cooldown=30, max_cooldown=300, probe_timeout=120):
+        """
+        Args:
+            failure_threshold: Количество ошибок подряд, после которого выключатель размыкается
+            cooldown: Начальное время (сек), на которое размыкается выключатель
+            max_cooldown: Максимальное время размыкания (сек)
+            probe_timeout: Через сколько секунд пробный запрос без результата считается потерянным
+        """
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.probe_timeout = probe_timeout
+
+        # model_id -> {"state", "failures", "open_until", "cooldown", "probe_started"}
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def _breaker(self, model_id):
+        return self.breakers.setdefault(model_id, {
+            "state": "closed", "failures": 0, "open_until": 0.0, "cooldown": self.cooldown, "probe_started": None
+        })
+
+    def allow(self, model_id):
+        """Проверяет, можно ли отправить запрос к модели (для half_open - занимает пробный запрос)."""
+        now = time.monotonic()
+        with self.lock:
+            breaker = self.breakers.get(model_id)
+            if breaker is None or breaker["state"] == "closed":
+                return True
+
+            if breaker["state"] == "open":
+                if now < breaker["open_until"]:
+                    return False
+                breaker["state"] = "half_open"
+                breaker["probe_started"] = None
+
+            # half_open: одновременно выполняется только один пробный запрос
+            if breaker["probe_started"] is not None and now - breaker["probe_started"] < self.probe_timeout:
+                return False
+            breaker["probe_started"] = now
+            return True
+
+    def retry_after(self, model_id):
+        """Возвращает, через сколько секунд модель снова примет запросы (0 - уже принимает)."""
+        with self.lock:
+            breaker = self.breakers.get(model_id)
+            if breaker is None or breaker["state"] != "open":
+                return 0.0
+            return max(0.0, breaker["open_until"] - time.monotonic())
+
+    def state(self, model_id):
+        """Возвращает состояние выключателя модели: "closed", "open" или "half_open"."""
+        with self.lock:
+            breaker = self.breakers.get(model_id)
+            return breaker["state"] if breaker else "closed"
+
+    def record_success(self, model_id):
+        """Записывает успешный запрос: выключатель замыкается."""
+        with self.lock:
+            breaker = self.breakers.get(model_id)
+            if breaker is None:
+                return
+            if breaker["state"] != "closed":
+                logger.info(f"Модель {model_id} снова доступна")
+            del self.breakers[model_id]
+
+    def release_probe(self, model_id):
+        """
+        Освобождает пробный запрос, не меняя состояние выключателя (например, если запрос отклонен
+        из-за ошибки в нем самом и ничего не говорит о доступности модели).
+        """
+        with self.lock:
+            breaker = self.breakers.get(model_id)
+            if breaker is not None and breaker["state"] == "half_open":
+                breaker["probe_started"] = None
+
+    def record_failure(self, model_id, retry_after=None):
+        """
+        Записывает неудачный запрос.
+
+        Args:
+            model_id: ID модели
+            retry_after: Время ожидания (сек) из заголовка Retry-After, если провайдер его указал
+        """
+        now = time.monotonic()
+        with self.lock:
+            breaker = self._breaker(model_id)
+            breaker["failures"] += 1
+
+            if breaker["state"] == "half_open":
+                # Пробный запрос не удался - размыкаем на удвоенное время
+                breaker["cooldown"] = min(self.max_cooldown, breaker["cooldown"] * 2)
+            elif retry_after is None and breaker["failures"] < self.failure_threshold:
+                return
+
+            open_for = retry_after if retry_after is not None else breaker["cooldown"]
+            breaker["state"] = "open"
+            breaker["open_until"] = now + min(open_for, self.max_cooldown)
+            breaker["probe_started"] = None
+            logger.warning(f"Модель {model_id} временно отключена на {min(open_for, self.max_cooldown):.0f} сек.")
@@ -0,0 +1,122 @@
+import re
+import threading
+from collections import Counter
+
+# Символы, которые не входят в слова при поиске (разделители в ID моделей и названиях)
+NON_WORD_RE = re.compile(r"[^0-9a-zа-яё]+")
+
+
+def normalize(text):
+    """Приводит текст к нижнему регистру и заменяет разделители пробелами."""
+    return NON_WORD_RE.sub(" ", (text or "").lower().replace("ё", "е")).strip()
+
+
+def trigrams(text):
+    """Возвращает множество триграмм слов нормализованного текста (с отступами по краям слов)."""
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        grams.update(padded[index:index + 3] for index in range(len(padded) - 2))
+    return grams
+
+
+class ModelSearchIndex:
+    """
+    Нечеткий поиск моделей по ID, названию и описанию.
+
+    Для каждой модели хранятся триграммы ID и названия (заголовок) и описания, а также
+    инвертированный индекс триграмма -> номера моделей. Оценка модели - доля триграмм запроса,
+    найденных в заголовке, с меньшим весом - в описании, и бонус за слова заголовка, начинающиеся
+    со слов запроса. Индекс перестраивается, когда каталог моделей возвращает новый снимок записей.
+    """
+
+    # Вес совпадений в описании относительно совпадений в ID и названии
+    DESCRIPTION_WEIGHT = 0.4
+    # Минимальная оценка, при которой модель попадает в результаты
+    MIN_SCORE = 0.35
+
+    def __init__(self, catalog):
+        """
+        Args:
+            catalog: Каталог моделей (ModelCatalog)
+        """
+        self.catalog = catalog
+        self.lock = threading.Lock()
+        # Снимок индекса заменяется целиком: (записи каталога, заголовки, слова заголовков, индексы триграмм)
+        self.index = ((), (), (), {}, {})
+
+    def _current(self):
+        records = self.catalog.models()
+        if records is not self.index[0]:
+            with self.lock:
+                if records is not self.index[0]:
+                    self._rebuild(records)
+        return self.index
+
+    def _rebuild(self, records):
+        titles = []
+        title_words = []
+        title_postings = {}
+        description_postings = {}
+
+        for position, record in enumerate(records):
+            title = normalize(f"{record.id} {record.name}")
+            titles.append(title)
+            title_words.append(tuple(set(title.split())))
+
+            for gram in trigrams(title):
+                title_postings.setdefault(gram, []).append(position)
+            for gram in trigrams(normalize(record.description)):
+                description_postings.setdefault(gram, []).append(position)
+
+        self.index = (records, tuple(titles), tuple(title_words), title_postings, description_postings)
+
+    def search(self, query, only_free=False, limit=10):
+        """
+        Ищет модели по запросу.
+
+        Args:
+            query: Текст запроса (часть ID, названия или описания, допускаются опечатки)
+            only_free: Искать только среди бесплатных моделей
+            limit: Максимальное количество результатов
+
+        Returns:
+            list: Записи ModelRecord от наиболее к наименее подходящей
+        """
+        records, titles, title_words, title_postings, description_postings = self._current()
+        query = normalize(query)
+        query_grams = trigrams(query)
+        if not query_grams:
+            return []
+
+        title_hits = Counter()
+        description_hits = Counter()
+        for gram in query_grams:
+            title_hits.update(title_postings.get(gram, ()))
+            description_hits.update(description_postings.get(gram, ()))
+
+        query_words = query.split()
+        scored = []
+        for position in title_hits.keys() | description_hits.keys():
+            record = records[position]
+            if only_free and not record.is_free:
+                continue
+
+            score = (title_hits[position] + self.DESCRIPTION_WEIGHT * description_hits[position]) / len(query_grams)
+
+            # Слова запроса, с которых начинаются слова ID или названия
+            prefixes = sum(
+                1 for query_word in query_words
+                if any(word.startswith(query_word) for word in title_words[position])
+            )
+            score += 0.5 * prefixes / len(query_words)
+
+            # Полное совпадение запроса с заголовком или его частью
+            if query in titles[position]:
+                score += 0.5
+
+            if score >= self.MIN_SCORE:
+                scored.append((-score, record.sort_key, record))
+
+        scored.sort(key=lambda item: item[:2])
+        return [record for _, _, record in scored[:limit]]
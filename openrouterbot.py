@@ -1,23 +1,38 @@
 import requests
 import html
+import io
 import os
 import queue
 import re
 import threading
 import time
 import json
+import random
+import itertools
 import asyncio
 import logging
-from datetime import datetime
+from datetime import datetime, timezone
+from collections import deque
+from email.utils import parsedate_to_datetime
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, MenuButtonCommands, BotCommandScope
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram.ext import BaseUpdateProcessor, CallbackContext, InlineQueryHandler
+from telegram import InlineQueryResultArticle, InputTextMessageContent
 
 import config
 from db_handler import DBHandler
+from state_backend import create_state_backend
+from scheduler import GenerationScheduler, GenerationTicket, percentile
+from rate_limits import RateLimiter
+from model_health import ModelHealthTracker, CircuitBreakers
+from usage_stats import UsageRollup, SpendBudgets, compute_cost, budget_periods
+from catalog import ModelCatalog
+from model_search import ModelSearchIndex
+from dialog_export import EXPORT_FORMATS, export_dialogs_to_file
 
 # Настройка логирования
 logging.basicConfig(
@@ -28,6 +43,107 @@ logger = logging.getLogger(__name__)
 # Глобальная переменная для доступа к application из разных частей кода
 application = None
 
+# Каталог моделей в памяти и поисковый индекс по нему (создаются в main после подключения к БД)
+model_catalog = None
+model_search = None
+
+# Пометка для ответов, генерация которых была прервана остановкой бота
+INTERRUPTED_ANSWER_MARKER = "[Генерация прервана перезапуском бота]"
+
+# Статистика кэширования промпта (обновляется из потока обработки ответов)
+prompt_cache_stats = {"hits": 0, "misses": 0, "cached_tokens": 0, "prompt_tokens": 0}
+prompt_cache_stats_lock = threading.Lock()
+
+# Статистика работы моделей для выбора запасной модели (обновляется из потоков генерации)
+model_health = ModelHealthTracker(
+    window=config.MODEL_HEALTH_WINDOW,
+    max_age=config.MODEL_HEALTH_MAX_AGE,
+    min_samples=config.MODEL_HEALTH_MIN_SAMPLES,
+    max_error_rate=config.MODEL_MAX_ERROR_RATE,
+    max_ttft=config.MODEL_MAX_TTFT
+)
+
+# Автоматические выключатели моделей: пока модель недоступна, запросы к ней отклоняются сразу
+model_breakers = CircuitBreakers(
+    failure_threshold=config.BREAKER_FAILURE_THRESHOLD,
+    cooldown=config.BREAKER_COOLDOWN,
+    max_cooldown=config.BREAKER_MAX_COOLDOWN
+)
+
+# HTTP-статусы временной недоступности модели: такие запросы повторяются
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Время до первого токена с точки зрения пользователя для запросов с дублированием и без
+# (обновляется из потоков генерации)
+ttft_stats = {"hedged": deque(maxlen=1000), "direct": deque(maxlen=1000), "hedges_fired": 0, "hedges_won": 0}
+ttft_stats_lock = threading.Lock()
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает обновления параллельно (не более max_concurrent_updates одновременно),
+    сохраняя строгий порядок обработки обновлений внутри одного чата.
+
+    Очередь чата занимается в do_process_update, то есть уже после общего слота
+    (process_update базового класса final). Ожидающее обновление чата при этом держит слот,
+    но обработчики не ждут генераций (запросы ставятся в очередь чата), поэтому ожидание короткое.
+    Порядок сохраняется, так как и общий семафор, и lock чата пропускают ожидающих по очереди.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # Очередь (lock) для каждого чата и количество ожидающих ее обновлений
+        self._chat_locks = {}
+        self._chat_waiters = {}
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await coroutine
+            return
+
+        chat_id = chat.id
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        self._chat_waiters[chat_id] = self._chat_waiters.get(chat_id, 0) + 1
+
+        try:
+            async with lock:
+                await coroutine
+        finally:
+            self._chat_waiters[chat_id] -= 1
+            if not self._chat_waiters[chat_id]:
+                del self._chat_waiters[chat_id]
+                del self._chat_locks[chat_id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+class BotContext(CallbackContext):
+    """
+    Контекст обработчиков, в котором user_data берется из хранилища состояния
+    (bot_data["state"]), а не из памяти процесса. Это позволяет хранить выбранную модель
+    и текущий диалог вне процесса и обслуживать пользователей несколькими процессами.
+    """
+
+    @property
+    def user_data(self):
+        if self._user_id is None:
+            return None
+
+        state = self.application.bot_data.get("state")
+        if state is None:
+            return super().user_data
+        return state.user_session(self._user_id)
+
+    @property
+    def user_id(self):
+        """ID пользователя, от которого пришло обновление."""
+        return self._user_id
+
 
 def convert_markdown_to_html(markdown_text):
     """Конвертирует базовую разметку Markdown в HTML для Telegram."""
@@ -49,8 +165,13 @@ def convert_markdown_to_html(markdown_text):
     return text
 
 
-def fetch_and_update_models(context):
-    """Получает список моделей из API и обновляет БД."""
+def fetch_models():
+    """
+    Получает список моделей из API (выполняется в отдельном потоке, к БД не обращается).
+
+    Returns:
+        list: Модели из каталога OpenRouter (None при ошибке)
+    """
     url = "https://openrouter.ai/api/v1/models"
     headers = {
         "Authorization": f"Bearer {config.OPENROUTER_API_KEY}",
@@ -64,45 +185,56 @@ def fetch_and_update_models(context):
         response = requests.get(url, headers=headers, timeout=10)
 
         if response.status_code == 200:
-            data = response.json()
-
-            # Получаем доступ к БД
-            db = context.bot_data.get("db")
-            if db:
-                # Сохраняем каждую модель
-                saved_count = 0
-                for model in data.get("data", []):
-                    if db.save_model(model):
-                        saved_count += 1
-
-                logger.info(f"Обновлено {saved_count} моделей из {len(data.get('data', []))}")
-                return True
-            else:
-                logger.error("Нет доступа к БД для сохранения моделей")
-        else:
-            logger.error(f"Ошибка при получении моделей: {response.status_code} - {response.text}")
+            return response.json().get("data", [])
+
+        logger.error(f"Ошибка при получении моделей: {response.status_code} - {response.text}")
     except Exception as e:
         logger.error(f"Ошибка при обновлении моделей: {e}")
 
-    return False
+    return None
+
+
+async def fetch_and_update_models(application):
+    """
+    Получает список моделей из API и обновляет БД.
+
+    Запрос к API выполняется в отдельном потоке, а запись в БД - в цикле событий, как и все
+    остальные записи через общее соединение SQLite, поэтому транзакции не перемешиваются.
+    """
+    models = await asyncio.to_thread(fetch_models)
+    if models is None:
+        return False
+
+    db = application.bot_data.get("db")
+    if not db:
+        logger.error("Нет доступа к БД для сохранения моделей")
+        return False
+
+    # Сохраняем каждую модель, периодически уступая цикл событий другим обработчикам
+    saved_count = 0
+    for index, model in enumerate(models):
+        if db.save_model(model):
+            saved_count += 1
+        if index % 50 == 49:
+            await asyncio.sleep(0)
+
+    logger.info(f"Обновлено {saved_count} моделей из {len(models)}")
+    return True
 
 
-def select_translation_model(db):
+def select_translation_model():
     """
     Выбирает модель для перевода по заданным критериям:
     1. Модель должна быть бесплатной
     2. Предпочтительно содержать "Gemini" в названии
     3. В случае отсутствия Gemini, выбирается любая бесплатная модель
 
-    Args:
-        db: Объект базы данных для доступа к моделям
-
     Returns:
         str: ID модели для перевода или None, если подходящая модель не найдена
     """
     try:
         # Получаем все бесплатные модели
-        free_models = db.get_models(only_free=True)
+        free_models = model_catalog.models(only_free=True)
 
         if not free_models:
             logger.error("Не найдено бесплатных моделей для перевода")
@@ -110,29 +242,70 @@ def select_translation_model(db):
 
         # Ищем модель Gemini среди бесплатных
         gemini_models = [model for model in free_models
-                         if "gemini" in model["id"].lower() or "gemini" in model["name"].lower()]
+                         if "gemini" in model.id.lower() or "gemini" in model.name.lower()]
 
         if gemini_models:
             # Если есть несколько моделей Gemini, предпочитаем более новые версии.
             # Сортируем по убыванию, чтобы более новые версии были вначале
             # (например, gemini-pro-2.0 должен идти перед gemini-pro-1.5)
             gemini_models.sort(
-                key=lambda model: model["id"] + model["name"],
+                key=lambda model: model.id + model.name,
                 reverse=True
             )
 
-            logger.info(f"Выбрана модель Gemini для перевода: {gemini_models[0]['id']}")
-            return gemini_models[0]["id"]
+            logger.info(f"Выбрана модель Gemini для перевода: {gemini_models[0].id}")
+            return gemini_models[0].id
 
         # Если Gemini не найдена, берем первую бесплатную модель
-        logger.info(f"Модель Gemini не найдена, используем: {free_models[0]['id']}")
-        return free_models[0]["id"]
+        logger.info(f"Модель Gemini не найдена, используем: {free_models[0].id}")
+        return free_models[0].id
 
     except Exception as e:
         logger.error(f"Ошибка при выборе модели для перевода: {e}")
         return None
 
 
+class TokenBucket:
+    """Ограничитель частоты запросов по алгоритму token bucket."""
+
+    def __init__(self, rate, capacity):
+        """
+        Args:
+            rate: Скорость пополнения (токенов в секунду)
+            capacity: Максимальное количество токенов (допустимый всплеск)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, tokens=1):
+        """Забирает токены, если они есть. Возвращает False, не дожидаясь пополнения."""
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens=1):
+        """Ожидает, пока в корзине накопится нужное количество токенов, и забирает их."""
+        while not self.try_acquire(tokens):
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+def build_translation_prompt(description):
+    """Формирует запрос на перевод описания модели."""
+    return f"""Переведи следующее описание AI модели с английского на русский язык.
+Сохрани форматирование и технические термины, но сделай текст понятным русскоязычному пользователю:
+
+{description}"""
+
+
 async def translate_model_description(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Переводит описание указанной модели на русский язык."""
     user_id = update.effective_user.id
@@ -172,11 +345,18 @@ async def translate_model_description(update: Update, context: ContextTypes.DEFA
         await update.message.reply_text(f"⚠️ Модель '{model_id}' не имеет описания для перевода.")
         return
 
+    # Если этот текст уже переводился, используем готовый перевод
+    cached = db.get_cached_translation(description)
+    if cached:
+        db.set_model_description_ru(model_id, cached)
+        await update.message.reply_text(f"✅ Перевод описания модели '{model_id}' взят из кэша и сохранен.")
+        return
+
     # Сообщаем о начале перевода
     message = await update.message.reply_text(f"🔄 Начинаю перевод описания модели '{model_id}'...")
 
     # Выбираем модель для перевода
-    translation_model = select_translation_model(db)
+    translation_model = select_translation_model()
 
     if not translation_model:
         await message.edit_text("⚠️ Не удалось найти подходящую модель для перевода.")
@@ -186,21 +366,16 @@ async def translate_model_description(update: Update, context: ContextTypes.DEFA
     try:
         await message.edit_text(f"🔄 Перевожу описание модели '{model_id}' с помощью '{translation_model}'...")
 
-        # Формируем запрос на перевод
-        original_prompt = f"""Переведи следующее описание AI модели с английского на русский язык. 
-Сохрани форматирование и технические термины, но сделай текст понятным русскоязычному пользователю:
-
-{description}"""
-
         # Получаем перевод
         translation = await generate_ai_response(
-            original_prompt,
+            build_translation_prompt(description),
             translation_model,
             stream=False
         )
 
         # Сохраняем перевод в базе данных
         if translation:
+            db.save_cached_translation(description, translation)
             db.set_model_description_ru(model_id, translation)
             await message.edit_text(f"✅ Перевод описания модели '{model_id}' завершен и сохранен.")
         else:
@@ -237,33 +412,156 @@ async def generate_ai_response(prompt, model_id, stream=True):
         "stream": stream
     }
 
-    try:
-        response = requests.post(url, headers=headers, json=payload, timeout=60)
+    for attempt in range(config.MODEL_RETRY_ATTEMPTS + 1):
+        # Пока выключатель модели разомкнут, запрос отклоняется сразу, без обращения к API
+        if not model_breakers.allow(model_id):
+            logger.warning(f"Модель {model_id} временно отключена, запрос не отправлен")
+            return None
+
+        retry_after = None
+        try:
+            # Блокирующий запрос выполняется в отдельном потоке, чтобы не останавливать цикл событий бота
+            request_start = time.time()
+            response = await asyncio.to_thread(requests.post, url, headers=headers, json=payload, timeout=60)
+
+            if response.status_code != 200:
+                logger.error(f"Ошибка OpenRouter API: {response.status_code} - {response.text}")
+
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    # Ошибка в самом запросе ничего не говорит о доступности модели - повтор не поможет
+                    model_breakers.release_probe(model_id)
+                    return None
+
+                model_health.record_failure(model_id, response.status_code)
+                if response.status_code in (429, 503):
+                    retry_after = parse_retry_after(response)
+                model_breakers.record_failure(model_id, retry_after)
+
+            # Для неспотоковой передачи извлекаем текст
+            elif not stream:
+                response_data = response.json()
+
+                if (response_data and 'choices' in response_data
+                        and len(response_data['choices']) > 0
+                        and 'message' in response_data['choices'][0]
+                        and 'content' in response_data['choices'][0]['message']):
+
+                    # Без потоковой передачи первым токеном считается весь ответ
+                    model_health.record_success(model_id, time.time() - request_start)
+                    model_breakers.record_success(model_id)
+                    return response_data['choices'][0]['message']['content']
+                else:
+                    logger.error("Неожиданный формат ответа от OpenRouter API")
+                    model_health.record_failure(model_id)
+                    model_breakers.record_success(model_id)
+                    return None
+            else:
+                # Для потоковой передачи (неприменимо в этой функции)
+                return None
+
+        except Exception as e:
+            logger.error(f"Ошибка при запросе к OpenRouter API: {e}")
+            model_health.record_failure(model_id)
+            model_breakers.record_failure(model_id)
 
-        if response.status_code != 200:
-            logger.error(f"Ошибка OpenRouter API: {response.status_code} - {response.text}")
+        # Повторяем запрос, если ожидание не слишком долгое
+        delay = retry_delay(attempt, retry_after)
+        if attempt == config.MODEL_RETRY_ATTEMPTS or delay > config.MODEL_RETRY_MAX_DELAY:
             return None
+        await asyncio.sleep(delay)
+
+    return None
+
+
+def parse_retry_after(response):
+    """Возвращает время ожидания (сек) из заголовка Retry-After или None, если заголовка нет."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    # Заголовок может содержать дату в формате HTTP
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(attempt, retry_after=None):
+    """
+    Задержка перед повторной попыткой запроса: время из Retry-After, если провайдер его указал,
+    иначе экспоненциальная задержка со случайным разбросом, чтобы повторы не приходили одновременно.
+    """
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0.5, 1.0) * min(config.MODEL_RETRY_MAX_DELAY, config.MODEL_RETRY_BASE_DELAY * 2 ** attempt)
 
-        # Для неспотоковой передачи извлекаем текст
-        if not stream:
-            response_data = response.json()
 
-            if (response_data and 'choices' in response_data
-                    and len(response_data['choices']) > 0
-                    and 'message' in response_data['choices'][0]
-                    and 'content' in response_data['choices'][0]['message']):
+def open_model_stream(session, url, headers, payload, model_id, cancel_event):
+    """
+    Отправляет потоковый запрос к модели с учетом ее автоматического выключателя.
+
+    Пока ответ не начался, сетевые ошибки и ответы 429/5xx повторяются (не более MODEL_RETRY_ATTEMPTS раз)
+    с задержкой retry_delay. Если провайдер просит подождать дольше MODEL_RETRY_MAX_DELAY, повтор
+    не выполняется, а выключатель модели размыкается на время из Retry-After.
+
+    Returns:
+        (response, error_msg, request_start): успешный ответ и время начала запроса
+            либо (None, текст ошибки, None)
+    """
+    error_msg = None
+
+    for attempt in range(config.MODEL_RETRY_ATTEMPTS + 1):
+        # Пока выключатель модели разомкнут, запрос отклоняется сразу, без обращения к API
+        if not model_breakers.allow(model_id):
+            wait_time = int(model_breakers.retry_after(model_id)) + 1
+            logger.warning(f"Модель {model_id} временно отключена, запрос не отправлен")
+            return None, error_msg or f"Модель {model_id} временно недоступна, повторите запрос через {wait_time} сек.", None
 
-                return response_data['choices'][0]['message']['content']
+        request_start = time.time()
+        retry_after = None
+        try:
+            response = session.post(url, headers=headers, json=payload, stream=True, timeout=30)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Ошибка запроса к модели {model_id}: {e}")
+            if isinstance(e, requests.exceptions.Timeout):
+                error_msg = "Сервер не отвечает. Пожалуйста, попробуйте позже."
             else:
-                logger.error("Неожиданный формат ответа от OpenRouter API")
-                return None
+                error_msg = f"Ошибка соединения с API: {e}"
+            model_health.record_failure(model_id)
         else:
-            # Для потоковой передачи (неприменимо в этой функции)
-            return None
+            if response.ok:
+                return response, None, request_start
 
-    except Exception as e:
-        logger.error(f"Ошибка при запросе к OpenRouter API: {e}")
-        return None
+            error_msg = f"Ошибка API: {response.status_code} - {response.text}"
+            logger.error(error_msg)
+            response.close()
+
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                # Ошибка в самом запросе ничего не говорит о доступности модели - повтор не поможет
+                model_breakers.release_probe(model_id)
+                return None, error_msg, None
+
+            model_health.record_failure(model_id, response.status_code)
+
+            if response.status_code in (429, 503):
+                retry_after = parse_retry_after(response)
+
+        model_breakers.record_failure(model_id, retry_after)
+
+        delay = retry_delay(attempt, retry_after)
+        if attempt == config.MODEL_RETRY_ATTEMPTS or delay > config.MODEL_RETRY_MAX_DELAY:
+            break
+
+        # Ожидание прерывается отменой генерации
+        if cancel_event.wait(delay):
+            break
+
+    return None, error_msg, None
 
 
 async def translate_descriptions(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -286,114 +584,122 @@ async def translate_descriptions(update: Update, context: ContextTypes.DEFAULT_T
     if context.args:
         model_id = context.args[0]
 
-    # Отправляем сообщение о начале обновления
-    message = await update.message.reply_text("Начинаю перевод описаний моделей...")
+    # Перевод выполняется фоновой задачей: он переживает перезапуск бота и не запускается дважды
+    message = await update.message.reply_text("Ставлю перевод описаний моделей в очередь...")
 
-    # Получаем список моделей для перевода
-    cursor = db.conn.cursor()
+    job_id, created = db.enqueue_job(
+        "translate_descriptions",
+        {"model_id": model_id, "chat_id": message.chat_id, "message_id": message.message_id},
+        dedup_key=f"translate_descriptions:{model_id or '*'}",
+        created_by=user_id
+    )
 
-    if model_id:
-        # Переводим конкретную модель
-        cursor.execute(
-            "SELECT id, description FROM models WHERE id = ?",
-            (model_id,)
-        )
+    if not job_id:
+        await message.edit_text("⚠️ Не удалось поставить задачу в очередь. Подробности в логах.")
+    elif not created:
+        await message.edit_text(f"Перевод описаний уже выполняется (задача #{job_id}). Статус: /jobs")
     else:
-        # Ищем все модели с пустым rus_description
-        cursor.execute(
-            "SELECT id, description FROM models WHERE rus_description IS NULL OR rus_description = ''"
-        )
-
-    models_to_translate = cursor.fetchall()
-
-    if not models_to_translate:
-        await message.edit_text("Нет моделей для перевода.")
-        return
+        wake_job_workers(context.application)
+        await message.edit_text(f"Задача #{job_id} на перевод описаний поставлена в очередь. Статус: /jobs")
 
-    # Счетчики для статистики
-    total = len(models_to_translate)
-    success = 0
-    failed = 0
 
-    # Получаем начальную модель для перевода
-    current_tr_model = select_translation_model(db)
+async def translate_models_concurrently(db, models_to_translate, translation_model, progress_callback=None):
+    """
+    Переводит описания моделей параллельно с ограничением нагрузки на API.
 
-    if not current_tr_model:
-        await message.edit_text("⚠️ Не удалось найти подходящую модель для перевода.")
-        return
+    Одновременно выполняется не более TRANSLATION_CONCURRENCY запросов, частота запросов
+    к каждой модели-переводчику ограничена собственным TokenBucket. При ошибке перевод
+    повторяется на следующей бесплатной модели (get_next_free_model).
 
-    # Обновляем статус
-    await message.edit_text(
-        f"Начинаю перевод {total} описаний моделей.\n"
-        f"Текущая модель для перевода: {current_tr_model}"
-    )
+    Args:
+        db: Экземпляр DBHandler
+        models_to_translate: Список кортежей (id, description)
+        translation_model: Начальная модель для перевода
+        progress_callback: Корутина (success, failed, current_tr_model), вызываемая после каждой модели
 
-    # Переводим каждое описание
-    for i, model_data in enumerate(models_to_translate):
-        current_model_id = model_data[0]
-        description = model_data[1]
+    Returns:
+        (success, failed): Количество успешных и неудачных переводов
+    """
+    semaphore = asyncio.Semaphore(config.TRANSLATION_CONCURRENCY)
+    buckets = {}
+    state = {"model": translation_model, "success": 0, "failed": 0}
+
+    def get_bucket(model_id):
+        if model_id not in buckets:
+            buckets[model_id] = TokenBucket(
+                rate=config.TRANSLATION_REQUESTS_PER_MINUTE / 60,
+                capacity=config.TRANSLATION_BURST
+            )
+        return buckets[model_id]
 
+    async def translate_one(current_model_id, description):
         if not description:
             logger.warning(f"У модели {current_model_id} отсутствует описание")
-            failed += 1
-            continue
+            return False
 
-        # Формируем запрос на перевод
-        original_prompt = f"""Переведи следующее описание AI модели с английского на русский язык.
-Сохрани форматирование и технические термины, но сделай текст понятным русскоязычному пользователю:
+        # Уже переведенный текст берем из кэша без обращения к API
+        cached = db.get_cached_translation(description)
+        if cached:
+            logger.info(f"Перевод для модели {current_model_id} взят из кэша")
+            return db.set_model_description_ru(current_model_id, cached)
 
-{description}"""
+        prompt = build_translation_prompt(description)
 
-        try:
-            # Пробуем получить перевод
-            translated = await generate_ai_response(
-                original_prompt,
-                current_tr_model,
-                stream=False
-            )
+        for _ in range(config.TRANSLATION_MAX_ATTEMPTS):
+            tr_model = state["model"]
+            await get_bucket(tr_model).acquire()
+
+            try:
+                translated = await generate_ai_response(prompt, tr_model, stream=False)
+            except Exception as e:
+                logger.error(f"Ошибка при переводе модели {current_model_id}: {e}")
+                translated = None
 
             if translated:
                 logger.info(f"Перевод для модели {current_model_id} получен: {translated[:50]}...")
-                # Обновляем описание в БД
+                db.save_cached_translation(description, translated)
                 if db.set_model_description_ru(current_model_id, translated):
-                    success += 1
                     logger.info(f"Перевод для модели {current_model_id} успешно сохранен")
-                else:
-                    failed += 1
-                    logger.error(f"Не удалось сохранить перевод для модели {current_model_id}")
-            else:
-                failed += 1
-                logger.error(f"Не удалось получить перевод для модели {current_model_id}")
+                    return True
+                logger.error(f"Не удалось сохранить перевод для модели {current_model_id}")
+                return False
 
-                # Пробуем получить следующую модель при ошибке
-                next_tr_model = get_next_free_model(db, current_tr_model)
-                if next_tr_model and next_tr_model != current_tr_model:
-                    current_tr_model = next_tr_model
-                    logger.info(f"Модель для перевода изменена на: {current_tr_model}")
+            logger.error(f"Не удалось получить перевод для модели {current_model_id} с помощью {tr_model}")
 
-        except Exception as e:
-            logger.error(f"Ошибка при переводе модели {current_model_id}: {e}")
-            failed += 1
-
-        # Обновляем статус каждые 3 модели или на последней модели
-        if (success + failed) % 3 == 0 or (success + failed) == total:
-            await message.edit_text(
-                f"Перевод моделей: {success + failed}/{total}\n"
-                f"✅ Успешно: {success}\n"
-                f"❌ Ошибок: {failed}\n"
-                f"Текущая модель для перевода: {current_tr_model}"
-            )
+            # Переключаемся на следующую модель, если другой воркер еще не сделал этого
+            if state["model"] == tr_model:
+                next_tr_model = get_next_free_model(tr_model)
+                if next_tr_model and next_tr_model != tr_model:
+                    state["model"] = next_tr_model
+                    logger.info(f"Модель для перевода изменена на: {next_tr_model}")
 
-        # Делаем паузу, чтобы не перегружать API
-        await asyncio.sleep(2)
+        return False
 
-    # Финальный отчет
-    await message.edit_text(
-        f"Перевод завершен!\n"
-        f"Всего моделей: {total}\n"
-        f"✅ Успешно переведено: {success}\n"
-        f"❌ Ошибок: {failed}"
-    )
+    async def worker(model_ids, description):
+        async with semaphore:
+            translated = await translate_one(model_ids[0], description)
+
+        # Модели с одинаковым описанием (например, :free и платная версия) переводятся одним запросом
+        for duplicate_id in model_ids[1:]:
+            translated = translated and db.set_model_description_ru(duplicate_id, db.get_cached_translation(description))
+
+        if translated:
+            state["success"] += len(model_ids)
+        else:
+            state["failed"] += len(model_ids)
+
+        if progress_callback:
+            await progress_callback(state["success"], state["failed"], state["model"])
+
+    # Группируем модели по хэшу исходного текста
+    groups = {}
+    for model_id, description in models_to_translate:
+        key = db.translation_hash(description) if description else model_id
+        groups.setdefault(key, (description, []))[1].append(model_id)
+
+    await asyncio.gather(*(worker(model_ids, description) for description, model_ids in groups.values()))
+
+    return state["success"], state["failed"]
 
 
 async def translate_all_models(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -411,28 +717,28 @@ async def translate_all_models(update: Update, context: ContextTypes.DEFAULT_TYP
     await translate_descriptions(update, context)
 
 
-def get_next_free_model(db, current_model_id):
+def get_next_free_model(current_model_id):
     """
-    Получает следующую доступную бесплатную модель после текущей.
-    Если текущая модель последняя или не найдена, возвращает первую доступную бесплатную модель.
+    Получает бесплатную модель на замену текущей: лучшую исправную по статистике model_health.
+    Если исправных моделей нет, возвращает следующую бесплатную модель после текущей
+    (или первую, если текущая последняя или не найдена).
     """
     try:
-        cursor = db.conn.cursor()
-
         # Получаем все бесплатные модели
-        cursor.execute("""
-        SELECT id FROM models 
-        WHERE (prompt_price = '0' AND completion_price = '0') 
-           OR id LIKE '%:free' 
-        ORDER BY id
-        """)
-
-        free_models = [row[0] for row in cursor.fetchall()]
+        free_models = sorted(model.id for model in model_catalog.models(only_free=True))
 
         if not free_models:
             logger.error("В базе данных нет доступных бесплатных моделей")
             return None
 
+        # Выбираем самую быструю из исправных моделей (кроме временно отключенных)
+        healthy_models = model_health.rank([
+            model_id for model_id in free_models
+            if model_id != current_model_id and not model_breakers.retry_after(model_id)
+        ])
+        if healthy_models:
+            return healthy_models[0]
+
         # Если текущая модель в списке, ищем следующую
         if current_model_id in free_models:
             current_index = free_models.index(current_model_id)
@@ -448,6 +754,253 @@ def get_next_free_model(db, current_model_id):
         return "anthropic/claude-3-haiku:free"
 
 
+def get_failover_models(model_id, required_context=0):
+    """
+    Определяет модели, к которым по очереди обращается запрос чата.
+
+    Для бесплатной модели добавляются исправные бесплатные модели, вмещающие контекст диалога,
+    в порядке их статистики (model_health). Если выбранная модель неисправна или слишком медленная,
+    запрос сразу направляется на лучшую запасную модель. Платные модели не подменяются.
+
+    Args:
+        model_id: ID выбранной модели
+        required_context: Оценка размера контекста диалога в токенах
+
+    Returns:
+        list: ID моделей (не более MODEL_FAILOVER_ATTEMPTS)
+    """
+    selected = model_catalog.get(model_id)
+    if selected is None or not selected.is_free:
+        return [model_id]
+
+    # Модели с разомкнутым выключателем не рассматриваем
+    alternates = model_health.rank([
+        model.id for model in model_catalog.models(only_free=True)
+        if model.id != model_id and model.context_length >= required_context
+        and not model_breakers.retry_after(model.id)
+    ])
+
+    if model_health.is_healthy(model_id) and not model_breakers.retry_after(model_id):
+        candidates = [model_id] + alternates
+    else:
+        logger.info(f"Модель {model_id} неисправна или медленная, запрос будет направлен на запасную модель")
+        candidates = alternates + [model_id]
+
+    return candidates[:config.MODEL_FAILOVER_ATTEMPTS]
+
+
+def sse_line_has_content(line):
+    """Проверяет, содержит ли строка SSE-потока непустой фрагмент ответа модели."""
+    if not line or not line.startswith(b"data: ") or line == b"data: [DONE]":
+        return False
+    try:
+        choices = json.loads(line[6:]).get("choices") or []
+    except ValueError:
+        return False
+    return bool(choices and (choices[0].get("delta") or {}).get("content"))
+
+
+def get_hedge_delay(model_id):
+    """
+    Время ожидания первого токена, после которого отправляется дублирующий запрос:
+    перцентиль HEDGE_DELAY_PERCENTILE времени до первого токена модели в пределах
+    [HEDGE_MIN_DELAY, HEDGE_MAX_DELAY] (HEDGE_MAX_DELAY, если статистики еще нет).
+    """
+    delay = model_health.ttft_percentile(model_id, config.HEDGE_DELAY_PERCENTILE)
+    if delay is None:
+        return config.HEDGE_MAX_DELAY
+    return min(config.HEDGE_MAX_DELAY, max(config.HEDGE_MIN_DELAY, delay))
+
+
+def open_hedged_stream(url, headers, messages, candidates, model_id, prompt_cache, cancel_event):
+    """
+    Запрос с дублированием: если первая модель не прислала содержимое ответа за get_hedge_delay
+    секунд, такой же запрос отправляется следующей модели из candidates. При ошибке запроса
+    следующая модель запускается сразу. Побеждает запрос, первым приславший содержимое ответа,
+    остальные соединения немедленно закрываются, и провайдер прекращает их генерацию.
+
+    Returns:
+        (model_id, response, line_iter, request_start, error_msg, hedge_fired): победивший запрос
+            и итератор строк ответа (вместе с уже прочитанными), либо response = None и текст ошибки
+    """
+    results = queue.Queue()
+    attempts = {}
+    attempts_lock = threading.Lock()
+    pending = list(candidates)
+
+    def run_attempt(candidate):
+        attempt = attempts[candidate]
+        payload = build_chat_payload(candidate, messages, prompt_cache if candidate == model_id else None)
+
+        # Сессия закрывается при выходе из попытки: соединение победившего ответа остается
+        # за ним и закрывается вместе с ответом, остальные соединения пула закрываются сразу
+        with requests.Session() as session:
+            response, error_msg, request_start = open_model_stream(
+                session, url, headers, payload, candidate, attempt["abandoned"])
+
+            if response is None:
+                results.put((candidate, None, None, None, error_msg))
+                return
+
+            with attempts_lock:
+                attempt["response"] = response
+                if attempt["abandoned"].is_set():
+                    response.close()
+                    return
+
+            # Читаем ответ до первого фрагмента содержимого
+            lines = []
+            try:
+                line_iter = response.iter_lines()
+                for line in line_iter:
+                    lines.append(line)
+                    if sse_line_has_content(line):
+                        results.put((candidate, response, itertools.chain(lines, line_iter), request_start, None))
+                        return
+            except Exception as e:
+                if not attempt["abandoned"].is_set():
+                    results.put((candidate, None, None, None, f"Ошибка при чтении ответа: {e}"))
+                return
+
+            if not attempt["abandoned"].is_set():
+                model_health.record_failure(candidate)
+                results.put((candidate, None, None, None, f"Модель {candidate} вернула пустой ответ"))
+
+    def launch():
+        candidate = pending.pop(0)
+        attempts[candidate] = {"response": None, "abandoned": threading.Event()}
+        threading.Thread(target=run_attempt, args=(candidate,), daemon=True).start()
+
+    def abandon(except_model=None):
+        with attempts_lock:
+            for candidate, attempt in attempts.items():
+                if candidate != except_model:
+                    attempt["abandoned"].set()
+                    if attempt["response"] is not None:
+                        attempt["response"].close()
+
+    launch()
+    in_flight = 1
+    hedge_at = time.time() + get_hedge_delay(candidates[0])
+    hedge_fired = False
+    error_msg = None
+
+    while True:
+        if cancel_event.is_set():
+            abandon()
+            return None, None, None, None, error_msg, hedge_fired
+
+        try:
+            candidate, response, line_iter, request_start, attempt_error = results.get(timeout=0.1)
+        except queue.Empty:
+            # Первая модель молчит дольше обычного - дублируем запрос
+            if pending and not hedge_fired and time.time() >= hedge_at:
+                logger.info(f"Модель {candidates[0]} не ответила за отведенное время, дублируем запрос на {pending[0]}")
+                launch()
+                in_flight += 1
+                hedge_fired = True
+            continue
+
+        in_flight -= 1
+        if response is not None:
+            abandon(except_model=candidate)
+            return candidate, response, line_iter, request_start, None, hedge_fired
+
+        error_msg = attempt_error
+        if pending:
+            launch()
+            in_flight += 1
+        elif not in_flight:
+            return None, None, None, None, error_msg, hedge_fired
+
+
+def record_ttft(hedging, ttft, hedge_fired=False, hedge_won=False):
+    """Записывает время до первого токена с точки зрения пользователя."""
+    with ttft_stats_lock:
+        ttft_stats["hedged" if hedging else "direct"].append(ttft)
+        if hedge_fired:
+            ttft_stats["hedges_fired"] += 1
+        if hedge_won:
+            ttft_stats["hedges_won"] += 1
+
+
+def build_chat_payload(model_id, messages, prompt_cache=None, max_tokens=None):
+    """
+    Формирует тело запроса к OpenRouter для чата.
+
+    Для моделей с явным кэшированием промпта (см. ModelRecord.prompt_cache) последнее
+    сообщение стабильного префикса истории помечается точкой кэширования cache_control,
+    чтобы провайдер мог переиспользовать уже обработанную часть диалога.
+
+    Args:
+        model_id: ID модели
+        messages: Список сообщений диалога (последнее - текущий запрос пользователя)
+        prompt_cache: Режим кэширования промпта ("explicit", "implicit" или None)
+        max_tokens: Ограничение длины ответа в токенах (None - без ограничения)
+
+    Returns:
+        dict: Тело запроса
+    """
+    payload_messages = [dict(message) for message in messages]
+
+    if prompt_cache == "explicit" and len(payload_messages) > 1:
+        # Стабильный префикс - вся история без текущего запроса
+        prefix = payload_messages[:-1]
+        prefix_tokens = sum(estimate_tokens(message["content"]) for message in prefix)
+
+        # Короткие префиксы провайдеры не кэшируют, разметка только увеличит стоимость записи
+        if prefix_tokens >= config.PROMPT_CACHE_MIN_TOKENS:
+            breakpoint_message = prefix[-1]
+            breakpoint_message["content"] = [{
+                "type": "text",
+                "text": breakpoint_message["content"],
+                "cache_control": {"type": "ephemeral"}
+            }]
+
+    payload = {
+        "model": model_id,
+        "messages": payload_messages,
+        "stream": True,
+        # Просим OpenRouter вернуть статистику токенов в последнем чанке
+        "usage": {"include": True}
+    }
+    if max_tokens:
+        payload["max_tokens"] = max_tokens
+    return payload
+
+
+def record_prompt_cache_usage(usage, prompt_cache):
+    """
+    Учитывает попадания и промахи кэша промпта по объекту usage из ответа модели.
+
+    Args:
+        usage: Объект usage из ответа OpenRouter
+        prompt_cache: Режим кэширования промпта модели
+
+    Returns:
+        (prompt_tokens, cached_tokens): Количество токенов промпта и из них взятых из кэша
+    """
+    prompt_tokens = usage.get("prompt_tokens")
+    cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+
+    if prompt_cache:
+        with prompt_cache_stats_lock:
+            if cached_tokens > 0:
+                prompt_cache_stats["hits"] += 1
+            else:
+                prompt_cache_stats["misses"] += 1
+            prompt_cache_stats["cached_tokens"] += cached_tokens
+            prompt_cache_stats["prompt_tokens"] += prompt_tokens or 0
+
+        logger.info(
+            f"Кэш промпта: {'попадание' if cached_tokens > 0 else 'промах'}, "
+            f"из кэша {cached_tokens} из {prompt_tokens} токенов "
+            f"(всего попаданий {prompt_cache_stats['hits']}, промахов {prompt_cache_stats['misses']})"
+        )
+
+    return prompt_tokens, cached_tokens
+
+
 def stream_ai_response(model_id, user_message, update_queue, chat_id, message_id, cancel_event, context):
     """
     Функция для потоковой обработки ответа от AI.
@@ -467,13 +1020,6 @@ def stream_ai_response(model_id, user_message, update_queue, chat_id, message_id
     if not messages or messages[-1]["role"] != "user" or messages[-1]["content"] != user_message:
         messages.append({"role": "user", "content": user_message})
 
-    # Формируем payload
-    payload = {
-        "model": model_id,
-        "messages": messages,
-        "stream": True
-    }
-
     # Измеряем время начала запроса
     start_time = time.time()
     # Максимальное время ожидания ответа в секундах (5 минут)
@@ -486,14 +1032,49 @@ def stream_ai_response(model_id, user_message, update_queue, chat_id, message_id
     # Для отслеживания изменений в ответе
     last_response_txt = ""
 
+    # Статистика токенов из последнего чанка ответа и ID генерации OpenRouter
+    usage = None
+    generation_id = None
+
+    # Модель, которая фактически отвечает (при переключении на запасную), и время первого токена
+    served_model_id = model_id
+    request_start = None
+    first_token_time = None
+
+    # Ответ модели, принявшей запрос (None, пока ни одна модель не начала генерацию)
+    response = None
+
+    # Генерация прервана (отмена, тайм-аут, ошибка) без финального обновления: провайдер все равно
+    # тарифицирует уже сгенерированные токены, поэтому расход (фактический, если статистика
+    # успела прийти, иначе оценка) передается в отметку о завершении генерации для учета в бюджете
+    def note_interrupted_usage():
+        if response is None:
+            return
+        context["interrupted_usage"] = {
+            "model_id": served_model_id,
+            "usage": usage or {
+                "prompt_tokens": sum(estimate_tokens(message["content"]) for message in messages),
+                "completion_tokens": estimate_tokens(full_response)
+            }
+        }
+
+    # Обрыв уже начатого ответа считается ошибкой модели, которая его отдавала
+    def record_stream_failure():
+        if response is None:
+            return
+        model_health.record_failure(served_model_id)
+        model_breakers.record_failure(served_model_id)
+
     # Функция для проверки отмены и отправки обновления
     def handle_cancellation():
         if cancel_event.is_set():
             logger.info(f"Генерация для chat_id {chat_id} остановлена пользователем")
+            note_interrupted_usage()
             update_queue.put({
                 "chat_id": chat_id,
                 "message_id": message_id,
                 "text": convert_markdown_to_html(full_response) + "\n\n[Генерация остановлена пользователем]",
+                "raw_text": full_response + "\n\n[Генерация остановлена пользователем]",
                 "is_final": True,
                 "was_canceled": True,
                 "dialog_id": context.get("current_dialog_id", None),
@@ -512,11 +1093,13 @@ def stream_ai_response(model_id, user_message, update_queue, chat_id, message_id
         current_time = time.time()
         if current_time - start_time > max_wait_time:
             logger.warning(f"Превышен тайм-аут ответа модели ({max_wait_time} сек) для chat_id {chat_id}")
+            note_interrupted_usage()
             update_queue.put({
                 "chat_id": chat_id,
                 "message_id": message_id,
                 "text": convert_markdown_to_html(
                     full_response) + "\n\n[Генерация прервана из-за превышения тайм-аута (5 минут)]",
+                "raw_text": full_response + "\n\n[Генерация прервана из-за превышения тайм-аута (5 минут)]",
                 "is_final": True,
                 "was_canceled": True,
                 "dialog_id": context.get("current_dialog_id", None),
@@ -530,44 +1113,98 @@ def stream_ai_response(model_id, user_message, update_queue, chat_id, message_id
             return True
         return False
 
+    # Режим дублирования запросов (только если есть запасные модели)
+    candidates = context.get("failover_models") or [model_id]
+    hedging = context.get("hedging", False) and len(candidates) > 1
+    hedge_fired = False
+    line_iter = None
+
+    # Сессия закрывается после завершения генерации (в том числе при ошибке или отмене)
+    session = requests.Session()
     try:
-        # Проверяем не отменена ли генерация до начала запроса
-        if handle_cancellation():
-            return
+        if hedging:
+            if handle_cancellation():
+                return
 
-        # Устанавливаем тайм-аут для requests
-        session = requests.Session()
-        response = session.post(url, headers=headers, json=payload, stream=True, timeout=30)
+            served_model_id, response, line_iter, request_start, error_msg, hedge_fired = open_hedged_stream(
+                url, headers, messages, candidates[:config.HEDGE_MAX_MODELS], model_id,
+                context.get("prompt_cache"), cancel_event)
+
+            if response is None:
+                if handle_cancellation():
+                    return
+                update_queue.put({
+                    "chat_id": chat_id,
+                    "message_id": message_id,
+                    "text": f"Произошла ошибка при запросе к API: {error_msg}",
+                    "is_final": True,
+                    "error": True,
+                    "dialog_id": context.get("current_dialog_id", None),
+                    "is_reload": context.get("is_reload", False)
+                })
+                return
 
-        # Проверяем статус ответа
-        if not response.ok:
-            error_msg = f"Ошибка API: {response.status_code} - {response.text}"
-            logger.error(error_msg)
-            update_queue.put({
-                "chat_id": chat_id,
-                "message_id": message_id,
-                "text": f"Произошла ошибка при запросе к API: {error_msg}",
-                "is_final": True,
-                "error": True,
-                "dialog_id": context.get("current_dialog_id", None),
-                "is_reload": context.get("is_reload", False)
-            })
-            return
+            if served_model_id != model_id:
+                logger.info(f"Ответ для chat_id {chat_id} генерирует модель {served_model_id}")
 
-        # Для просмотра ответа строка за строкой
-        line_iter = response.iter_lines()
+            # Модели уже опрошены параллельно - последовательный перебор не нужен
+            candidates = []
 
-        # Проверяем отмену каждые 0.1 сек
-        while not handle_cancellation() and not check_timeout():
-            try:
-                # Используем poll с таймаутом для более частой проверки отмены
-                line_available = False
-                line = None
+        # Обращаемся к моделям по очереди, пока одна из них не примет запрос
+        for index, candidate in enumerate(candidates):
+            is_last = index == len(candidates) - 1
 
-                # Попытка получить следующую строку с таймаутом
-                try:
-                    line = next(line_iter)
-                    line_available = True
+            # Проверяем не отменена ли генерация до начала запроса
+            if handle_cancellation():
+                return
+
+            # Разметка кэширования промпта рассчитана на выбранную модель
+            payload = build_chat_payload(
+                candidate, messages, context.get("prompt_cache") if candidate == model_id else None,
+                context.get("max_tokens"))
+
+            response, error_msg, request_start = open_model_stream(
+                session, url, headers, payload, candidate, cancel_event)
+
+            # Проверяем статус ответа
+            if response is not None:
+                served_model_id = candidate
+                if candidate != model_id:
+                    logger.info(f"Ответ для chat_id {chat_id} генерирует запасная модель {candidate}")
+                break
+
+            if handle_cancellation():
+                return
+
+            if not is_last:
+                logger.warning(f"Модель {candidate} недоступна, переключаемся на {candidates[index + 1]}")
+            else:
+                update_queue.put({
+                    "chat_id": chat_id,
+                    "message_id": message_id,
+                    "text": f"Произошла ошибка при запросе к API: {error_msg}",
+                    "is_final": True,
+                    "error": True,
+                    "dialog_id": context.get("current_dialog_id", None),
+                    "is_reload": context.get("is_reload", False)
+                })
+                return
+
+        # Для просмотра ответа строка за строкой
+        if line_iter is None:
+            line_iter = response.iter_lines()
+
+        # Проверяем отмену каждые 0.1 сек
+        while not handle_cancellation() and not check_timeout():
+            try:
+                # Используем poll с таймаутом для более частой проверки отмены
+                line_available = False
+                line = None
+
+                # Попытка получить следующую строку с таймаутом
+                try:
+                    line = next(line_iter)
+                    line_available = True
                 except StopIteration:
                     # Конец итератора (конец ответа)
                     break
@@ -589,6 +1226,12 @@ def stream_ai_response(model_id, user_message, update_queue, chat_id, message_id
                         try:
                             data_obj = json.loads(data)
 
+                            # Статистика токенов приходит в последнем чанке
+                            if data_obj.get("usage"):
+                                usage = data_obj["usage"]
+                            if data_obj.get("id"):
+                                generation_id = data_obj["id"]
+
                             # Проверяем, есть ли выбор в ответе
                             if "choices" in data_obj and len(data_obj["choices"]) > 0:
                                 choice = data_obj["choices"][0]
@@ -601,6 +1244,9 @@ def stream_ai_response(model_id, user_message, update_queue, chat_id, message_id
                                     full_response += content_chunk
                                     content_updated = True
 
+                                    if first_token_time is None and content_chunk:
+                                        first_token_time = time.time()
+
                                 # Обновляем сообщение только если был новый контент
                                 if content_updated:
                                     # Обновляем сообщение с заданным интервалом
@@ -614,7 +1260,9 @@ def stream_ai_response(model_id, user_message, update_queue, chat_id, message_id
                                                 "chat_id": chat_id,
                                                 "message_id": message_id,
                                                 "text": current_response,
-                                                "is_final": False
+                                                "is_final": False,
+                                                "dialog_id": context.get("current_dialog_id", None),
+                                                "is_reload": context.get("is_reload", False)
                                             })
                                             last_response_txt = current_response
                                             last_update_time = current_time
@@ -638,6 +1286,8 @@ def stream_ai_response(model_id, user_message, update_queue, chat_id, message_id
 
     except requests.exceptions.Timeout:
         logger.error(f"Timeout при запросе к API для chat_id {chat_id}")
+        note_interrupted_usage()
+        record_stream_failure()
         update_queue.put({
             "chat_id": chat_id,
             "message_id": message_id,
@@ -650,6 +1300,8 @@ def stream_ai_response(model_id, user_message, update_queue, chat_id, message_id
         return
     except Exception as e:
         logger.error(f"Ошибка при потоковом получении ответа для chat_id {chat_id}: {e}")
+        note_interrupted_usage()
+        record_stream_failure()
         update_queue.put({
             "chat_id": chat_id,
             "message_id": message_id,
@@ -660,6 +1312,23 @@ def stream_ai_response(model_id, user_message, update_queue, chat_id, message_id
             "is_reload": context.get("is_reload", False)
         })
         return
+    finally:
+        session.close()
+
+    # Обновляем статистику модели: время до первого токена и скорость генерации
+    if first_token_time is None:
+        model_health.record_failure(served_model_id)
+        model_breakers.record_failure(served_model_id)
+    else:
+        model_breakers.record_success(served_model_id)
+        record_ttft(hedging, first_token_time - start_time, hedge_fired, hedge_fired and served_model_id != model_id)
+        completion_tokens = (usage or {}).get("completion_tokens") or estimate_tokens(full_response)
+        generation_time = time.time() - first_token_time
+        model_health.record_success(
+            served_model_id,
+            first_token_time - request_start,
+            completion_tokens / generation_time if generation_time > 0 else None
+        )
 
     # Преобразуем финальный текст ответа для корректного отображения
     formatted_response = convert_markdown_to_html(full_response)
@@ -668,21 +1337,84 @@ def stream_ai_response(model_id, user_message, update_queue, chat_id, message_id
     if handle_cancellation() or check_timeout():
         return
 
-    # Отправляем финальное обновление
-    if formatted_response != last_response_txt:
-        update_queue.put({
-            "chat_id": chat_id,
-            "message_id": message_id,
-            "text": formatted_response,
-            "is_final": True,
-            "dialog_id": context.get("current_dialog_id", None),  # Передаем ID диалога
-            "is_reload": context.get("is_reload", False),
-            "user_id": context.get("user_id"),
-            "model_name": context.get("model_name"),
-            "model_id": context.get("model_id"),
-            "user_ask": context.get("user_ask"),
-            "dialog_number": context.get("dialog_number")
-        })
+    # Отправляем финальное обновление всегда, даже если текст совпадает с последним промежуточным:
+    # по нему ответ сохраняется в БД, учитывается расход и снимается регистрация генерации
+    update_queue.put({
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "text": formatted_response,
+        "raw_text": full_response,
+        "is_final": True,
+        "dialog_id": context.get("current_dialog_id", None),  # Передаем ID диалога
+        "is_reload": context.get("is_reload", False),
+        "user_id": context.get("user_id"),
+        "model_name": context.get("model_name"),
+        "model_id": context.get("model_id"),
+        "user_ask": context.get("user_ask"),
+        "dialog_number": context.get("dialog_number"),
+        "usage": usage,
+        "prompt_cache": context.get("prompt_cache"),
+        "rate_limit": context.get("rate_limit"),
+        "served_model_id": served_model_id,
+        "generation_id": generation_id
+    })
+
+
+def build_answer_document(raw_text, html_text, message_id):
+    """
+    Формирует файл с полным ответом в памяти (формат задается LONG_ANSWER_DOCUMENT_FORMAT).
+
+    Returns:
+        tuple: (файловый объект, имя файла)
+    """
+    if config.LONG_ANSWER_DOCUMENT_FORMAT == "html":
+        content = (
+            "<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>Ответ</title></head>\n"
+            "<body style=\"white-space: pre-wrap; font-family: sans-serif\">\n"
+            f"{html_text}\n</body></html>\n"
+        )
+        filename = f"answer_{message_id}.html"
+    else:
+        content = raw_text
+        filename = f"answer_{message_id}.md"
+
+    return io.BytesIO(content.encode("utf-8")), filename
+
+
+async def send_answer_document(context, chat_id, message_id, raw_text, html_text, reply_markup):
+    """
+    Отправляет очень длинный ответ одним файлом вместо множества сообщений по 4096 символов:
+    промежуточное сообщение заменяется коротким превью, файл отправляется ответом на него.
+    Количество запросов к Bot API не зависит от длины ответа.
+    """
+    preview = raw_text[:config.LONG_ANSWER_PREVIEW_LENGTH].rstrip()
+    preview_text = (
+        f"{preview}...\n\n"
+        f"📄 Ответ слишком длинный ({len(raw_text)} символов), полный текст - в файле ниже."
+    )
+
+    # Превью отправляется без разметки: обрезанный текст может содержать незакрытые теги
+    try:
+        await context.bot.edit_message_text(
+            text=preview_text,
+            chat_id=chat_id,
+            message_id=message_id,
+            reply_markup=reply_markup
+        )
+    except Exception as e:
+        if "Message is not modified" not in str(e):
+            logger.error(f"Ошибка при обновлении сообщения с превью ответа: {e}")
+
+    document, filename = build_answer_document(raw_text, html_text, message_id)
+    try:
+        await context.bot.send_document(
+            chat_id=chat_id,
+            document=document,
+            filename=filename,
+            reply_to_message_id=message_id
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при отправке ответа файлом: {e}")
 
 
 async def message_updater(context):
@@ -690,6 +1422,9 @@ async def message_updater(context):
     # Для хранения последнего содержимого каждого сообщения
     last_message_content = {}
 
+    # Время последней контрольной точки частичного ответа для каждой записи диалога
+    last_checkpoint_time = {}
+
     while True:
         try:
             # Проверяем, есть ли элементы в очереди
@@ -697,6 +1432,28 @@ async def message_updater(context):
                 # Получаем данные из синхронной очереди
                 update_data = context.bot_data["update_queue"].get_nowait()
 
+                # Отметка о завершении генерации: все ее обновления уже обработаны
+                if "generation_done" in update_data:
+                    # Прерванная генерация не передала расход с финальным обновлением - учитываем его
+                    if update_data.get("interrupted_usage"):
+                        record_interrupted_usage(context.bot_data, update_data)
+
+                    # Фактическая стоимость уже учтена - снимаем резерв бюджета
+                    if update_data.get("budget_reservation"):
+                        context.bot_data["spend_budgets"].release(update_data["budget_reservation"])
+
+                    context.bot_data["live_dialog_ids"].discard(update_data.get("dialog_id"))
+
+                    # Счетчик завершенных (не отмененных) генераций для отчета об остановке бота
+                    if not update_data.get("canceled"):
+                        context.bot_data["completed_generations"] = context.bot_data.get("completed_generations", 0) + 1
+
+                    generation_done = update_data["generation_done"]
+                    if not generation_done.done():
+                        generation_done.set_result(True)
+                    context.bot_data["update_queue"].task_done()
+                    continue
+
                 chat_id = update_data["chat_id"]
                 message_id = update_data["message_id"]
                 text = update_data["text"]
@@ -722,11 +1479,22 @@ async def message_updater(context):
                         context.bot_data["update_queue"].task_done()
                         continue
 
+                # Совпадает ли финальный текст с уже показанным промежуточным
+                text_unchanged = is_final and msg_identifier in last_message_content and \
+                    last_message_content[msg_identifier]["text"] == text
+
                 # Сохраняем новое содержимое
                 last_message_content[msg_identifier] = current_content
 
                 # Создаем разные клавиатуры в зависимости от статуса
                 if is_final:
+                    # Генерация завершена - снимаем ее регистрацию, чтобы отмена больше не применялась
+                    context.bot_data["state"].finish_stream(chat_id)
+                    last_checkpoint_time.pop(dialog_id, None)
+
+                    # Списываем из лимитов фактически израсходованные токены
+                    charge_rate_limit_tokens(context.bot_data, update_data.get("usage"), update_data.get("rate_limit"))
+
                     # Для завершенных сообщений добавляем кнопку перезагрузки
                     reply_markup = InlineKeyboardMarkup([[
                         InlineKeyboardButton("🔄 Перезагрузить ответ",
@@ -766,6 +1534,12 @@ async def message_updater(context):
                                 )
                                 logger.info(f"Создана новая запись для перезагруженного ответа: {new_dialog_id}")
 
+                                if new_dialog_id and update_data.get("usage"):
+                                    record_usage(context.bot_data, new_dialog_id, update_data)
+
+                                if new_dialog_id and update_data.get("served_model_id"):
+                                    db.update_served_model(new_dialog_id, update_data["served_model_id"])
+
                                 # Обновляем текущий диалог_id в контексте пользователя
                                 if user_id and hasattr(context, 'dispatcher') and context.dispatcher:
                                     user_data = context.dispatcher.user_data.get(int(user_id), {})
@@ -778,14 +1552,47 @@ async def message_updater(context):
                         else:
                             # Если это обычный ответ, обновляем существующую запись
                             db.update_model_answer(dialog_id, text, displayed=1)
+
+                            if update_data.get("usage"):
+                                record_usage(context.bot_data, dialog_id, update_data)
+
+                            if update_data.get("served_model_id"):
+                                db.update_served_model(dialog_id, update_data["served_model_id"])
                 else:
                     # Для незавершенных сообщений добавляем кнопку отмены
                     reply_markup = InlineKeyboardMarkup([[
                         InlineKeyboardButton("❌ Остановить генерацию", callback_data="cancel_stream")
                     ]])
 
+                    # Периодически сохраняем частичный ответ, чтобы не потерять его при падении бота.
+                    # При перезагрузке ответа запись создается только в конце, сохранять некуда.
+                    if dialog_id and not update_data.get("is_reload", False) and "db" in context.bot_data:
+                        now = time.monotonic()
+                        if now - last_checkpoint_time.get(dialog_id, 0) >= config.ANSWER_CHECKPOINT_INTERVAL:
+                            context.bot_data["db"].checkpoint_model_answer(dialog_id, text)
+                            last_checkpoint_time[dialog_id] = now
+
+                raw_text = update_data.get("raw_text") or text
+
+                # Текст уже показан полностью - меняем только кнопку отмены на кнопку перезагрузки
+                if text_unchanged and len(text) <= 4096:
+                    try:
+                        await context.bot.edit_message_reply_markup(
+                            chat_id=chat_id,
+                            message_id=message_id,
+                            reply_markup=reply_markup
+                        )
+                    except Exception as e:
+                        if "Message is not modified" not in str(e):
+                            logger.error(f"Ошибка при обновлении кнопок сообщения: {e}")
+
+                # Очень длинный финальный ответ отправляем одним файлом
+                elif is_final and config.LONG_ANSWER_DOCUMENT_THRESHOLD and \
+                        len(raw_text) > config.LONG_ANSWER_DOCUMENT_THRESHOLD:
+                    await send_answer_document(context, chat_id, message_id, raw_text, text, reply_markup)
+
                 # Если текст слишком длинный для одного сообщения Telegram
-                if len(text) > 4096:
+                elif len(text) > 4096:
                     # Если это финальное сообщение, разбиваем на части
                     if is_final:
                         chunks = [text[i:i + 4096] for i in range(0, len(text), 4096)]
@@ -821,10 +1628,6 @@ async def message_updater(context):
                                         logger.error(f"Ошибка при отправке сообщения: {e}")
                                         continue
 
-                                # Сохраняем ID последнего сообщения для потенциальной перезагрузки
-                                if str(chat_id) in context.bot_data.get("active_streams", {}):
-                                    del context.bot_data["active_streams"][str(chat_id)]
-
                                 # Сохраняем информацию о последнем сообщении для перезагрузки
                                 if hasattr(context, 'user_data_dict') and int(chat_id) in context.user_data_dict:
                                     user_data = context.user_data_dict[int(chat_id)]
@@ -892,10 +1695,6 @@ async def message_updater(context):
 
                         # Если это финальное сообщение
                         if is_final:
-                            # Удаляем из активных потоков
-                            if str(chat_id) in context.bot_data.get("active_streams", {}):
-                                del context.bot_data["active_streams"][str(chat_id)]
-
                             # Обновляем идентификатор последнего сообщения для перезагрузки
                             try:
                                 # Получаем user_id из update_data если есть
@@ -923,10 +1722,6 @@ async def message_updater(context):
                                     message_id=message_id,
                                     reply_markup=reply_markup
                                 )
-
-                                # Если это финальное сообщение, удаляем из активных потоков
-                                if is_final and str(chat_id) in context.bot_data.get("active_streams", {}):
-                                    del context.bot_data["active_streams"][str(chat_id)]
                             except Exception as inner_e:
                                 logger.error(f"Не удалось отправить даже очищенный текст: {inner_e}")
                         elif "Message is not modified" in str(e):
@@ -949,13 +1744,22 @@ async def message_updater(context):
 
 
 async def process_ai_request(context, chat_id, user_message, is_reload=False):
-    """Обработка запроса к AI модели и отправка ответа."""
+    """
+    Обработка запроса к AI модели и отправка ответа.
+
+    Returns:
+        asyncio.Future: Завершается, когда ответ отправлен и сохранен в БД (None, если генерация не запущена)
+    """
+    # Запрос мог ждать в очереди чата, пока начиналась остановка бота
+    if await reject_if_shutting_down(context, chat_id):
+        return None
+
     if "selected_model" not in context.user_data:
         await context.bot.send_message(
             chat_id=chat_id,
             text="Пожалуйста, сначала выберите модель с помощью команды /select_model"
         )
-        return
+        return None
 
     model_id = context.user_data["selected_model"]
     user_id = None
@@ -970,13 +1774,20 @@ async def process_ai_request(context, chat_id, user_message, is_reload=False):
         # Используем chat_id как user_id, если не можем найти
         user_id = chat_id
 
+    # Отправитель запроса (в групповом чате user_id выше может оказаться ID чата): по нему
+    # учитываются бюджет, лимиты и справедливая очередь генераций
+    sender_id = getattr(context, "user_id", None) or user_id
+
     # Получаем номер текущего диалога
     dialog_number = context.user_data.get("current_dialog", 1)
 
     # Подготавливаем контекст диалога
     db = context.bot_data.get("db")
     if db:
-        messages, context_usage_percent = prepare_context(db, user_id, dialog_number, model_id, user_message)
+        messages, context_usage_percent = prepare_context(
+            db, user_id, dialog_number, model_id, user_message,
+            context_mode=context.user_data.get("context_mode", config.CONTEXT_MODE)
+        )
 
         # Округляем процент до целого числа
         context_usage_percent = round(context_usage_percent)
@@ -992,72 +1803,556 @@ async def process_ai_request(context, chat_id, user_message, is_reload=False):
         messages = [{"role": "user", "content": user_message}]
         context_usage_percent = 0
 
-    # Отправляем индикатор набора текста
-    await context.bot.send_chat_action(chat_id=chat_id, action="typing")
+    # Бюджет расходов на платную модель проверяется до обращения к API
+    model_id, max_tokens, budget_reservation, budget_notice = check_spend_budget(
+        context.bot_data, sender_id, model_id, messages)
+
+    # Резерв бюджета переходит к генерации, когда она запускается (start_generation); до этого
+    # при любой ошибке (например, Telegram не принял сообщение) его нужно снять здесь
+    reservation_handed_over = False
+    live_dialog_id = None
+    try:
+        if budget_notice:
+            await context.bot.send_message(chat_id=chat_id, text=budget_notice)
+        if model_id is None:
+            return None
+
+        # Отправляем индикатор набора текста
+        await context.bot.send_chat_action(chat_id=chat_id, action="typing")
+
+        # Начальное сообщение с кнопкой отмены
+        cancel_keyboard = InlineKeyboardMarkup([[
+            InlineKeyboardButton("❌ Остановить генерацию", callback_data="cancel_stream")
+        ]])
+
+        initial_message = await context.bot.send_message(
+            chat_id=chat_id,
+            text="Генерирую ответ...",
+            reply_markup=cancel_keyboard
+        )
+
+        # Сохраняем информацию о последнем сообщении для перезагрузки
+        context.user_data["last_message"] = {
+            "id": f"{chat_id}_{initial_message.message_id}",
+            "text": user_message
+        }
+
+        # Инициализируем очередь обновлений, если её еще нет
+        if "update_queue" not in context.bot_data:
+            # Используем стандартную синхронную очередь
+            context.bot_data["update_queue"] = queue.Queue()
+            # Запускаем фоновую задачу для обновления сообщений
+            context.bot_data["message_updater_task"] = asyncio.create_task(message_updater(context))
+
+        # Регистрируем генерацию и получаем событие для отмены потока
+        cancel_event = context.bot_data["state"].register_stream(chat_id)
+
+        # Передаем идентификатор текущего диалога в контекст для потоковой функции
+        thread_context = {
+            "user_id": sender_id,  # Для учета расхода и бюджета
+            "is_reload": is_reload,  # Флаг перезагрузки
+            "messages": messages,  # Контекст диалога
+            "context_usage_percent": context_usage_percent  # Процент заполнения контекста
+        }
+
+        if "current_dialog_id" in context.user_data:
+            thread_context["current_dialog_id"] = context.user_data["current_dialog_id"]
+
+        # Режим кэширования промпта определяется по каталогу моделей в памяти,
+        # запасные модели - по статистике их работы
+        model = model_catalog.get(model_id)
+        thread_context["prompt_cache"] = model.prompt_cache if model else None
+        if db:
+            thread_context["failover_models"] = get_failover_models(
+                model_id, sum(estimate_tokens(message["content"]) for message in messages))
+
+        # Ограничение длины ответа платной модели и резерв бюджета (снимается после генерации)
+        thread_context["max_tokens"] = max_tokens
+        thread_context["budget_reservation"] = budget_reservation
+
+        # Дублирование запроса на запасную модель, если выбранная долго не отвечает
+        thread_context["hedging"] = context.user_data.get("hedging", config.HEDGE_REQUESTS)
+
+        # Для списания фактически израсходованных токенов из лимитов (оценка запроса уже списана при приеме)
+        thread_context["rate_limit"] = {
+            "user_id": sender_id,
+            "chat_id": chat_id,
+            "prepaid_tokens": 0 if is_reload else estimate_tokens(user_message)
+        }
+
+        # Добавляем дополнительную информацию для перезагрузки
+        if is_reload and "current_dialog_info" in context.user_data:
+            thread_context.update(context.user_data["current_dialog_info"])
+
+        scheduler = context.bot_data["scheduler"]
+        loop = asyncio.get_running_loop()
+        generation_done = loop.create_future()
+
+        def start_generation(ticket):
+            nonlocal reservation_handed_over
+            reservation_handed_over = True
+
+            # Если пользователь видел сообщение об очереди, заменяем его
+            if ticket.reported_position:
+                asyncio.create_task(edit_queued_message(
+                    context.bot, chat_id, initial_message.message_id, "Генерирую ответ..."))
+
+            # Поток не блокирует завершение процесса, а остановка бота дожидается его через stream_threads
+            stream_thread = threading.Thread(
+                target=run_scheduled_stream,
+                args=(loop, scheduler, ticket, generation_done, model_id, user_message, context.bot_data["update_queue"],
+                      chat_id, initial_message.message_id, cancel_event, thread_context),
+                daemon=True
+            )
+            stream_threads = context.bot_data.setdefault("stream_threads", set())
+            stream_threads.difference_update([thread for thread in stream_threads if not thread.is_alive()])
+            stream_threads.add(stream_thread)
+            try:
+                stream_thread.start()
+            except Exception:
+                generation_done.set_result(False)
+                if budget_reservation:
+                    context.bot_data["spend_budgets"].release(budget_reservation)
+                raise
+
+        # Запись диалога не считается прерванной, пока генерация выполняется или ждет в очереди
+        live_dialog_id = thread_context.get("current_dialog_id")
+        if live_dialog_id:
+            context.bot_data["live_dialog_ids"].add(live_dialog_id)
+
+        # Генерация запускается планировщиком, когда для нее освободится слот
+        ticket = GenerationTicket(
+            user_id=sender_id,
+            lane=get_user_role(context.bot_data, sender_id),
+            start=start_generation,
+            cancel_event=cancel_event,
+            chat_id=chat_id,
+            message_id=initial_message.message_id
+        )
+        position = scheduler.submit(ticket)
+    except Exception:
+        if not reservation_handed_over:
+            if budget_reservation:
+                context.bot_data["spend_budgets"].release(budget_reservation)
+            context.bot_data["live_dialog_ids"].discard(live_dialog_id)
+        raise
+
+    if position:
+        ticket.reported_position = position
+        await edit_queued_message(context.bot, chat_id, initial_message.message_id, queue_position_text(position))
+
+    return generation_done
+
+
+def run_scheduled_stream(loop, scheduler, ticket, generation_done, model_id, user_message, update_queue,
+                         chat_id, message_id, cancel_event, context):
+    """
+    Выполняет генерацию в потоке и освобождает слот планировщика после ее завершения.
+
+    После всех обновлений генерации в очередь помещается отметка о завершении: message_updater
+    завершает generation_done, когда ответ уже отправлен и сохранен в БД.
+    """
+    try:
+        stream_ai_response(model_id, user_message, update_queue, chat_id, message_id, cancel_event, context)
+    finally:
+        update_queue.put({
+            "chat_id": chat_id,
+            "generation_done": generation_done,
+            "budget_reservation": context.get("budget_reservation"),
+            "user_id": context.get("user_id"),
+            "interrupted_usage": context.get("interrupted_usage"),
+            "dialog_id": context.get("current_dialog_id"),
+            "canceled": cancel_event.is_set()
+        })
+        try:
+            loop.call_soon_threadsafe(scheduler.release, ticket)
+        except RuntimeError:
+            # Цикл событий уже закрыт - бот остановлен
+            pass
+
+
+def format_price(price):
+    """Форматирует цену за токен из каталога для отображения (в долларах за миллион токенов)."""
+    if price is None:
+        return "определяется при запросе"
+    return f"${(price * 1000000).normalize():f} за 1M токенов"
+
+
+def get_user_role(bot_data, user_id):
+    """
+    Определяет роль пользователя для лимитов и приоритета генераций: "admin", "premium" или "default".
+    Премиум-статус берется из кэша в памяти (bot_data["premium_users"]), без обращения к БД.
+    """
+    if str(user_id) in config.ADMIN_IDS:
+        return "admin"
+    if user_id in bot_data.get("premium_users", ()):
+        return "premium"
+    return "default"
+
+
+def record_usage(bot_data, dialog_id, update_data):
+    """
+    Сохраняет расход завершенной генерации: токены, стоимость и ID генерации - в запись диалога,
+    а также прибавляет его к суммарной статистике по пользователю, модели и дню.
+    """
+    usage = update_data["usage"]
+    prompt_tokens, cached_tokens = record_prompt_cache_usage(usage, update_data.get("prompt_cache"))
+    completion_tokens = usage.get("completion_tokens")
+
+    # Стоимость считается по модели, которая фактически сгенерировала ответ
+    model_id = update_data.get("served_model_id") or update_data.get("model_id")
+    cost = compute_cost(model_catalog.get(model_id), usage)
+
+    bot_data["db"].update_dialog_usage(
+        dialog_id, prompt_tokens, cached_tokens, completion_tokens, cost, update_data.get("generation_id"))
+
+    if update_data.get("user_id") and model_id:
+        bot_data["usage_rollup"].record(
+            update_data["user_id"], model_id, prompt_tokens, completion_tokens, cached_tokens, cost)
+        bot_data["spend_budgets"].record(update_data["user_id"], cost)
+
+
+def record_interrupted_usage(bot_data, update_data):
+    """
+    Учитывает в суммарной статистике и бюджете расход прерванной генерации (отмена, тайм-аут, ошибка).
+    Стоимость считается по ценам модели из каталога, если провайдер не сообщил ее сам.
+    """
+    user_id = update_data.get("user_id")
+    model_id = update_data["interrupted_usage"]["model_id"]
+    usage = update_data["interrupted_usage"]["usage"]
+    if not user_id or not model_id:
+        return
+
+    cost = compute_cost(model_catalog.get(model_id), usage)
+    cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+    bot_data["usage_rollup"].record(
+        user_id, model_id, usage.get("prompt_tokens"), usage.get("completion_tokens"), cached_tokens, cost)
+    bot_data["spend_budgets"].record(user_id, cost)
+
+
+def get_budget_fallback_model():
+    """Выбирает бесплатную модель на замену платной по каталогу в памяти и статистике model_health."""
+    free_models = sorted(model.id for model in model_catalog.models(only_free=True))
+    healthy_models = model_health.rank([
+        model_id for model_id in free_models if not model_breakers.retry_after(model_id)
+    ])
+    if healthy_models:
+        return healthy_models[0]
+    return free_models[0] if free_models else None
+
+
+def check_spend_budget(bot_data, user_id, model_id, messages):
+    """
+    Проверяет бюджет расходов перед запросом к платной модели и резервирует максимальную стоимость
+    запроса: токены подготовленного контекста по цене промпта и MAX_COMPLETION_TOKENS по цене ответа.
+
+    Если максимальная стоимость не укладывается в остаток бюджета, ответ ограничивается остатком
+    (не короче BUDGET_MIN_COMPLETION_TOKENS), иначе запрос передается бесплатной модели
+    (BUDGET_DOWNGRADE_TO_FREE) или отклоняется. Используются только данные в памяти.
+
+    Returns:
+        (model_id, max_tokens, reservation, notice): модель для запроса, ограничение длины ответа,
+            резерв бюджета и сообщение для пользователя; model_id = None - запрос отклонен
+    """
+    model = model_catalog.get(model_id)
+    if model is None or model.is_free:
+        return model_id, None, None, None
+
+    max_tokens = config.MAX_COMPLETION_TOKENS
+    if model.prompt_price is None or model.completion_price is None:
+        # Цена определяется провайдером при запросе - учитываем только фактическую стоимость
+        logger.warning(f"Цена модели {model_id} неизвестна, бюджет не резервируется")
+        return model_id, max_tokens, None, None
+
+    budgets = bot_data["spend_budgets"]
+    prompt_cost = float(sum(estimate_tokens(message["content"]) for message in messages) * model.prompt_price)
+    completion_price = float(model.completion_price)
+
+    reservation = budgets.reserve(user_id, prompt_cost + max_tokens * completion_price)
+    if reservation is not None:
+        return model_id, max_tokens, reservation, None
+
+    # Сокращаем ответ до остатка бюджета
+    remaining = budgets.remaining(user_id) - prompt_cost
+    if completion_price > 0:
+        affordable_tokens = min(max_tokens, int(remaining / completion_price))
+    else:
+        affordable_tokens = max_tokens if remaining >= 0 else 0
+
+    if affordable_tokens >= config.BUDGET_MIN_COMPLETION_TOKENS:
+        reservation = budgets.reserve(user_id, prompt_cost + affordable_tokens * completion_price)
+        if reservation is not None:
+            return model_id, affordable_tokens, reservation, (
+                f"⚠️ Бюджет на платные модели почти исчерпан: ответ будет ограничен {affordable_tokens} токенами."
+            )
+
+    if config.BUDGET_DOWNGRADE_TO_FREE:
+        free_model_id = get_budget_fallback_model()
+        if free_model_id:
+            logger.info(f"Бюджет пользователя {user_id} исчерпан, запрос к {model_id} передан модели {free_model_id}")
+            return free_model_id, None, None, (
+                f"⚠️ Бюджет на платные модели исчерпан, ответ сгенерирует бесплатная модель {free_model_id}."
+            )
+
+    logger.info(f"Бюджет пользователя {user_id} исчерпан, запрос к {model_id} отклонен")
+    return None, None, None, "⚠️ Бюджет на платные модели исчерпан. Выберите бесплатную модель командой /select_model."
+
 
-    # Начальное сообщение с кнопкой отмены
-    cancel_keyboard = InlineKeyboardMarkup([[
-        InlineKeyboardButton("❌ Остановить генерацию", callback_data="cancel_stream")
-    ]])
+def charge_rate_limit_tokens(bot_data, usage, rate_limit):
+    """Списывает из лимитов пользователя токены завершенной генерации сверх списанной при приеме оценки."""
+    if not usage or not rate_limit or "rate_limiter" not in bot_data:
+        return
+
+    total_tokens = usage.get("total_tokens") or (usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0))
+    user_id = rate_limit["user_id"]
+    bot_data["rate_limiter"].charge(
+        user_id, rate_limit["chat_id"], get_user_role(bot_data, user_id), "tokens",
+        total_tokens - rate_limit["prepaid_tokens"]
+    )
+
+
+def refresh_premium_users(bot_data):
+    """Обновляет кэш премиум-пользователей из БД."""
+    bot_data["premium_users"] = bot_data["db"].get_premium_user_ids()
+
+
+async def reject_if_rate_limited(context, chat_id, user_id, amounts):
+    """
+    Проверяет лимиты частоты запросов пользователя и чата. Проверка выполняется в памяти
+    и при отказе не обращается ни к БД, ни к API.
+
+    Args:
+        context: Контекст телеграм-бота
+        chat_id: ID чата
+        user_id: ID пользователя
+        amounts: Списываемое количество по видам ограничений, например {"message": 1, "tokens": 500}
+
+    Returns:
+        bool: True, если запрос отклонен
+    """
+    retry_after = context.bot_data["rate_limiter"].check(
+        user_id, chat_id, get_user_role(context.bot_data, user_id), amounts)
+    if not retry_after:
+        return False
 
-    initial_message = await context.bot.send_message(
+    await context.bot.send_message(
         chat_id=chat_id,
-        text="Генерирую ответ...",
-        reply_markup=cancel_keyboard
+        text=f"⏳ Слишком много запросов. Попробуйте снова через {format_retry_after(retry_after)}."
     )
+    return True
 
-    # Сохраняем информацию о последнем сообщении для перезагрузки
-    context.user_data["last_message"] = {
-        "id": f"{chat_id}_{initial_message.message_id}",
-        "text": user_message
-    }
 
-    # Инициализируем очередь обновлений, если её еще нет
-    if "update_queue" not in context.bot_data:
-        # Используем стандартную синхронную очередь
-        context.bot_data["update_queue"] = queue.Queue()
-        # Запускаем фоновую задачу для обновления сообщений
-        asyncio.create_task(message_updater(context))
-
-    # Инициализируем словарь активных потоков, если его еще нет
-    if "active_streams" not in context.bot_data:
-        context.bot_data["active_streams"] = {}
-
-    # Создаем событие для отмены потока
-    cancel_event = threading.Event()
-    context.bot_data["active_streams"][str(chat_id)] = cancel_event
-
-    # Передаем идентификатор текущего диалога в контекст для потоковой функции
-    thread_context = {
-        "is_reload": is_reload,  # Флаг перезагрузки
-        "messages": messages,  # Контекст диалога
-        "context_usage_percent": context_usage_percent  # Процент заполнения контекста
-    }
+def format_retry_after(seconds):
+    """Форматирует время до снятия ограничения."""
+    seconds = int(seconds) + 1
+    if seconds < 60:
+        return f"{seconds} сек."
+    if seconds < 3600:
+        return f"{seconds // 60 + (1 if seconds % 60 else 0)} мин."
+    return f"{seconds // 3600} ч. {seconds % 3600 // 60} мин."
+
+
+def queue_position_text(position):
+    """Текст сообщения о позиции запроса в очереди генераций."""
+    return f"⏳ Запрос в очереди, позиция: {position}. Ответ начнет генерироваться, когда освободится место."
+
+
+async def edit_queued_message(bot, chat_id, message_id, text):
+    """Обновляет сообщение о состоянии запроса в очереди, сохраняя кнопку отмены."""
+    try:
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=message_id,
+            text=text,
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("❌ Остановить генерацию", callback_data="cancel_stream")
+            ]])
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении сообщения об очереди: {e}")
+
+
+async def queue_status_updater(application):
+    """
+    Фоновая задача: запускает отмененные заявки из очереди генераций и обновляет
+    сообщения с позицией в очереди, если позиция изменилась.
+    """
+    scheduler = application.bot_data["scheduler"]
+
+    while True:
+        await asyncio.sleep(config.GENERATION_QUEUE_UPDATE_INTERVAL)
+        try:
+            # Отмена могла быть запрошена через другой процесс бота
+            scheduler.start_canceled()
+
+            # Ограничиваем количество правок за один проход, чтобы не упереться в лимиты Telegram;
+            # первыми обновляются заявки, ближайшие к запуску
+            edits = 0
+            for ticket, position in scheduler.positions():
+                if edits >= config.GENERATION_QUEUE_EDITS_PER_UPDATE:
+                    break
+                if ticket.reported_position == position:
+                    continue
+
+                ticket.reported_position = position
+                await edit_queued_message(application.bot, ticket.chat_id, ticket.message_id,
+                                          queue_position_text(position))
+                edits += 1
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении очереди генераций: {e}")
+
+
+async def reject_if_shutting_down(context, chat_id):
+    """
+    Проверяет, не останавливается ли бот. Во время остановки новые запросы к моделям не принимаются.
+
+    Returns:
+        bool: True, если запрос отклонен
+    """
+    if context.bot_data.get("accepting_prompts", True):
+        return False
+
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text="⚠️ Бот перезапускается. Пожалуйста, повторите запрос через минуту."
+    )
+    return True
+
+
+class ChatPromptLane:
+    """
+    Очередь запросов одного чата. Генерации в чате выполняются строго по одной, а сообщения
+    пользователя, пришедшие подряд в пределах PROMPT_DEBOUNCE_SECONDS (например, длинный текст,
+    разбитый Telegram на части), объединяются в один запрос.
+    """
+
+    def __init__(self):
+        # Элементы: (user_id, текст, обработчик, можно ли объединять с соседними сообщениями)
+        self.pending = []
+        self.last_message_time = 0.0
+        self.task = None
+
+
+def enqueue_chat_prompt(context, chat_id, user_id, text, handler, mergeable=True):
+    """
+    Ставит запрос в очередь чата и запускает ее обработку, если она еще не запущена.
+
+    Args:
+        context: Контекст телеграм-бота
+        chat_id: ID чата
+        user_id: ID пользователя (объединяются только сообщения одного пользователя)
+        text: Текст запроса
+        handler: Корутинная функция, принимающая текст запроса и возвращающая asyncio.Future
+            завершения генерации (или None)
+        mergeable: Можно ли объединять запрос с соседними сообщениями
+    """
+    lanes = context.bot_data.setdefault("chat_lanes", {})
+    lane = lanes.get(chat_id)
+    if lane is None:
+        lane = lanes[chat_id] = ChatPromptLane()
+
+    lane.pending.append((user_id, text, handler, mergeable))
+    lane.last_message_time = time.monotonic()
+
+    if lane.task is None:
+        lane.task = asyncio.create_task(run_chat_lane(context, lanes, chat_id, lane))
 
-    if "current_dialog_id" in context.user_data:
-        thread_context["current_dialog_id"] = context.user_data["current_dialog_id"]
 
-    # Добавляем дополнительную информацию для перезагрузки
-    if is_reload and "current_dialog_info" in context.user_data:
-        thread_context.update(context.user_data["current_dialog_info"])
+async def run_chat_lane(context, lanes, chat_id, lane):
+    """
+    Обрабатывает очередь запросов чата, дожидаясь завершения каждой генерации перед следующей.
+    Во время остановки бота оставшиеся запросы не запускаются: пользователь получает уведомление.
+    """
+    try:
+        while lane.pending:
+            user_id, text, handler, mergeable = lane.pending[0]
+
+            if mergeable:
+                # Ждем, пока пользователь перестанет присылать сообщения
+                while True:
+                    delay = lane.last_message_time + config.PROMPT_DEBOUNCE_SECONDS - time.monotonic()
+                    if delay <= 0:
+                        break
+                    await asyncio.sleep(delay)
+
+                # Объединяем идущие подряд сообщения того же пользователя
+                batch_size = 1
+                while batch_size < len(lane.pending):
+                    next_user_id, _, _, next_mergeable = lane.pending[batch_size]
+                    if next_user_id != user_id or not next_mergeable:
+                        break
+                    batch_size += 1
+
+                if batch_size > 1:
+                    text = "\n\n".join(item[1] for item in lane.pending[:batch_size])
+                    logger.info(f"Объединено {batch_size} сообщений пользователя {user_id} в чате {chat_id}")
+            else:
+                batch_size = 1
 
-    # Запускаем поток для потоковой обработки
-    threading.Thread(
-        target=stream_ai_response,
-        args=(model_id, user_message, context.bot_data["update_queue"], chat_id,
-              initial_message.message_id, cancel_event, thread_context)
-    ).start()
+            if not context.bot_data.get("accepting_prompts", True):
+                logger.info(f"Остановка бота: отклонено запросов из очереди чата {chat_id}: {len(lane.pending)}")
+                lane.pending.clear()
+                await reject_if_shutting_down(context, chat_id)
+                break
+
+            del lane.pending[:batch_size]
+
+            try:
+                generation_done = await handler(text)
+                if generation_done is not None:
+                    await generation_done
+            except Exception as e:
+                logger.error(f"Ошибка при обработке запроса в чате {chat_id}: {e}")
+    finally:
+        lane.task = None
+        if not lane.pending and lanes.get(chat_id) is lane:
+            del lanes[chat_id]
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик текстовых сообщений."""
-    user_message = update.message.text
+    """
+    Обработчик текстовых сообщений: ставит сообщение в очередь запросов чата.
+
+    Обработчик не дожидается генерации, поэтому обновления чата (например, кнопка отмены)
+    обрабатываются, пока идет генерация.
+    """
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+
+    if await reject_if_shutting_down(context, chat_id):
+        return
+
+    # Фактический расход токенов списывается после генерации
+    if await reject_if_rate_limited(context, chat_id, user_id,
+                                    {"message": 1, "tokens": estimate_tokens(update.message.text)}):
+        return
+
+    enqueue_chat_prompt(
+        context, chat_id, user_id, update.message.text,
+        lambda user_message: submit_prompt(update, context, user_message)
+    )
+
+
+async def submit_prompt(update, context, user_message):
+    """
+    Регистрирует запрос пользователя в БД и запускает генерацию ответа.
+
+    Args:
+        update: Обновление с первым сообщением запроса
+        context: Контекст телеграм-бота
+        user_message: Текст запроса (может объединять несколько сообщений)
+
+    Returns:
+        asyncio.Future: Завершается вместе с генерацией (None, если генерация не запущена)
+    """
     user = update.effective_user
     chat_id = update.effective_chat.id
     user_id = user.id
 
     # Логируем пользователя и его сообщение
     db = context.bot_data.get("db")
+    dialog_id = None
+    previous_dialog = {key: context.user_data.get(key) for key in ("current_dialog_id", "current_dialog_info")}
     if db:
         # Регистрируем или обновляем пользователя
         db.register_user(
@@ -1079,36 +2374,25 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             # Проверяем, имеет ли пользователь право использовать эту модель
             is_admin = str(user_id) in config.ADMIN_IDS
 
-            # Проверяем, бесплатная ли модель
-            cursor = db.conn.cursor()
-            cursor.execute(
-                "SELECT is_free FROM models WHERE id = ?",
-                (model_id,)
-            )
-            result = cursor.fetchone()
-
-            is_free_model = True  # По умолчанию считаем модель бесплатной
-            if result is not None:
-                is_free_model = bool(result[0])
+            # Проверяем, бесплатная ли модель (по умолчанию считаем модель бесплатной)
+            model = model_catalog.get(model_id)
+            is_free_model = model is None or model.is_free
 
             # Если модель платная и пользователь не админ, сообщаем об ошибке
             if not is_free_model and not is_admin:
                 await update.message.reply_text(
                     "⚠️ У вас нет доступа к этой модели. Пожалуйста, выберите бесплатную модель с помощью команды /select_model"
                 )
-                return
+                return None
 
             # Находим название модели для логирования
-            models = await get_available_models(context, user_id)
-            model_name = model_id
-            for model in models:
-                if model["id"] == model_id:
-                    model_name = model["name"]
-                    break
+            model_name = model.name if model else model_id
 
             # Подготавливаем контекст диалога для оценки заполнения
-            messages, context_usage_percent = prepare_context(db, user_id, context.user_data["current_dialog"],
-                                                              model_id, user_message)
+            messages, context_usage_percent = prepare_context(
+                db, user_id, context.user_data["current_dialog"], model_id, user_message,
+                context_mode=context.user_data.get("context_mode", config.CONTEXT_MODE)
+            )
 
             # Если контекст заполнен более чем на 90%, предлагаем начать новый диалог
             if context_usage_percent > 90:
@@ -1150,14 +2434,28 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await update.message.reply_text(
                 "Пожалуйста, сначала выберите модель с помощью команды /select_model"
             )
-            return
+            return None
 
     # Обрабатываем запрос и отправляем ответ
-    await process_ai_request(
-        context,
-        update.message.chat_id,
-        user_message
-    )
+    generation = None
+    try:
+        generation = await process_ai_request(
+            context,
+            update.message.chat_id,
+            user_message
+        )
+    finally:
+        # Если генерация не запущена (например, отклонена бюджетом), запрос не должен
+        # оставаться в истории незавершенной записью
+        if generation is None and dialog_id:
+            db.delete_unanswered_dialog(dialog_id)
+            for key, value in previous_dialog.items():
+                if value is None:
+                    context.user_data.pop(key, None)
+                else:
+                    context.user_data[key] = value
+
+    return generation
 
 
 async def new_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1182,96 +2480,193 @@ async def new_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         await update.message.reply_text("Ошибка доступа к базе данных.")
 
 
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик нажатий на кнопки."""
-    query = update.callback_query
-    await query.answer()
+async def context_mode_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Переключает режим формирования контекста диалога."""
+    modes = {
+        "recent": "последние сообщения диалога",
+        "retrieval": "последние сообщения и найденные по смыслу запроса более ранние"
+    }
+    current_mode = context.user_data.get("context_mode", config.CONTEXT_MODE)
 
-    data = query.data
-    user_id = query.from_user.id
-    chat_id = query.message.chat_id
+    if not context.args:
+        await update.message.reply_text(
+            f"Текущий режим контекста: {current_mode} ({modes.get(current_mode, '')}).\n\n"
+            f"Используйте формат: /context_mode recent|retrieval"
+        )
+        return
+
+    mode = context.args[0].lower()
+    if mode not in modes:
+        await update.message.reply_text("Используйте формат: /context_mode recent|retrieval")
+        return
+
+    db = context.bot_data.get("db")
+    if mode == "retrieval" and not (db and db.fts_enabled):
+        await update.message.reply_text("⚠️ Режим поиска недоступен: SQLite собран без поддержки FTS5.")
+        return
+
+    context.user_data["context_mode"] = mode
+    await update.message.reply_text(f"Режим контекста изменен: {mode} ({modes[mode]}).")
+
+
+async def hedging_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Включает или выключает дублирование медленных запросов к бесплатным моделям."""
+    current = "on" if context.user_data.get("hedging", config.HEDGE_REQUESTS) else "off"
+
+    if not context.args or context.args[0].lower() not in ("on", "off"):
+        await update.message.reply_text(
+            f"Дублирование запросов: {current}.\n\n"
+            "Если бесплатная модель не начала отвечать за обычное для нее время, такой же запрос "
+            "отправляется другой бесплатной модели, и вы получаете ответ той, что ответит первой.\n\n"
+            "Используйте формат: /hedging on|off"
+        )
+        return
+
+    enabled = context.args[0].lower() == "on"
+    context.user_data["hedging"] = enabled
+    await update.message.reply_text(f"Дублирование запросов {'включено' if enabled else 'выключено'}.")
+
+
+def select_model_for_user(context, user_id, model_id):
+    """
+    Выбирает модель для пользователя и начинает новый диалог.
+
+    Returns:
+        str: Сообщение для пользователя (о выборе модели или об отсутствии доступа)
+    """
     is_admin = str(user_id) in config.ADMIN_IDS
 
-    if data.startswith("model_"):
-        # Извлекаем ID модели
-        model_id = data[6:]
+    # Проверяем, имеет ли пользователь право использовать эту модель
+    db = context.bot_data.get("db")
+    model = model_catalog.get(model_id)
 
-        # Проверяем, имеет ли пользователь право использовать эту модель
-        db = context.bot_data.get("db")
-        if db:
-            cursor = db.conn.cursor()
-            cursor.execute("SELECT is_free FROM models WHERE id = ?", (model_id,))
-            result = cursor.fetchone()
+    # Если модель платная и пользователь не админ, сообщаем об ошибке
+    if model is not None and not model.is_free and not is_admin:
+        return "⚠️ У вас нет доступа к этой модели. Пожалуйста, выберите бесплатную модель."
 
-            is_free_model = True  # По умолчанию считаем модель бесплатной
-            if result is not None:
-                is_free_model = bool(result[0])
+    # Сохраняем модель
+    context.user_data["selected_model"] = model_id
 
-            # Если модель платная и пользователь не админ, сообщаем об ошибке
-            if not is_free_model and not is_admin:
-                await query.edit_message_text(
-                    "⚠️ У вас нет доступа к этой модели. Пожалуйста, выберите бесплатную модель."
-                )
-                return
+    # Находим название модели и описание для отображения
+    model_name = model.name if model else model_id
+    model_description = (model.description if model else None) or "Нет описания"
 
-        # Сохраняем модель
-        context.user_data["selected_model"] = model_id
+    # Если текущий диалог существует, отмечаем его как завершенный
+    if db and "current_dialog" in context.user_data:
+        db.mark_last_message(user_id, context.user_data["current_dialog"])
+        # Создаем новый диалог при выборе новой модели
+        context.user_data["current_dialog"] = db.get_next_dialog_number(user_id)
 
-        # Находим название модели и описание для отображения
-        models = await get_available_models(context, user_id)
-        model_name = model_id
-        model_description = "Нет описания"
+    # Для администраторов добавляем информацию о платности модели
+    if is_admin and model:
+        pricing_info = (
+            f"Информация о цене:\n"
+            f"Цена за запрос: {format_price(model.prompt_price)}\n"
+            f"Цена за ответ: {format_price(model.completion_price)}\n"
+            f"Статус: {'Бесплатная' if model.is_free else 'Платная'}\n\n"
+        )
+    else:
+        pricing_info = ""
+
+    # Формируем сообщение с названием и описанием модели
+    response_message = (
+        f"Вы выбрали модель: {model_name}\n\n"
+        f"{pricing_info}"
+        f"Описание модели:\n{model_description}\n\n"
+        "Теперь вы можете отправить сообщение, и я передам его выбранной AI модели."
+    )
 
-        for model in models:
-            if model["id"] == model_id:
-                model_name = model["name"]
-                model_description = model["description"]
-                break
+    # Если сообщение слишком длинное, сокращаем
+    if len(response_message) > 4096:
+        response_message = response_message[:4093] + "..."
 
-        # Если текущий диалог существует, отмечаем его как завершенный
-        if db and "current_dialog" in context.user_data:
-            db.mark_last_message(user_id, context.user_data["current_dialog"])
-            # Создаем новый диалог при выборе новой модели
-            context.user_data["current_dialog"] = db.get_next_dialog_number(user_id)
+    return response_message
 
-        # Для администраторов добавляем информацию о платности модели
-        if is_admin and db:
-            cursor = db.conn.cursor()
-            cursor.execute(
-                "SELECT prompt_price, completion_price, is_free FROM models WHERE id = ?",
-                (model_id,)
-            )
-            result = cursor.fetchone()
-
-            if result:
-                prompt_price = result[0] or "0"
-                completion_price = result[1] or "0"
-                is_free = bool(result[2])
-
-                pricing_info = (
-                    f"Информация о цене:\n"
-                    f"Цена за запрос: {prompt_price}\n"
-                    f"Цена за ответ: {completion_price}\n"
-                    f"Статус: {'Бесплатная' if is_free else 'Платная'}\n\n"
-                )
-            else:
-                pricing_info = ""
-        else:
-            pricing_info = ""
-
-        # Формируем сообщение с названием и описанием модели
-        response_message = (
-            f"Вы выбрали модель: {model_name}\n\n"
-            f"{pricing_info}"
-            f"Описание модели:\n{model_description}\n\n"
-            "Теперь вы можете отправить сообщение, и я передам его выбранной AI модели."
+
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ищет модели по части ID, названия или описания и предлагает выбрать одну из них."""
+    user_id = update.effective_user.id
+
+    if not context.args:
+        await update.message.reply_text(
+            "Используйте формат: /find запрос\n\n"
+            "Например: /find llama или /find модель для кода"
         )
+        return
 
-        # Если сообщение слишком длинное, сокращаем
-        if len(response_message) > 4096:
-            response_message = response_message[:4093] + "..."
+    query = " ".join(context.args)
+    models = model_search.search(
+        query, only_free=str(user_id) not in config.ADMIN_IDS, limit=config.MODEL_SEARCH_LIMIT)
 
-        await query.edit_message_text(response_message)
+    if not models:
+        await update.message.reply_text(f"По запросу «{query}» модели не найдены.")
+        return
+
+    keyboard = []
+    for model in models:
+        top_mark = "⭐️ " if model.top_model else ""
+        free_mark = "🆓 " if model.is_free else "💰 "
+        keyboard.append([InlineKeyboardButton(f"{top_mark}{free_mark}{model.name}", callback_data=f"model_{model.id}")])
+
+    await update.message.reply_text(
+        f"Модели по запросу «{query}»:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def use_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Выбирает модель по ID (например, из результата поиска в инлайн-режиме)."""
+    if not context.args:
+        await update.message.reply_text("Используйте формат: /use model_id")
+        return
+
+    model_id = context.args[0]
+    if model_catalog.get(model_id) is None:
+        await update.message.reply_text(
+            f"⚠️ Модель с ID '{model_id}' не найдена. Используйте /find для поиска модели.")
+        return
+
+    await update.message.reply_text(select_model_for_user(context, update.effective_user.id, model_id))
+
+
+async def inline_model_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Инлайн-режим: ищет модели по запросу, выбор результата отправляет в чат команду /use."""
+    inline_query = update.inline_query
+    query = inline_query.query.strip()
+    is_admin = str(inline_query.from_user.id) in config.ADMIN_IDS
+
+    if query:
+        models = model_search.search(query, only_free=not is_admin, limit=config.MODEL_SEARCH_LIMIT)
+    else:
+        # Без запроса показываем топовые модели
+        models = [model for model in model_catalog.models(only_top=True) if is_admin or model.is_free]
+        models = models[:config.MODEL_SEARCH_LIMIT]
+
+    results = []
+    for model in models:
+        free_mark = "🆓 " if model.is_free else "💰 "
+        results.append(InlineQueryResultArticle(
+            id=str(len(results)),
+            title=f"{free_mark}{model.name}",
+            description=(model.description or model.id)[:200],
+            input_message_content=InputTextMessageContent(f"/use {model.id}")
+        ))
+
+    # Результаты зависят от прав пользователя, поэтому не кэшируются для всех
+    await inline_query.answer(results, cache_time=30, is_personal=True)
+
+
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик нажатий на кнопки."""
+    query = update.callback_query
+    await query.answer()
+
+    data = query.data
+    user_id = query.from_user.id
+    chat_id = query.message.chat_id
+    is_admin = str(user_id) in config.ADMIN_IDS
+
+    if data.startswith("model_"):
+        # Извлекаем ID модели и выбираем ее
+        await query.edit_message_text(select_model_for_user(context, user_id, data[6:]))
 
     elif data.startswith("modelpage_"):
         # Обработка навигации по страницам
@@ -1293,9 +2688,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
         # Применяем фильтры
         if current_filter == "free":
-            models = [model for model in models if model.get("is_free")]
+            models = [model for model in models if model.is_free]
         elif current_filter == "top":
-            models = [model for model in models if model.get("top_model")]
+            models = [model for model in models if model.top_model]
 
         # Строим клавиатуру для новой страницы
         keyboard = build_model_keyboard(models, page)
@@ -1314,10 +2709,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             model_name = model_id
 
             # Ищем название выбранной модели
-            for model in models:
-                if model["id"] == model_id:
-                    model_name = model["name"]
-                    break
+            selected = model_catalog.get(model_id)
+            if selected:
+                model_name = selected.name
 
             selected_model_text = f"Текущая выбранная модель: {model_name}\n\n"
 
@@ -1344,9 +2738,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
         # Применяем фильтры
         if filter_type == "free":
-            models = [model for model in models if model.get("is_free")]
+            models = [model for model in models if model.is_free]
         elif filter_type == "top":
-            models = [model for model in models if model.get("top_model")]
+            models = [model for model in models if model.top_model]
 
         # Строим клавиатуру для новой страницы
         keyboard = build_model_keyboard(models, 0)
@@ -1365,10 +2759,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             model_name = model_id
 
             # Ищем название выбранной модели
-            for model in models:
-                if model["id"] == model_id:
-                    model_name = model["name"]
-                    break
+            selected = model_catalog.get(model_id)
+            if selected:
+                model_name = selected.name
 
             selected_model_text = f"Текущая выбранная модель: {model_name}\n\n"
 
@@ -1380,39 +2773,50 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             reply_markup=keyboard
         )
 
+    elif data.startswith("hsearch_"):
+        # Следующая страница результатов поиска по истории
+        try:
+            token, page = data[8:].split("_")
+            page = int(page)
+        except ValueError:
+            return
+        await send_history_search_page(context, user_id, token, page, query=query)
+
     elif data.startswith("reload_"):
         # Обработка перезагрузки ответа
         try:
             message_id_to_reload = int(data.split("_")[1])
+
+            if await reject_if_shutting_down(context, chat_id):
+                return
+
+            # Токены перезагрузки списываются после генерации
+            if await reject_if_rate_limited(context, chat_id, user_id, {"reload": 1}):
+                return
+
             user_message = context.user_data.get("last_message", {}).get("text", "")
 
             if not user_message:
                 await query.edit_message_text("Не удалось перезагрузить ответ: сообщение не найдено")
                 return
 
-            # Создаем новое сообщение для перезагрузки
-            cancel_keyboard = InlineKeyboardMarkup([[
-                InlineKeyboardButton("❌ Остановить генерацию", callback_data="cancel_stream")
-            ]])
-
-            new_message = await context.bot.send_message(
-                chat_id=chat_id,
-                text="Генерирую новый ответ...",
-                reply_markup=cancel_keyboard
-            )
-
+            # Перезагрузка выполняется после текущей генерации чата.
             # Устанавливаем флаг перезагрузки для правильного обновления в БД
-            await process_ai_request(context, chat_id, user_message, is_reload=True)
+            enqueue_chat_prompt(
+                context, chat_id, user_id, user_message,
+                lambda text: process_ai_request(context, chat_id, text, is_reload=True),
+                mergeable=False
+            )
 
         except Exception as e:
             logger.error(f"Ошибка при перезагрузке ответа: {e}")
             await query.edit_message_text(f"Ошибка при перезагрузке ответа: {str(e)}")
 
     elif data == "cancel_stream":
-        # Обработка отмены потоковой передачи
-        if "active_streams" in context.bot_data and str(chat_id) in context.bot_data["active_streams"]:
-            cancel_event = context.bot_data["active_streams"][str(chat_id)]
-            cancel_event.set()
+        # Обработка отмены потоковой передачи (генерация может выполняться в другом процессе)
+        if context.bot_data["state"].request_cancel(chat_id):
+            # Генерация, ожидающая в очереди, завершается сразу
+            context.bot_data["scheduler"].start_canceled()
 
             # Меняем кнопку на индикатор отмены
             await query.edit_message_reply_markup(
@@ -1430,10 +2834,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     elif data == "cancel_stream":
         # Обработка отмены потоковой передачи
-        if "active_streams" in context.bot_data and str(chat_id) in context.bot_data["active_streams"]:
-            cancel_event = context.bot_data["active_streams"][str(chat_id)]
-            cancel_event.set()
-
+        if context.bot_data["state"].request_cancel(chat_id):
             # Просто удаляем кнопки, чтобы пользователь не мог нажать их повторно
             try:
                 await query.edit_message_reply_markup(reply_markup=None)
@@ -1480,7 +2881,7 @@ async def wait_for_cancel_processing(context, chat_id, message_id, wait_time=1.5
     await asyncio.sleep(wait_time)
 
     # Обновляем кнопки, только если поток все еще активен
-    if "active_streams" in context.bot_data and str(chat_id) in context.bot_data["active_streams"]:
+    if context.bot_data["state"].has_stream(chat_id):
         try:
             # Убираем кнопки совсем, так как генерация уже должна остановиться
             await context.bot.edit_message_reply_markup(
@@ -1519,7 +2920,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             "/translate_all - Перевести все описания моделей\n"
             "/set_description - Установить русское описание модели\n"
             "/set_top - Установить или снять статус топ-модели\n"
-            "/list_models - Показать список моделей в БД\n\n"
+            "/list_models - Показать список моделей в БД\n"
+            "/jobs - Состояние фоновых задач\n"
+            "/queue - Очередь генераций и время ожидания\n"
+            "/latency - Время до первого токена с дублированием запросов и без\n"
+            "/usage - Расход токенов и стоимость по моделям и пользователям\n"
+            "/export_all - Экспорт диалогов всех пользователей (или одного: /export_all md user_id)\n\n"
         )
         welcome_message += admin_message
 
@@ -1548,7 +2954,12 @@ async def set_user_commands(context, user_id, chat_id):
         BotCommand("start", "Начать работу с ботом"),
         BotCommand("help", "Показать сообщение помощи"),
         BotCommand("select_model", "Выбрать модель AI"),
-        BotCommand("new_dialog", "Начать новый диалог")
+        BotCommand("find", "Найти модель"),
+        BotCommand("new_dialog", "Начать новый диалог"),
+        BotCommand("export", "Экспорт диалогов в файл"),
+        BotCommand("search", "Поиск по истории диалогов"),
+        BotCommand("context_mode", "Режим контекста диалога"),
+        BotCommand("hedging", "Дублирование медленных запросов")
     ]
 
     if is_admin:
@@ -1559,7 +2970,12 @@ async def set_user_commands(context, user_id, chat_id):
             BotCommand("translate_all", "Перевести все описания"),
             BotCommand("set_description", "Установить описание модели"),
             BotCommand("set_top", "Установить топ-модель"),
-            BotCommand("list_models", "Показать список моделей")
+            BotCommand("list_models", "Показать список моделей"),
+            BotCommand("jobs", "Состояние фоновых задач"),
+            BotCommand("queue", "Очередь генераций"),
+            BotCommand("latency", "Время до первого токена"),
+            BotCommand("usage", "Расход и стоимость запросов"),
+            BotCommand("export_all", "Экспорт диалогов всех пользователей")
         ]
         # Объединяем базовые и админские команды
         commands = base_commands + admin_commands
@@ -1620,11 +3036,11 @@ def build_model_keyboard(models, page=0, page_size=8):
     keyboard = []
     for model in current_models:
         # Добавляем эмодзи для топовых и платных моделей
-        top_mark = "⭐️ " if model.get("top_model") else ""
-        free_mark = "🆓 " if model.get("is_free") else "💰 "
+        top_mark = "⭐️ " if model.top_model else ""
+        free_mark = "🆓 " if model.is_free else "💰 "
 
-        button_text = f"{top_mark}{free_mark}{model['name']}"
-        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"model_{model['id']}")])
+        button_text = f"{top_mark}{free_mark}{model.name}"
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"model_{model.id}")])
 
     # Добавляем навигационные кнопки
     nav_buttons = []
@@ -1669,7 +3085,12 @@ async def set_bot_commands(context, is_admin=False, chat_id=None):
         BotCommand("start", "Начать работу с ботом"),
         BotCommand("help", "Показать сообщение помощи"),
         BotCommand("select_model", "Выбрать модель AI"),
-        BotCommand("new_dialog", "Начать новый диалог")
+        BotCommand("find", "Найти модель"),
+        BotCommand("new_dialog", "Начать новый диалог"),
+        BotCommand("export", "Экспорт диалогов в файл"),
+        BotCommand("search", "Поиск по истории диалогов"),
+        BotCommand("context_mode", "Режим контекста диалога"),
+        BotCommand("hedging", "Дублирование медленных запросов")
     ]
 
     if is_admin:
@@ -1680,7 +3101,12 @@ async def set_bot_commands(context, is_admin=False, chat_id=None):
             BotCommand("translate_all", "Перевести все описания"),
             BotCommand("set_description", "Установить описание модели"),
             BotCommand("set_top", "Установить топ-модель"),
-            BotCommand("list_models", "Показать список моделей")
+            BotCommand("list_models", "Показать список моделей"),
+            BotCommand("jobs", "Состояние фоновых задач"),
+            BotCommand("queue", "Очередь генераций"),
+            BotCommand("latency", "Время до первого токена"),
+            BotCommand("usage", "Расход и стоимость запросов"),
+            BotCommand("export_all", "Экспорт диалогов всех пользователей")
         ]
         # Объединяем базовые и админские команды
         commands = base_commands + admin_commands
@@ -1718,7 +3144,12 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "/start - Начать работу с ботом\n"
         "/help - Показать это сообщение помощи\n"
         "/select_model - Выбрать модель AI для общения\n"
-        "/new_dialog - Начать новый диалог (сбросить контекст)\n\n"
+        "/find - Найти модель по названию или описанию (или наберите @имя_бота запрос в любом чате)\n"
+        "/new_dialog - Начать новый диалог (сбросить контекст)\n"
+        "/export - Экспорт текущего диалога в файл (/export all jsonl - всех диалогов в JSONL)\n"
+        "/search - Поиск по истории всех ваших диалогов\n"
+        "/context_mode - Режим контекста: последние сообщения или поиск по истории\n"
+        "/hedging - Дублировать запрос на другую бесплатную модель, если выбранная долго не отвечает\n\n"
         "💬 *О контексте диалога:*\n"
         "Бот сохраняет историю вашего диалога и передает её модели. "
         "Это позволяет вести непрерывную беседу, где модель помнит предыдущие сообщения. "
@@ -1739,23 +3170,11 @@ async def get_available_models(context, user_id):
         user_id: ID пользователя
 
     Returns:
-        Список доступных моделей
+        Записи каталога доступных моделей (ModelRecord)
     """
-    # Проверяем, является ли пользователь админом
+    # Для админов возвращаем все модели, для обычных пользователей - только бесплатные
     is_admin = str(user_id) in config.ADMIN_IDS
-
-    # Получаем доступ к БД
-    db = context.bot_data.get("db")
-    if db:
-        if is_admin:
-            # Для админов возвращаем все модели
-            return db.get_models()
-        else:
-            # Для обычных пользователей возвращаем только бесплатные модели
-            return db.get_models(only_free=True)
-
-    # Если не удалось получить из БД, возвращаем стандартный список бесплатных моделей
-    return []
+    return model_catalog.models(only_free=not is_admin)
 
 
 async def select_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1773,9 +3192,9 @@ async def select_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
     # Применяем фильтры
     if current_filter == "free":
-        models = [model for model in models if model.get("is_free")]
+        models = [model for model in models if model.is_free]
     elif current_filter == "top":
-        models = [model for model in models if model.get("top_model")]
+        models = [model for model in models if model.top_model]
 
     # Построение клавиатуры с пагинацией
     keyboard = build_model_keyboard(models, page)
@@ -1787,10 +3206,9 @@ async def select_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         model_name = model_id
 
         # Ищем название выбранной модели
-        for model in models:
-            if model["id"] == model_id:
-                model_name = model["name"]
-                break
+        selected = model_catalog.get(model_id)
+        if selected:
+            model_name = selected.name
 
         selected_model_text = f"Текущая выбранная модель: {model_name}\n\n"
 
@@ -1824,19 +3242,17 @@ async def update_models_command(update: Update, context: ContextTypes.DEFAULT_TY
         return
 
     # Отправляем сообщение о начале обновления
-    message = await update.message.reply_text("Обновляю список моделей...")
+    message = await update.message.reply_text("Ставлю обновление списка моделей в очередь...")
 
-    # Запускаем обновление в отдельном потоке, чтобы не блокировать бота
-    def run_update():
-        return fetch_and_update_models(context)
+    # Обновление выполняется фоновой задачей, чтобы не блокировать бота
+    job_id, created = enqueue_update_models(context.application, message, user_id)
 
-    # Запускаем в отдельном потоке
-    success = await context.application.loop.run_in_executor(None, run_update)
-
-    if success:
-        await message.edit_text("Список моделей успешно обновлен!")
+    if not job_id:
+        await message.edit_text("⚠️ Не удалось поставить задачу в очередь. Подробности в логах.")
+    elif not created:
+        await message.edit_text(f"Обновление списка моделей уже выполняется (задача #{job_id}). Статус: /jobs")
     else:
-        await message.edit_text("Произошла ошибка при обновлении моделей. Подробности в логах.")
+        await message.edit_text(f"Задача #{job_id} на обновление списка моделей поставлена в очередь. Статус: /jobs")
 
 
 async def set_model_description(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1928,7 +3344,7 @@ async def list_models(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         only_free = (filter_type == "free")
         only_top = (filter_type == "top")
 
-        models = db.get_models(only_free=only_free, only_top=only_top)
+        models = model_catalog.models(only_free=only_free, only_top=only_top)
 
         if not models:
             await update.message.reply_text("Список моделей пуст.")
@@ -1938,13 +3354,13 @@ async def list_models(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         message = f"Список моделей ({filter_type}):\n\n"
 
         for i, model in enumerate(models, 1):
-            top_mark = "⭐️ " if model["top_model"] else ""
-            free_mark = "🆓 " if model["is_free"] else ""
+            top_mark = "⭐️ " if model.top_model else ""
+            free_mark = "🆓 " if model.is_free else ""
 
             model_info = (
-                f"{i}. {top_mark}{free_mark}{model['name']}\n"
-                f"ID: {model['id']}\n"
-                f"Описание: {model['description'] or 'Нет описания'}\n\n"
+                f"{i}. {top_mark}{free_mark}{model.name}\n"
+                f"ID: {model.id}\n"
+                f"Описание: {model.description or 'Нет описания'}\n\n"
             )
 
             # Если сообщение становится слишком длинным, отправляем его и начинаем новое
@@ -1992,7 +3408,196 @@ def estimate_tokens(text):
     return int(tokens)
 
 
-def prepare_context(db, user_id, dialog_number, model_id, current_message, max_context_size=None):
+def build_fts_query(text, max_terms=16, operator="OR"):
+    """
+    Строит запрос FTS5 MATCH из произвольного текста пользователя.
+
+    Каждое слово берется в кавычки, чтобы операторы FTS5 в тексте не ломали запрос,
+    по умолчанию слова объединяются через OR - ранжирование BM25 само поднимет лучшие совпадения.
+
+    Args:
+        text: Текст сообщения
+        max_terms: Максимальное количество слов в запросе
+        operator: Оператор между словами ("OR" или "AND" - все слова должны встретиться)
+
+    Returns:
+        str: Запрос FTS5 или None, если в тексте нет подходящих слов
+    """
+    terms = []
+    for word in re.findall(r"\w{3,}", text.lower()):
+        if word not in terms:
+            terms.append(word)
+        if len(terms) >= max_terms:
+            break
+
+    if not terms:
+        return None
+
+    return f" {operator} ".join(f'"{term}"' for term in terms)
+
+
+def format_history_search_results(results, search_text):
+    """
+    Формирует HTML-сообщение с результатами поиска по истории.
+
+    Args:
+        results: Результаты DBHandler.search_user_history (найденные слова выделены символами \x02 и \x03)
+        search_text: Текст запроса для заголовка
+    """
+    def highlight(snippet):
+        # Экранируем текст, затем заменяем маркеры выделения тегами
+        return html.escape(snippet or "").replace("\x02", "<b>").replace("\x03", "</b>")
+
+    message = f"🔎 Результаты поиска «{html.escape(search_text)}»:\n\n"
+    for _, number_dialog, ask_date, _, user_snippet, answer_snippet in results:
+        message += f"<i>Диалог {number_dialog}, {ask_date}</i>\n"
+        if user_snippet:
+            message += f"👤 {highlight(user_snippet)}\n"
+        if answer_snippet:
+            message += f"🤖 {highlight(answer_snippet)}\n"
+        message += "\n"
+
+    return message[:4096]
+
+
+async def send_history_search_page(context, user_id, token, page=0, query=None, message=None):
+    """
+    Выполняет поиск по истории пользователя и показывает страницу результатов.
+
+    Поиски хранятся в user_data под коротким токеном, который передается в кнопке
+    "Показать еще" вместе с номером страницы, поэтому кнопка старого сообщения продолжает
+    свой поиск, а не последний. Для каждой страницы там же хранится ключ (rank, rowid)
+    последнего результата предыдущей страницы в том виде, в каком его вернул SQLite.
+
+    Args:
+        context: Контекст обработчика
+        user_id: ID пользователя
+        token: Токен поиска в user_data["history_searches"]
+        page: Номер страницы (0 - первая)
+        query: CallbackQuery при переходе на следующую страницу
+        message: Сообщение с командой для первой страницы
+    """
+    searches = dict(context.user_data.get("history_searches") or {})
+    search = searches.get(token)
+    if not search or page >= len(search["cursors"]):
+        await query.edit_message_reply_markup(reply_markup=None)
+        await query.message.reply_text("Этот поиск устарел. Повторите команду /search.")
+        return
+
+    db = context.bot_data["db"]
+    limit = config.HISTORY_SEARCH_PAGE_SIZE
+    after = search["cursors"][page]
+
+    # Выбираем на один результат больше, чтобы узнать, есть ли следующая страница
+    results = db.search_user_history(
+        user_id, search["match_query"], after=after, limit=limit + 1,
+        highlight=("\x02", "\x03"), snippet_tokens=config.HISTORY_SEARCH_SNIPPET_TOKENS
+    )
+
+    if not results:
+        text = "Больше ничего не найдено." if page else f"По запросу «{search['text']}» ничего не найдено."
+        if query:
+            await query.edit_message_reply_markup(reply_markup=None)
+            await query.message.reply_text(text)
+        else:
+            await message.reply_text(text)
+        return
+
+    reply_markup = None
+    if len(results) > limit:
+        results = results[:limit]
+
+        # Ключ следующей страницы сохраняется один раз: повторное нажатие кнопки показывает ту же страницу
+        if page + 1 == len(search["cursors"]):
+            search = dict(search, cursors=search["cursors"] + [[results[-1][3], results[-1][0]]])
+            searches[token] = search
+            # Состояние пользователя сохраняется только при присваивании ключа
+            context.user_data["history_searches"] = searches
+
+        reply_markup = InlineKeyboardMarkup([[
+            InlineKeyboardButton("Показать еще ▶️", callback_data=f"hsearch_{token}_{page + 1}")
+        ]])
+
+    text = format_history_search_results(results, search["text"])
+
+    if query:
+        # Кнопку предыдущей страницы убираем, новая страница отправляется отдельным сообщением
+        await query.edit_message_reply_markup(reply_markup=None)
+        await query.message.reply_text(text, reply_markup=reply_markup, parse_mode="HTML")
+    else:
+        await message.reply_text(text, reply_markup=reply_markup, parse_mode="HTML")
+
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Полнотекстовый поиск по всем диалогам пользователя."""
+    db = context.bot_data.get("db")
+    if not db:
+        await update.message.reply_text("Ошибка доступа к базе данных.")
+        return
+
+    if not db.fts_enabled:
+        await update.message.reply_text("⚠️ Поиск недоступен: SQLite собран без поддержки FTS5.")
+        return
+
+    search_text = " ".join(context.args or [])
+    match_query = build_fts_query(search_text, operator="AND")
+    if not match_query:
+        await update.message.reply_text(
+            "Используйте формат: /search слова для поиска\n\n"
+            "Будут найдены сообщения и ответы, содержащие все слова запроса (не короче 3 букв)."
+        )
+        return
+
+    # Сохраняем поиск под новым токеном; хранятся только последние HISTORY_SEARCH_SESSIONS поисков
+    token = str(context.user_data.get("history_search_seq", 0) + 1)
+    context.user_data["history_search_seq"] = int(token)
+
+    searches = dict(context.user_data.get("history_searches") or {})
+    searches[token] = {"text": search_text, "match_query": match_query, "cursors": [None]}
+    for old_token in sorted(searches, key=int)[:-config.HISTORY_SEARCH_SESSIONS]:
+        del searches[old_token]
+    context.user_data["history_searches"] = searches
+
+    await send_history_search_page(context, update.effective_user.id, token, message=update.message)
+
+
+def get_retrieval_history(db, user_id, dialog_number, current_message):
+    """
+    Собирает историю диалога в режиме поиска: короткое окно последних обменов
+    плюс наиболее релевантные текущему сообщению более ранние обмены.
+
+    Args:
+        db: Экземпляр DBHandler
+        user_id: ID пользователя
+        dialog_number: Номер диалога
+        current_message: Текущее сообщение пользователя
+
+    Returns:
+        Список словарей с сообщениями диалога [{"role": "user/assistant", "content": "..."}]
+    """
+    recent_turns = db.get_recent_dialog_turns(user_id, dialog_number, config.RETRIEVAL_RECENT_TURNS)
+
+    retrieved_turns = []
+    match_query = build_fts_query(current_message)
+    if recent_turns and match_query:
+        retrieved_turns = db.search_dialog_turns(
+            user_id, dialog_number, match_query,
+            before_id=recent_turns[0][0],
+            limit=config.RETRIEVAL_TOP_K
+        )
+
+    history = []
+    for _, user_ask, model_answer in retrieved_turns + recent_turns:
+        if user_ask:
+            history.append({"role": "user", "content": user_ask})
+        if model_answer:
+            history.append({"role": "assistant", "content": model_answer})
+
+    return history
+
+
+def prepare_context(db, user_id, dialog_number, model_id, current_message, max_context_size=None,
+                    context_mode="recent"):
     """
     Подготавливает контекст диалога с учетом лимитов модели.
 
@@ -2003,6 +3608,8 @@ def prepare_context(db, user_id, dialog_number, model_id, current_message, max_c
         model_id: ID модели
         current_message: Текущее сообщение пользователя
         max_context_size: Максимальный размер контекста (если None, берем из БД)
+        context_mode: "recent" - последние сообщения диалога, "retrieval" - последние сообщения
+            и найденные по тексту запроса более ранние (требует FTS5)
 
     Returns:
         (messages, context_usage_percent): Список сообщений для контекста и процент заполнения контекста
@@ -2010,17 +3617,18 @@ def prepare_context(db, user_id, dialog_number, model_id, current_message, max_c
     # Получаем лимит контекста для модели
     context_limit = max_context_size
     if not context_limit:
-        cursor = db.conn.cursor()
-        cursor.execute("SELECT context_length FROM models WHERE id = ?", (model_id,))
-        result = cursor.fetchone()
-        if result and result[0]:
-            context_limit = result[0]
+        model = model_catalog.get(model_id)
+        if model and model.context_length:
+            context_limit = model.context_length
         else:
-            # Если не нашли в БД, используем значение по умолчанию
+            # Если не нашли в каталоге, используем значение по умолчанию
             context_limit = 4096
 
     # Получаем историю диалога
-    history = db.get_dialog_history(user_id, dialog_number)
+    if context_mode == "retrieval" and db.fts_enabled:
+        history = get_retrieval_history(db, user_id, dialog_number, current_message)
+    else:
+        history = db.get_dialog_history(user_id, dialog_number)
 
     # Добавляем текущее сообщение
     messages = history + [{"role": "user", "content": current_message}]
@@ -2042,6 +3650,540 @@ def prepare_context(db, user_id, dialog_number, model_id, current_message, max_c
     return messages, context_usage_percent
 
 
+def enqueue_update_models(application, message=None, user_id=None):
+    """
+    Ставит в очередь задачу обновления каталога моделей.
+
+    Args:
+        application: Приложение бота
+        message: Сообщение для отображения результата (None = без уведомления)
+        user_id: ID администратора, запустившего обновление
+
+    Returns:
+        (job_id, created): Результат DBHandler.enqueue_job
+    """
+    params = {}
+    if message:
+        params = {"chat_id": message.chat_id, "message_id": message.message_id}
+
+    job_id, created = application.bot_data["db"].enqueue_job(
+        "update_models", params, dedup_key="update_models", created_by=user_id
+    )
+    if created:
+        wake_job_workers(application)
+    return job_id, created
+
+
+def wake_job_workers(application):
+    """Будит воркеры фоновых задач, чтобы новая задача была взята без ожидания опроса."""
+    wakeup = application.bot_data.get("job_wakeup")
+    if wakeup:
+        wakeup.set()
+
+
+async def edit_job_message(application, job, text):
+    """Обновляет сообщение администратора, связанное с фоновой задачей."""
+    chat_id = job["params"].get("chat_id")
+    message_id = job["params"].get("message_id")
+    if not chat_id or not message_id:
+        return
+
+    try:
+        await application.bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id)
+    except Exception as e:
+        logger.debug(f"Не удалось обновить сообщение задачи #{job['id']}: {e}")
+
+
+async def job_update_models(application, job):
+    """Фоновая задача: обновляет каталог моделей из API."""
+    success = await fetch_and_update_models(application)
+    if not success:
+        raise RuntimeError("Произошла ошибка при обновлении моделей. Подробности в логах.")
+    return "Список моделей успешно обновлен!"
+
+
+async def job_translate_descriptions(application, job):
+    """
+    Фоновая задача: переводит описания моделей.
+
+    Контрольная точка хранит счетчики успешных и неудачных переводов. После перезапуска
+    задача продолжает с моделей, у которых все еще нет русского описания.
+    """
+    db = application.bot_data["db"]
+    checkpoint = job["checkpoint"]
+    success_before = checkpoint.get("success", 0)
+    failed_before = checkpoint.get("failed", 0)
+
+    models_to_translate = db.get_models_for_translation(job["params"].get("model_id"))
+    total = success_before + failed_before + len(models_to_translate)
+
+    if not models_to_translate:
+        return "Нет моделей для перевода."
+
+    translation_model = select_translation_model()
+    if not translation_model:
+        raise RuntimeError("Не удалось найти подходящую модель для перевода.")
+
+    await edit_job_message(
+        application, job,
+        f"Задача #{job['id']}: перевожу {len(models_to_translate)} описаний моделей.\n"
+        f"Текущая модель для перевода: {translation_model}"
+    )
+
+    last_progress_time = 0
+
+    async def report_progress(success, failed, current_tr_model):
+        nonlocal last_progress_time
+
+        success += success_before
+        failed += failed_before
+
+        # Ограничиваем частоту записи контрольных точек и редактирования сообщения
+        now = time.monotonic()
+        if now - last_progress_time < config.TRANSLATION_PROGRESS_INTERVAL and success + failed < total:
+            return
+        last_progress_time = now
+
+        db.checkpoint_job(job["id"], success + failed, total, {"success": success, "failed": failed})
+        await edit_job_message(
+            application, job,
+            f"Перевод моделей (задача #{job['id']}): {success + failed}/{total}\n"
+            f"✅ Успешно: {success}\n"
+            f"❌ Ошибок: {failed}\n"
+            f"Текущая модель для перевода: {current_tr_model}"
+        )
+
+    success, failed = await translate_models_concurrently(
+        db, models_to_translate, translation_model, report_progress
+    )
+
+    return (
+        f"Перевод завершен!\n"
+        f"Всего моделей: {total}\n"
+        f"✅ Успешно переведено: {success + success_before}\n"
+        f"❌ Ошибок: {failed + failed_before}"
+    )
+
+
+async def job_export_dialogs(application, job):
+    """
+    Фоновая задача: экспортирует диалоги в сжатый файл и отправляет его в чат.
+
+    Файл формируется на диске постранично, поэтому объем истории не влияет на потребление памяти.
+    После перезапуска бота экспорт выполняется заново.
+    """
+    params = job["params"]
+    export_format = params.get("format", "jsonl")
+
+    path, count = await asyncio.to_thread(
+        export_dialogs_to_file, application.bot_data["db"], export_format,
+        params.get("id_user"), params.get("number_dialog"), config.EXPORT_PAGE_SIZE
+    )
+
+    try:
+        if not count:
+            return "Нет сообщений для экспорта."
+
+        file_size = os.path.getsize(path)
+        if file_size > config.EXPORT_MAX_FILE_SIZE:
+            raise RuntimeError(
+                f"Файл экспорта слишком большой ({file_size // (1024 * 1024)} МБ). "
+                "Экспортируйте диалоги по отдельности или по пользователям."
+            )
+
+        if params.get("id_user") is None:
+            filename = f"dialogs_all.{export_format}.gz"
+        elif params.get("number_dialog") is None:
+            filename = f"dialogs_{params['id_user']}.{export_format}.gz"
+        else:
+            filename = f"dialog_{params['id_user']}_{params['number_dialog']}.{export_format}.gz"
+
+        with open(path, "rb") as document:
+            await application.bot.send_document(
+                chat_id=params["chat_id"],
+                document=document,
+                filename=filename,
+                read_timeout=120,
+                write_timeout=120
+            )
+    finally:
+        os.remove(path)
+
+    return f"Экспорт завершен: {count} сообщений."
+
+
+# Обработчики фоновых задач по их типу
+JOB_HANDLERS = {
+    "update_models": job_update_models,
+    "translate_descriptions": job_translate_descriptions,
+    "export_dialogs": job_export_dialogs,
+}
+
+
+async def enqueue_export(update, context, params):
+    """Ставит экспорт диалогов в очередь фоновых задач (один активный экспорт на пользователя)."""
+    user_id = update.effective_user.id
+    db = context.bot_data.get("db")
+    if not db:
+        await update.message.reply_text("Ошибка доступа к базе данных.")
+        return
+
+    message = await update.message.reply_text("Готовлю экспорт...")
+    params.update({"chat_id": message.chat_id, "message_id": message.message_id})
+
+    job_id, created = db.enqueue_job(
+        "export_dialogs", params, dedup_key=f"export_dialogs:{user_id}", created_by=user_id
+    )
+
+    if not job_id:
+        await message.edit_text("⚠️ Не удалось начать экспорт. Подробности в логах.")
+    elif not created:
+        await message.edit_text("Предыдущий экспорт еще выполняется, дождитесь его завершения.")
+    else:
+        wake_job_workers(context.application)
+        await message.edit_text(f"Экспорт поставлен в очередь (задача #{job_id}), файл придет в этот чат.")
+
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Экспортирует текущий или все диалоги пользователя: /export [all] [jsonl|md]."""
+    args = [arg.lower() for arg in context.args or []]
+    export_format = next((arg for arg in args if arg in EXPORT_FORMATS), "md")
+    unknown = [arg for arg in args if arg not in EXPORT_FORMATS and arg != "all"]
+
+    if unknown:
+        await update.message.reply_text(
+            "Используйте формат: /export [all] [md|jsonl]\n\n"
+            "/export - текущий диалог в Markdown\n"
+            "/export all jsonl - все диалоги в JSONL"
+        )
+        return
+
+    number_dialog = None
+    if "all" not in args:
+        number_dialog = context.user_data.get("current_dialog")
+        if number_dialog is None:
+            await update.message.reply_text("Текущего диалога нет. Используйте /export all для экспорта всех диалогов.")
+            return
+
+    await enqueue_export(update, context, {
+        "id_user": update.effective_user.id, "number_dialog": number_dialog, "format": export_format
+    })
+
+
+async def export_all_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Экспорт диалогов всех пользователей или одного пользователя (для администраторов)."""
+    user_id = update.effective_user.id
+
+    # Проверяем, является ли пользователь админом
+    if str(user_id) not in config.ADMIN_IDS:
+        await update.message.reply_text("У вас нет прав для использования этой команды.")
+        return
+
+    export_format = "jsonl"
+    target_user_id = None
+    for arg in context.args or []:
+        if arg.lower() in EXPORT_FORMATS:
+            export_format = arg.lower()
+        elif arg.isdigit():
+            target_user_id = int(arg)
+        else:
+            await update.message.reply_text("Используйте формат: /export_all [jsonl|md] [user_id]")
+            return
+
+    await enqueue_export(update, context, {
+        "id_user": target_user_id, "number_dialog": None, "format": export_format
+    })
+
+
+async def job_worker(application, worker_number):
+    """
+    Воркер фоновых задач: забирает задачи из таблицы jobs и выполняет их.
+
+    Args:
+        application: Приложение бота
+        worker_number: Номер воркера (для логов)
+    """
+    db = application.bot_data["db"]
+    wakeup = application.bot_data["job_wakeup"]
+
+    while True:
+        wakeup.clear()
+        job = db.claim_next_job()
+
+        if not job:
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=config.JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        logger.info(f"Воркер {worker_number} начал задачу #{job['id']} ({job['kind']}), попытка {job['attempts']}")
+
+        handler = JOB_HANDLERS.get(job["kind"])
+        if not handler:
+            logger.error(f"Неизвестный тип задачи: {job['kind']}")
+            db.finish_job(job["id"], "failed", error=f"Неизвестный тип задачи: {job['kind']}")
+            continue
+
+        try:
+            result = await handler(application, job)
+            db.finish_job(job["id"], "done", result=result)
+            await edit_job_message(application, job, result)
+            logger.info(f"Задача #{job['id']} ({job['kind']}) завершена")
+        except asyncio.CancelledError:
+            # Задача остается в статусе 'running' и будет возобновлена при следующем запуске
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при выполнении задачи #{job['id']} ({job['kind']}): {e}")
+            db.finish_job(job["id"], "failed", error=str(e))
+            await edit_job_message(application, job, f"⚠️ Задача #{job['id']} завершилась с ошибкой: {e}")
+
+
+async def jobs_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает состояние последних фоновых задач."""
+    user_id = update.effective_user.id
+
+    # Проверяем, является ли пользователь админом
+    if str(user_id) not in config.ADMIN_IDS:
+        await update.message.reply_text("У вас нет прав для использования этой команды.")
+        return
+
+    db = context.bot_data.get("db")
+    if not db:
+        await update.message.reply_text("Ошибка доступа к базе данных.")
+        return
+
+    jobs = db.get_jobs()
+    if not jobs:
+        await update.message.reply_text("Фоновых задач нет.")
+        return
+
+    status_marks = {"queued": "🕓", "running": "🔄", "done": "✅", "failed": "❌"}
+
+    message = "Последние фоновые задачи:\n\n"
+    for job in jobs:
+        message += (
+            f"{status_marks.get(job['status'], '')} #{job['id']} {job['kind']} - {job['status']}"
+            f" ({job['progress']}/{job['total']}, попыток: {job['attempts']})\n"
+            f"Обновлена: {job['updated_at']}\n"
+        )
+        if job["error"]:
+            message += f"Ошибка: {job['error']}\n"
+        message += "\n"
+
+    await update.message.reply_text(message[:4096])
+
+
+async def queue_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает состояние очереди генераций и время ожидания по полосам приоритета."""
+    user_id = update.effective_user.id
+
+    # Проверяем, является ли пользователь админом
+    if str(user_id) not in config.ADMIN_IDS:
+        await update.message.reply_text("У вас нет прав для использования этой команды.")
+        return
+
+    stats = context.bot_data["scheduler"].stats()
+
+    message = (
+        f"Генераций выполняется: {stats['running']} из {config.GENERATION_MAX_CONCURRENT}\n"
+        f"В очереди: {stats['queued']}\n\n"
+        "Время ожидания в очереди (последние запросы):\n"
+    )
+    for lane, lane_stats in sorted(stats["lanes"].items()):
+        message += (
+            f"\n{lane}: в очереди {lane_stats['queued']}, запущено {lane_stats['started']}\n"
+            f"среднее {lane_stats['avg_wait']:.1f} с, p50 {lane_stats['p50_wait']:.1f} с, "
+            f"p95 {lane_stats['p95_wait']:.1f} с, макс. {lane_stats['max_wait']:.1f} с\n"
+        )
+
+    await update.message.reply_text(message)
+
+
+async def latency_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает время до первого токена для запросов с дублированием и без."""
+    user_id = update.effective_user.id
+
+    # Проверяем, является ли пользователь админом
+    if str(user_id) not in config.ADMIN_IDS:
+        await update.message.reply_text("У вас нет прав для использования этой команды.")
+        return
+
+    with ttft_stats_lock:
+        samples = {mode: sorted(ttft_stats[mode]) for mode in ("direct", "hedged")}
+        hedges_fired = ttft_stats["hedges_fired"]
+        hedges_won = ttft_stats["hedges_won"]
+
+    titles = {"direct": "Без дублирования", "hedged": "С дублированием"}
+    message = "Время до первого токена (последние запросы):\n"
+    for mode, values in samples.items():
+        if not values:
+            message += f"\n{titles[mode]}: нет данных\n"
+            continue
+        message += (
+            f"\n{titles[mode]} ({len(values)} запр.): p50 {percentile(values, 0.5):.1f} с, "
+            f"p95 {percentile(values, 0.95):.1f} с, p99 {percentile(values, 0.99):.1f} с\n"
+        )
+    message += f"\nДублирующих запросов: {hedges_fired}, из них ответили первыми: {hedges_won}"
+
+    await update.message.reply_text(message)
+
+
+async def usage_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает расход токенов и стоимость по моделям и пользователям за последние дни."""
+    user_id = update.effective_user.id
+
+    # Проверяем, является ли пользователь админом
+    if str(user_id) not in config.ADMIN_IDS:
+        await update.message.reply_text("У вас нет прав для использования этой команды.")
+        return
+
+    try:
+        days = int(context.args[0]) if context.args else 7
+    except ValueError:
+        await update.message.reply_text("Используйте формат: /usage [количество дней]")
+        return
+    days = max(1, days)
+
+    db = context.bot_data["db"]
+
+    # Дописываем накопленный в памяти расход, чтобы статистика была актуальной
+    context.bot_data["usage_rollup"].flush(db)
+
+    since_day = time.strftime("%Y-%m-%d", time.gmtime(time.time() - (days - 1) * 86400))
+    models = db.get_usage_by_model(since_day)
+    users = db.get_usage_by_user(since_day)
+
+    if not models:
+        await update.message.reply_text(f"За последние {days} дн. расхода нет.")
+        return
+
+    budgets = context.bot_data["spend_budgets"].summary()
+
+    total_cost = sum(model["cost"] for model in models)
+    total_requests = sum(model["requests"] for model in models)
+    message = f"💰 Расход за последние {days} дн. (UTC): ${total_cost:.4f}, запросов {total_requests}\n\n"
+
+    message += "По моделям:\n"
+    for model in models:
+        tokens = model["prompt_tokens"] + model["completion_tokens"]
+        cost_per_1k = model["cost"] / tokens * 1000 if tokens else 0.0
+        message += (
+            f"\n{model['model_id']}\n"
+            f"  запросов {model['requests']}, пользователей {model['users']}, ${model['cost']:.4f}\n"
+            f"  токенов: промпт {model['prompt_tokens']} (из кэша {model['cached_tokens']}), "
+            f"ответ {model['completion_tokens']}\n"
+            f"  в среднем на запрос: ответ {model['completion_tokens'] // model['requests']} ток., "
+            f"${model['cost'] / model['requests']:.5f}; ${cost_per_1k:.5f} за 1000 токенов\n"
+        )
+
+    if budgets:
+        titles = {"day": "сегодня", "month": "в этом месяце"}
+        message += "\nОбщий бюджет на платные модели:\n"
+        for _, period, spent, limit in budgets:
+            message += f"{titles.get(period, period)}: ${spent:.4f} из ${limit:.2f}\n"
+
+    message += "\nПользователи с наибольшим расходом:\n"
+    for user in users:
+        message += f"{user['id_user']}: ${user['cost']:.4f}, запросов {user['requests']}, токенов {user['tokens']}\n"
+
+    await update.message.reply_text(message[:4096])
+
+
+async def run_periodically(interval, callback, name):
+    """
+    Периодически вызывает синхронную функцию в цикле событий бота.
+
+    Args:
+        interval: Интервал в секундах
+        callback: Вызываемая функция
+        name: Название операции (для логов)
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            callback()
+        except Exception as e:
+            logger.error(f"Ошибка при выполнении периодической операции '{name}': {e}")
+
+
+async def post_stop(application: Application) -> None:
+    """
+    Выполняется после остановки приема обновлений, пока бот еще может отправлять сообщения.
+
+    Дожидается завершения активных генераций (не дольше SHUTDOWN_DRAIN_TIMEOUT), отменяет
+    оставшиеся, отправляет накопленные обновления сообщений и останавливает фоновые задачи.
+    """
+    bot_data = application.bot_data
+    bot_data["accepting_prompts"] = False
+
+    scheduler = bot_data["scheduler"]
+    update_queue = bot_data.get("update_queue")
+
+    def live_streams():
+        return [thread for thread in bot_data.get("stream_threads", set()) if thread.is_alive()]
+
+    completed_before = bot_data.get("completed_generations", 0)
+    logger.info(f"Остановка бота: активных генераций {len(live_streams())}, в очереди {len(scheduler.pending)}")
+
+    # Даем активным генерациям и уже принятым запросам из очереди завершиться
+    deadline = time.monotonic() + config.SHUTDOWN_DRAIN_TIMEOUT
+    while time.monotonic() < deadline and (live_streams() or scheduler.pending):
+        await asyncio.sleep(0.2)
+
+    # Оставшиеся генерации отменяем: потоки сами отправят финальные обновления с пометкой об остановке
+    canceled = 0
+    if live_streams() or scheduler.pending:
+        canceled = bot_data["state"].cancel_local_streams()
+        scheduler.start_canceled()
+        deadline = time.monotonic() + config.SHUTDOWN_CANCEL_TIMEOUT
+        while time.monotonic() < deadline and live_streams():
+            await asyncio.sleep(0.1)
+
+    abandoned = len(live_streams())
+
+    # Дожидаемся, пока message_updater отправит накопленные правки сообщений и сохранит ответы
+    if update_queue is not None:
+        deadline = time.monotonic() + config.SHUTDOWN_CANCEL_TIMEOUT
+        while time.monotonic() < deadline and update_queue.unfinished_tasks:
+            await asyncio.sleep(0.1)
+    pending_updates = update_queue.unfinished_tasks if update_queue is not None else 0
+    completed = bot_data.get("completed_generations", 0) - completed_before
+
+    # Останавливаем фоновые задачи; прерванные задачи администраторов продолжатся при следующем запуске
+    lane_tasks = [lane.task for lane in bot_data.get("chat_lanes", {}).values()]
+    tasks = [bot_data.get("message_updater_task"), bot_data.get("queue_status_task")] + lane_tasks
+    tasks += bot_data.get("job_workers", [])
+    tasks = [task for task in tasks if task is not None]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    logger.info(
+        f"Остановка бота: генераций завершено {completed}, отменено {canceled}, "
+        f"не успели остановиться {abandoned}, неотправленных обновлений сообщений {pending_updates}"
+    )
+
+
+async def post_shutdown(application: Application) -> None:
+    """Выполняется при остановке бота: сохраняет состояние и закрывает хранилища."""
+    for task in application.bot_data.get("background_tasks", []):
+        task.cancel()
+
+    state = application.bot_data.get("state")
+    if state:
+        state.close()
+        logger.info("Состояние пользователей сохранено")
+
+    db = application.bot_data.get("db")
+    if db:
+        application.bot_data["rate_limiter"].flush(db)
+        model_health.flush(db)
+        application.bot_data["usage_rollup"].flush(db)
+        db.flush_writes()
+        db.close()
+
+
 async def post_init(application: Application) -> None:
     """
     Выполняется после инициализации приложения, но до обработки обновлений.
@@ -2052,7 +4194,12 @@ async def post_init(application: Application) -> None:
         BotCommand("start", "Начать работу с ботом"),
         BotCommand("help", "Показать сообщение помощи"),
         BotCommand("select_model", "Выбрать модель AI"),
-        BotCommand("new_dialog", "Начать новый диалог")
+        BotCommand("find", "Найти модель"),
+        BotCommand("new_dialog", "Начать новый диалог"),
+        BotCommand("export", "Экспорт диалогов в файл"),
+        BotCommand("search", "Поиск по истории диалогов"),
+        BotCommand("context_mode", "Режим контекста диалога"),
+        BotCommand("hedging", "Дублирование медленных запросов")
     ]
 
     try:
@@ -2062,28 +4209,132 @@ async def post_init(application: Application) -> None:
     except Exception as e:
         logger.error(f"Ошибка при установке базовых команд: {e}")
 
+    db = application.bot_data["db"]
+
+    # Запускаем хранилище состояния (для Redis - подписка на канал отмены генераций)
+    state = application.bot_data["state"]
+    state.start()
+
+    # Периодически сохраняем измененное состояние пользователей и отложенные записи в БД,
+    # а также завершаем генерации, оборвавшиеся без финального ответа
+    application.bot_data["background_tasks"] = [
+        asyncio.create_task(run_periodically(config.STATE_FLUSH_INTERVAL, state.flush, "сохранение состояния")),
+        asyncio.create_task(run_periodically(config.DB_FLUSH_INTERVAL, db.flush_writes, "пакетная запись в БД")),
+        asyncio.create_task(run_periodically(
+            config.RATE_LIMIT_FLUSH_INTERVAL,
+            lambda: application.bot_data["rate_limiter"].flush(db),
+            "сохранение лимитов запросов"
+        )),
+        asyncio.create_task(run_periodically(
+            config.MODEL_HEALTH_FLUSH_INTERVAL, lambda: model_health.flush(db), "сохранение статистики моделей"
+        )),
+        asyncio.create_task(run_periodically(
+            config.USAGE_FLUSH_INTERVAL,
+            lambda: application.bot_data["usage_rollup"].flush(db),
+            "сохранение статистики расхода"
+        )),
+        asyncio.create_task(run_periodically(
+            config.PREMIUM_USERS_REFRESH_INTERVAL,
+            lambda: refresh_premium_users(application.bot_data),
+            "обновление списка премиум-пользователей"
+        )),
+        # Проверка чаще таймаута, чтобы активные генерации этого процесса успевали отметиться
+        # до того, как их записи сочтут прерванными другие процессы
+        asyncio.create_task(run_periodically(
+            config.INTERRUPTED_ANSWER_TIMEOUT / 2,
+            lambda: db.finalize_interrupted_answers(
+                INTERRUPTED_ANSWER_MARKER, config.INTERRUPTED_ANSWER_TIMEOUT,
+                application.bot_data["live_dialog_ids"]
+            ),
+            "завершение прерванных генераций"
+        )),
+    ]
+
+    # Обновление сообщений о позиции в очереди генераций
+    application.bot_data["queue_status_task"] = asyncio.create_task(queue_status_updater(application))
+
+    # Возобновляем прерванные фоновые задачи и запускаем воркеры
+    db.requeue_running_jobs()
+
+    application.bot_data["job_wakeup"] = asyncio.Event()
+    application.bot_data["job_workers"] = [
+        asyncio.create_task(job_worker(application, worker_number))
+        for worker_number in range(config.JOB_WORKERS)
+    ]
+
 
 def main() -> None:
     """Запускает бота."""
     # Создаем обработчик обновлений
     global application
-    application = Application.builder().token(config.TELEGRAM_BOT_TOKEN).post_init(post_init).build()
+    application = (
+        Application.builder()
+        .token(config.TELEGRAM_BOT_TOKEN)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(ChatOrderedUpdateProcessor(config.MAX_CONCURRENT_UPDATES))
+        .context_types(ContextTypes(context=BotContext))
+        .build()
+    )
 
-    # Инициализируем базу данных
+    # Инициализируем базу данных и каталог моделей в памяти
+    global model_catalog, model_search
     db = DBHandler(config.DB_PATH)
     application.bot_data["db"] = db
+    model_catalog = ModelCatalog(db)
+    model_search = ModelSearchIndex(model_catalog)
+
+    # Кэш премиум-пользователей и лимиты частоты запросов (сохраненные корзины загружаются из БД)
+    refresh_premium_users(application.bot_data)
+    rate_limiter = RateLimiter(config.RATE_LIMITS, config.CHAT_RATE_LIMITS)
+    rate_limiter.load(db.load_rate_limit_buckets())
+    application.bot_data["rate_limiter"] = rate_limiter
+
+    # Статистика работы моделей, накопленная до перезапуска
+    model_health.load(db.load_model_health())
+
+    # Суммарная статистика расхода
+    application.bot_data["usage_rollup"] = UsageRollup()
+
+    # Бюджеты расходов: расход текущего месяца загружается один раз, дальше учитывается в памяти
+    spend_budgets = SpendBudgets(config.SPEND_BUDGETS)
+    spend_budgets.load(db.get_usage_costs(budget_periods()["month"] + "-01"))
+    application.bot_data["spend_budgets"] = spend_budgets
+
+    # Планировщик генераций: общий лимит, лимит на пользователя и приоритет по полосам
+    application.bot_data["scheduler"] = GenerationScheduler(
+        config.GENERATION_MAX_CONCURRENT,
+        config.GENERATION_MAX_PER_USER,
+        config.GENERATION_LANE_WEIGHTS
+    )
+
+    # ID записей диалогов, генерации которых выполняются или ждут в очереди
+    application.bot_data["live_dialog_ids"] = set()
+
+    # Завершаем генерации, прерванные предыдущей остановкой бота. Если БД используют
+    # несколько процессов, завершаем только заведомо устаревшие, чтобы не задеть чужие генерации.
+    db.finalize_interrupted_answers(
+        INTERRUPTED_ANSWER_MARKER,
+        config.INTERRUPTED_ANSWER_TIMEOUT if config.STATE_BACKEND == "redis" else None
+    )
 
-    # Обновляем модели при запуске в отдельном потоке
-    def update_models_at_startup():
-        fetch_and_update_models(application)
+    # Хранилище состояния пользователей и активных генераций
+    application.bot_data["state"] = create_state_backend(config.STATE_BACKEND, config.REDIS_URL, db)
 
-    threading.Thread(target=update_models_at_startup).start()
+    # Обновляем модели при запуске фоновой задачей
+    enqueue_update_models(application)
 
     # Добавляем обработчики команд
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("select_model", select_model))
+    application.add_handler(CommandHandler("find", find_command))
+    application.add_handler(CommandHandler("use", use_command))
+    application.add_handler(InlineQueryHandler(inline_model_search))
     application.add_handler(CommandHandler("new_dialog", new_dialog))
+    application.add_handler(CommandHandler("context_mode", context_mode_command))
+    application.add_handler(CommandHandler("hedging", hedging_command))
 
     # Команды для управления моделями (только для админов)
     application.add_handler(CommandHandler("update_models", update_models_command))
@@ -2092,6 +4343,13 @@ def main() -> None:
     application.add_handler(CommandHandler("list_models", list_models))
     application.add_handler(CommandHandler("translate_descriptions", translate_descriptions))
     application.add_handler(CommandHandler("translate_all", translate_all_models))
+    application.add_handler(CommandHandler("jobs", jobs_command))
+    application.add_handler(CommandHandler("queue", queue_command))
+    application.add_handler(CommandHandler("latency", latency_command))
+    application.add_handler(CommandHandler("usage", usage_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("search", search_command))
+    application.add_handler(CommandHandler("export_all", export_all_command))
 
     # Добавляем обработчик инлайн-кнопок
     application.add_handler(CallbackQueryHandler(button_callback))
@@ -2100,7 +4358,41 @@ def main() -> None:
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
     # Запускаем бота
-    application.run_polling()
+    if config.RUN_MODE == "webhook":
+        run_webhook(application)
+    else:
+        application.run_polling()
+
+
+def run_webhook(application):
+    """
+    Запускает бота в режиме вебхука на встроенном асинхронном HTTP-сервере.
+
+    Telegram присылает обновления на WEBHOOK_URL, запросы без правильного
+    секретного токена отклоняются сервером. При остановке сервер перестает принимать
+    новые запросы, а уже полученные обновления обрабатываются до конца.
+
+    Args:
+        application: Приложение бота
+    """
+    if not config.WEBHOOK_URL:
+        logger.error("Для режима webhook необходимо указать WEBHOOK_URL в config.py")
+        return
+
+    if not config.WEBHOOK_SECRET_TOKEN:
+        logger.warning("WEBHOOK_SECRET_TOKEN не задан: вебхук будет принимать запросы без проверки источника")
+
+    logger.info(f"Запуск в режиме webhook на {config.WEBHOOK_LISTEN}:{config.WEBHOOK_PORT}/{config.WEBHOOK_URL_PATH}")
+
+    application.run_webhook(
+        listen=config.WEBHOOK_LISTEN,
+        port=config.WEBHOOK_PORT,
+        url_path=config.WEBHOOK_URL_PATH,
+        webhook_url=config.WEBHOOK_URL,
+        secret_token=config.WEBHOOK_SECRET_TOKEN or None,
+        max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=Update.ALL_TYPES
+    )
 
 
 
@@ -0,0 +1,133 @@
+import time
+import logging
+import threading
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Длительность периодов ограничений в секундах
+PERIODS = {"minute": 60, "day": 86400}
+
+
+class RateLimiter:
+    """
+    Ограничивает частоту запросов пользователей и чатов корзинами токенов (token bucket).
+
+    Для каждого вида ограничения ("message", "reload", "tokens") и периода ("minute", "day")
+    заводится корзина емкостью в лимит периода, которая равномерно пополняется за период.
+    Проверка выполняется только в памяти; в БД периодически (flush) записываются измененные
+    корзины, а заполнившиеся корзины удаляются из памяти и из БД. Емкость сохраняется вместе
+    с корзиной, поэтому после смены роли пользователя корзина пополняется по новому лимиту
+    со следующей проверки.
+    """
+
+    def __init__(self, user_limits, chat_limits):
+        """
+        Args:
+            user_limits: Лимиты пользователей по ролям: {роль: {вид: {период: лимит}}}
+            chat_limits: Лимиты групповых чатов: {вид: {период: лимит}}
+        """
+        self.user_limits = user_limits
+        self.chat_limits = chat_limits
+        # (scope, subject_id, kind, period) -> [tokens, updated_at, capacity]
+        self.buckets = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def load(self, rows):
+        """Загружает корзины, сохраненные в БД."""
+        with self.lock:
+            for scope, subject_id, kind, period, tokens, updated_at, capacity in rows:
+                self.buckets[(scope, subject_id, kind, period)] = [tokens, updated_at, capacity]
+
+    def _limits(self, user_id, chat_id, role, kind):
+        for period, limit in self.user_limits.get(role, {}).get(kind, {}).items():
+            yield ("user", str(user_id), kind, period), limit
+
+        # В личном чате ID чата совпадает с ID пользователя - лимит чата не нужен
+        if chat_id is not None and chat_id != user_id:
+            for period, limit in self.chat_limits.get(kind, {}).items():
+                yield ("chat", str(chat_id), kind, period), limit
+
+    def _level(self, key, limit, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return limit
+        tokens, updated_at, _ = bucket
+        return min(limit, tokens + (now - updated_at) * limit / PERIODS[key[3]])
+
+    def check(self, user_id, chat_id, role, amounts):
+        """
+        Проверяет лимиты и, если все они соблюдены, списывает запрошенное количество.
+
+        Args:
+            user_id: ID пользователя
+            chat_id: ID чата
+            role: Роль пользователя ("admin", "premium" или "default")
+            amounts: Списываемое количество по видам, например {"message": 1, "tokens": 500}
+
+        Returns:
+            float: 0, если запрос разрешен, иначе через сколько секунд его можно повторить
+        """
+        now = time.time()
+        with self.lock:
+            levels = []
+            retry_after = 0.0
+            for kind, amount in amounts.items():
+                for key, limit in self._limits(user_id, chat_id, role, kind):
+                    level = self._level(key, limit, now)
+                    # Запрос больше емкости корзины разрешается, когда корзина полна
+                    needed = min(amount, limit)
+                    if level < needed:
+                        retry_after = max(retry_after, (needed - level) * PERIODS[key[3]] / limit)
+                    levels.append((key, limit, level, amount))
+
+            if retry_after:
+                return retry_after
+
+            for key, limit, level, amount in levels:
+                self.buckets[key] = [level - amount, now, limit]
+                self.dirty.add(key)
+            return 0.0
+
+    def charge(self, user_id, chat_id, role, kind, amount):
+        """
+        Списывает уже израсходованное количество без проверки (корзина может уйти в минус),
+        например, фактическое число токенов после генерации.
+        """
+        if amount <= 0:
+            return
+
+        now = time.time()
+        with self.lock:
+            for key, limit in self._limits(user_id, chat_id, role, kind):
+                self.buckets[key] = [self._level(key, limit, now) - amount, now, limit]
+                self.dirty.add(key)
+
+    def flush(self, db):
+        """
+        Записывает измененные корзины в БД и удаляет заполнившиеся.
+
+        Returns:
+            int: Количество записанных и удаленных корзин
+        """
+        now = time.time()
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+
+            # Заполнившиеся корзины не отличаются от отсутствующих
+            full_keys = []
+            for key, (tokens, updated_at, capacity) in list(self.buckets.items()):
+                if tokens + (now - updated_at) * capacity / PERIODS[key[3]] >= capacity:
+                    del self.buckets[key]
+                    full_keys.append(key)
+
+            rows = [key + tuple(self.buckets[key]) for key in dirty if key in self.buckets]
+
+        if not db.save_rate_limit_buckets(rows, full_keys):
+            # Не удалось записать - повторим при следующем сохранении
+            with self.lock:
+                self.dirty |= {key for key in dirty if key in self.buckets}
+            return 0
+
+        return len(rows) + len(full_keys)
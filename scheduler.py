@@ -0,0 +1,205 @@
+import time
+import logging
+from collections import deque
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+class GenerationTicket:
+    """Заявка на генерацию ответа в очереди планировщика."""
+
+    def __init__(self, user_id, lane, start, cancel_event=None, chat_id=None, message_id=None):
+        """
+        Args:
+            user_id: ID пользователя (ограничение одновременных генераций считается по нему)
+            lane: Полоса приоритета ("admin", "premium" или "default")
+            start: Функция, запускающая генерацию; вызывается с заявкой в качестве аргумента
+            cancel_event: Событие отмены генерации (отмененные заявки запускаются без очереди)
+            chat_id: ID чата с сообщением о позиции в очереди
+            message_id: ID сообщения о позиции в очереди
+        """
+        self.user_id = user_id
+        self.lane = lane
+        self.start = start
+        self.cancel_event = cancel_event
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+        self.finish_tag = 0.0
+        self.sequence = 0
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.released = False
+        # Последняя показанная пользователю позиция в очереди
+        self.reported_position = None
+
+
+class GenerationScheduler:
+    """
+    Планировщик генераций: ограничивает количество одновременных генераций (всего и на пользователя)
+    и выбирает следующую генерацию из очереди по алгоритму взвешенной справедливой очереди (WFQ).
+
+    Каждой заявке назначается виртуальное время завершения: max(текущее виртуальное время,
+    время завершения предыдущей заявки пользователя) + 1 / вес полосы. Запускается заявка с наименьшим
+    временем, поэтому пользователь с несколькими запросами не вытесняет остальных, а полосы
+    администраторов и премиум-пользователей получают долю слотов пропорционально весу.
+
+    Все методы, кроме release через call_soon_threadsafe, вызываются из цикла событий бота.
+    """
+
+    def __init__(self, max_concurrent, max_per_user, lane_weights, wait_samples=1000):
+        """
+        Args:
+            max_concurrent: Максимальное количество одновременных генераций
+            max_per_user: Максимальное количество одновременных генераций одного пользователя
+            lane_weights: Веса полос приоритета: {"admin": 4, "premium": 2, "default": 1}
+            wait_samples: Количество последних значений времени ожидания для метрик (на полосу)
+        """
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.lane_weights = lane_weights
+        self.wait_samples = wait_samples
+
+        self.pending = []
+        self.running = {}
+        self.running_total = 0
+        self.virtual_time = 0.0
+        self.last_finish = {}
+        self.sequence = 0
+
+        # Метрики: последние значения времени ожидания и количество запущенных генераций по полосам
+        self.wait_times = {}
+        self.started_count = {}
+
+    def submit(self, ticket):
+        """
+        Ставит заявку в очередь и запускает ее, если есть свободный слот.
+
+        Returns:
+            int: Позиция в очереди (0 - генерация запущена сразу)
+        """
+        weight = self.lane_weights.get(ticket.lane, 1)
+        ticket.finish_tag = max(self.virtual_time, self.last_finish.get(ticket.user_id, 0.0)) + 1.0 / weight
+        self.last_finish[ticket.user_id] = ticket.finish_tag
+
+        self.sequence += 1
+        ticket.sequence = self.sequence
+        ticket.enqueued_at = time.monotonic()
+        self.pending.append(ticket)
+
+        self.dispatch()
+        return self.position(ticket)
+
+    def dispatch(self):
+        """Запускает заявки из очереди, пока есть свободные слоты."""
+        while self.running_total < self.max_concurrent:
+            ticket = self._next_eligible()
+            if ticket is None:
+                break
+            self.pending.remove(ticket)
+            self._start(ticket)
+
+    def release(self, ticket):
+        """Освобождает слот завершившейся генерации и запускает следующие заявки."""
+        if ticket.started_at is None or ticket.released:
+            return
+        ticket.released = True
+
+        self.running_total -= 1
+        self.running[ticket.user_id] -= 1
+        if not self.running[ticket.user_id]:
+            del self.running[ticket.user_id]
+
+            # Забываем пользователя, если у него нет заявок и его время не опережает виртуальное
+            has_pending = any(pending.user_id == ticket.user_id for pending in self.pending)
+            if not has_pending and self.last_finish.get(ticket.user_id, 0.0) <= self.virtual_time:
+                self.last_finish.pop(ticket.user_id, None)
+
+        self.dispatch()
+
+    def start_canceled(self):
+        """
+        Запускает отмененные заявки вне очереди: поток генерации обнаружит отмену до запроса
+        к API и сразу отправит финальное сообщение, поэтому слот занимается лишь на мгновение.
+
+        Returns:
+            int: Количество запущенных заявок
+        """
+        canceled = [ticket for ticket in self.pending if ticket.cancel_event and ticket.cancel_event.is_set()]
+        for ticket in canceled:
+            self.pending.remove(ticket)
+            self._start(ticket)
+        return len(canceled)
+
+    def positions(self):
+        """Возвращает список (заявка, позиция) для заявок в очереди в порядке их запуска без учета лимитов."""
+        ordered = sorted(self.pending, key=lambda ticket: (ticket.finish_tag, ticket.sequence))
+        return [(ticket, position) for position, ticket in enumerate(ordered, start=1)]
+
+    def position(self, ticket):
+        """Возвращает позицию заявки в очереди (0 - заявка не в очереди)."""
+        for queued_ticket, position in self.positions():
+            if queued_ticket is ticket:
+                return position
+        return 0
+
+    def stats(self):
+        """
+        Возвращает метрики планировщика.
+
+        Returns:
+            dict: running, queued, а также по каждой полосе в lanes: queued, started
+                и время ожидания в очереди (секунды) avg_wait, p50_wait, p95_wait, max_wait
+        """
+        lanes = {}
+        for lane in set(self.lane_weights) | set(self.wait_times):
+            waits = sorted(self.wait_times.get(lane, ()))
+            lane_stats = {
+                "queued": sum(1 for ticket in self.pending if ticket.lane == lane),
+                "started": self.started_count.get(lane, 0),
+                "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+                "p50_wait": percentile(waits, 0.5),
+                "p95_wait": percentile(waits, 0.95),
+                "max_wait": waits[-1] if waits else 0.0,
+            }
+            lanes[lane] = lane_stats
+
+        return {
+            "running": self.running_total,
+            "queued": len(self.pending),
+            "lanes": lanes
+        }
+
+    def _next_eligible(self):
+        best = None
+        for ticket in self.pending:
+            if self.running.get(ticket.user_id, 0) >= self.max_per_user:
+                continue
+            if best is None or (ticket.finish_tag, ticket.sequence) < (best.finish_tag, best.sequence):
+                best = ticket
+        return best
+
+    def _start(self, ticket):
+        self.virtual_time = max(self.virtual_time, ticket.finish_tag)
+        self.running_total += 1
+        self.running[ticket.user_id] = self.running.get(ticket.user_id, 0) + 1
+
+        ticket.started_at = time.monotonic()
+        self.wait_times.setdefault(ticket.lane, deque(maxlen=self.wait_samples)).append(
+            ticket.started_at - ticket.enqueued_at)
+        self.started_count[ticket.lane] = self.started_count.get(ticket.lane, 0) + 1
+
+        try:
+            ticket.start(ticket)
+        except Exception as e:
+            logger.error(f"Ошибка при запуске генерации пользователя {ticket.user_id}: {e}")
+            self.release(ticket)
+
+
+def percentile(sorted_values, fraction):
+    """Возвращает перцентиль отсортированного списка значений (0.0 для пустого списка)."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
@@ -0,0 +1,341 @@
+import json
+import uuid
+import logging
+import threading
+from collections.abc import MutableMapping
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+class InMemoryStateBackend:
+    """
+    Хранит состояние пользователей (выбранная модель, текущий диалог и т.д.)
+    и события отмены активных генераций в памяти процесса.
+    """
+
+    def __init__(self):
+        """Инициализация хранилища."""
+        self.sessions = {}
+        # События отмены генераций, запущенных в этом процессе: chat_id -> threading.Event
+        self.streams = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Запускает фоновые механизмы хранилища (для хранилища в памяти не требуется)."""
+
+    def flush(self):
+        """Сохраняет накопленные изменения состояния (для хранилища в памяти не требуется)."""
+        return 0
+
+    def close(self):
+        """Освобождает ресурсы хранилища."""
+
+    def user_session(self, user_id):
+        """
+        Возвращает словарь состояния пользователя.
+
+        Args:
+            user_id: ID пользователя
+
+        Returns:
+            MutableMapping: Состояние пользователя
+        """
+        with self.lock:
+            return self.sessions.setdefault(user_id, {})
+
+    def register_stream(self, chat_id):
+        """
+        Регистрирует новую генерацию в чате.
+
+        Args:
+            chat_id: ID чата
+
+        Returns:
+            threading.Event: Событие, которое будет установлено при запросе отмены
+        """
+        cancel_event = threading.Event()
+        with self.lock:
+            self.streams[str(chat_id)] = cancel_event
+        return cancel_event
+
+    def has_stream(self, chat_id):
+        """Проверяет, идет ли в чате генерация."""
+        with self.lock:
+            return str(chat_id) in self.streams
+
+    def request_cancel(self, chat_id):
+        """
+        Запрашивает отмену генерации в чате.
+
+        Returns:
+            bool: True, если в чате была активная генерация
+        """
+        with self.lock:
+            cancel_event = self.streams.get(str(chat_id))
+
+        if cancel_event:
+            cancel_event.set()
+            return True
+        return False
+
+    def cancel_local_streams(self):
+        """
+        Отменяет все генерации, выполняющиеся в этом процессе (используется при остановке бота).
+
+        Returns:
+            int: Количество отмененных генераций
+        """
+        with self.lock:
+            cancel_events = list(self.streams.values())
+
+        for cancel_event in cancel_events:
+            cancel_event.set()
+        return len(cancel_events)
+
+    def finish_stream(self, chat_id, cancel_event=None):
+        """
+        Снимает регистрацию генерации в чате.
+
+        Args:
+            chat_id: ID чата
+            cancel_event: Событие завершившейся генерации (None = снять любую генерацию чата).
+                Позволяет не удалить регистрацию более новой генерации того же чата.
+        """
+        with self.lock:
+            current_event = self.streams.get(str(chat_id))
+            if current_event and (cancel_event is None or current_event is cancel_event):
+                del self.streams[str(chat_id)]
+
+
+class RedisSession(MutableMapping):
+    """Состояние пользователя, хранящееся в хэше Redis (значения сериализуются в JSON)."""
+
+    def __init__(self, client, key):
+        self.client = client
+        self.key = key
+
+    def __getitem__(self, field):
+        value = self.client.hget(self.key, field)
+        if value is None:
+            raise KeyError(field)
+        return json.loads(value)
+
+    def __setitem__(self, field, value):
+        self.client.hset(self.key, field, json.dumps(value))
+
+    def __delitem__(self, field):
+        if not self.client.hdel(self.key, field):
+            raise KeyError(field)
+
+    def __contains__(self, field):
+        return bool(self.client.hexists(self.key, field))
+
+    def __iter__(self):
+        return iter(field.decode() if isinstance(field, bytes) else field for field in self.client.hkeys(self.key))
+
+    def __len__(self):
+        return self.client.hlen(self.key)
+
+
+class RedisStateBackend(InMemoryStateBackend):
+    """
+    Хранит состояние пользователей в Redis, чтобы несколько процессов бота могли
+    обслуживать одних и тех же пользователей.
+
+    Генерация выполняется в процессе, который ее запустил. В Redis хранится отметка
+    об активной генерации чата, а отмена доставляется всем процессам через канал pub/sub,
+    поэтому кнопку отмены может обработать любой процесс.
+    """
+
+    def __init__(self, url=None, client=None, prefix="openrouter_bot", stream_ttl=600):
+        """
+        Args:
+            url: URL подключения к Redis (например, "redis://localhost:6379/0")
+            client: Готовый клиент Redis (например, для подключения к локальному тестовому серверу)
+            prefix: Префикс ключей
+            stream_ttl: Время жизни отметки об активной генерации в секундах
+        """
+        super().__init__()
+
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError("Для STATE_BACKEND = 'redis' установите пакет redis: pip install redis")
+            client = redis.Redis.from_url(url)
+
+        self.client = client
+        self.prefix = prefix
+        self.stream_ttl = stream_ttl
+        self.worker_id = uuid.uuid4().hex
+        self.cancel_channel = f"{prefix}:cancel"
+        self.pubsub_thread = None
+
+    def _stream_key(self, chat_id):
+        return f"{self.prefix}:stream:{chat_id}"
+
+    def start(self):
+        """Подписывается на канал отмены генераций."""
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.cancel_channel: self._on_cancel_message})
+        self.pubsub_thread = pubsub.run_in_thread(sleep_time=0.1, daemon=True)
+        logger.info(f"Подписка на канал отмены генераций {self.cancel_channel} (процесс {self.worker_id})")
+
+    def close(self):
+        """Останавливает подписку на канал отмены."""
+        if self.pubsub_thread:
+            self.pubsub_thread.stop()
+            self.pubsub_thread = None
+
+    def _on_cancel_message(self, message):
+        chat_id = message["data"]
+        if isinstance(chat_id, bytes):
+            chat_id = chat_id.decode()
+
+        # Событие есть только в процессе, который выполняет генерацию
+        super().request_cancel(chat_id)
+
+    def user_session(self, user_id):
+        return RedisSession(self.client, f"{self.prefix}:session:{user_id}")
+
+    def register_stream(self, chat_id):
+        cancel_event = super().register_stream(chat_id)
+        self.client.set(self._stream_key(chat_id), self.worker_id, ex=self.stream_ttl)
+        return cancel_event
+
+    def has_stream(self, chat_id):
+        return bool(self.client.exists(self._stream_key(chat_id)))
+
+    def request_cancel(self, chat_id):
+        if not self.has_stream(chat_id):
+            return False
+
+        self.client.publish(self.cancel_channel, str(chat_id))
+        return True
+
+    def finish_stream(self, chat_id, cancel_event=None):
+        with self.lock:
+            current_event = self.streams.get(str(chat_id))
+            owns_stream = current_event is not None and (cancel_event is None or current_event is cancel_event)
+            if owns_stream:
+                del self.streams[str(chat_id)]
+
+        # Отметку снимает только процесс, который ее поставил
+        if owns_stream:
+            key = self._stream_key(chat_id)
+            owner = self.client.get(key)
+            if owner is not None and (owner.decode() if isinstance(owner, bytes) else owner) == self.worker_id:
+                self.client.delete(key)
+
+
+class TrackedSession(MutableMapping):
+    """
+    Состояние пользователя в памяти, запоминающее измененные ключи для записи в БД.
+
+    Отслеживаются только присваивания и удаления ключей: изменение вложенного
+    объекта на месте не помечает ключ измененным.
+    """
+
+    def __init__(self, backend, user_id, data):
+        self.backend = backend
+        self.user_id = user_id
+        self.data = data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.backend.mark_dirty(self.user_id, key)
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.backend.mark_dirty(self.user_id, key)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+
+class SqliteStateBackend(InMemoryStateBackend):
+    """
+    Хранит состояние пользователей в памяти и сохраняет его в SQLite, чтобы оно
+    переживало перезапуск бота.
+
+    Состояние пользователя загружается из БД при первом обращении к нему, поэтому
+    время запуска не зависит от количества пользователей. В БД периодически (flush)
+    записываются только измененные ключи.
+    """
+
+    def __init__(self, db):
+        """
+        Args:
+            db: Экземпляр DBHandler
+        """
+        super().__init__()
+        self.db = db
+        # Измененные с последней записи ключи: множество (user_id, key)
+        self.dirty = set()
+
+    def user_session(self, user_id):
+        with self.lock:
+            session = self.sessions.get(user_id)
+            if session is None:
+                session = TrackedSession(self, user_id, self.db.load_user_session(user_id))
+                self.sessions[user_id] = session
+            return session
+
+    def mark_dirty(self, user_id, key):
+        """Помечает ключ состояния пользователя измененным."""
+        with self.lock:
+            self.dirty.add((user_id, key))
+
+    def flush(self):
+        """
+        Записывает измененные ключи в БД.
+
+        Returns:
+            int: Количество записанных ключей
+        """
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            changes = []
+            for user_id, key in dirty:
+                data = self.sessions[user_id].data
+                if key in data:
+                    changes.append((user_id, key, data[key], False))
+                else:
+                    changes.append((user_id, key, None, True))
+
+        if not self.db.save_user_session_changes(changes):
+            # Не удалось записать - повторим при следующем сохранении
+            with self.lock:
+                self.dirty |= dirty
+            return 0
+
+        return len(changes)
+
+    def close(self):
+        self.flush()
+
+
+def create_state_backend(backend_type, redis_url=None, db=None):
+    """
+    Создает хранилище состояния по типу из конфигурации.
+
+    Args:
+        backend_type: "memory", "sqlite" или "redis"
+        redis_url: URL подключения к Redis
+        db: Экземпляр DBHandler (для "sqlite")
+
+    Returns:
+        Экземпляр хранилища состояния
+    """
+    if backend_type == "redis":
+        return RedisStateBackend(url=redis_url)
+    if backend_type == "sqlite":
+        return SqliteStateBackend(db)
+    return InMemoryStateBackend()
@@ -0,0 +1,201 @@
+import time
+import logging
+import threading
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+def compute_cost(model, usage):
+    """
+    Рассчитывает стоимость запроса в долларах.
+
+    Если OpenRouter вернул стоимость в объекте usage, используется она; иначе стоимость
+    считается по ценам модели из каталога (токены из кэша - по цене чтения кэша, если она известна).
+
+    Args:
+        model: Запись каталога ModelRecord (None, если модели нет в каталоге)
+        usage: Объект usage из ответа OpenRouter
+
+    Returns:
+        float: Стоимость запроса (None, если цены модели неизвестны)
+    """
+    if usage.get("cost") is not None:
+        return float(usage["cost"])
+
+    if model is None or model.prompt_price is None or model.completion_price is None:
+        return None
+
+    prompt_tokens = usage.get("prompt_tokens") or 0
+    completion_tokens = usage.get("completion_tokens") or 0
+    cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+
+    cache_read_price = model.cache_read_price if model.cache_read_price is not None else model.prompt_price
+    return float((prompt_tokens - cached_tokens) * model.prompt_price + cached_tokens * cache_read_price
+                 + completion_tokens * model.completion_price)
+
+
+class UsageRollup:
+    """
+    Суммарный расход по пользователям, моделям и дням (UTC).
+
+    Расход каждого запроса прибавляется к счетчикам в памяти, а в таблицу usage_daily
+    периодически (flush) одной транзакцией прибавляются накопленные с прошлой записи значения,
+    поэтому завершение генерации не требует отдельной записи в БД для статистики.
+    """
+
+    def __init__(self):
+        # (day, user_id, model_id) -> [requests, prompt_tokens, completion_tokens, cached_tokens, cost]
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def record(self, user_id, model_id, prompt_tokens=0, completion_tokens=0, cached_tokens=0, cost=0.0):
+        """Прибавляет расход одного запроса к счетчикам текущего дня."""
+        key = (time.strftime("%Y-%m-%d", time.gmtime()), int(user_id), model_id)
+        with self.lock:
+            totals = self.pending.setdefault(key, [0, 0, 0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += prompt_tokens or 0
+            totals[2] += completion_tokens or 0
+            totals[3] += cached_tokens or 0
+            totals[4] += cost or 0.0
+
+    def flush(self, db):
+        """
+        Прибавляет накопленный расход к таблице usage_daily.
+
+        Returns:
+            int: Количество записанных строк
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        rows = [key + tuple(totals) for key, totals in pending.items()]
+        if not db.save_usage_daily(rows):
+            # Не удалось записать - возвращаем расход в счетчики, чтобы записать его при следующем сохранении
+            with self.lock:
+                for key, totals in pending.items():
+                    current = self.pending.setdefault(key, [0, 0, 0, 0, 0.0])
+                    for index, value in enumerate(totals):
+                        current[index] += value
+            return 0
+
+        return len(rows)
+
+
+def budget_periods(now=None):
+    """Возвращает текущие периоды бюджетов: {"day": "YYYY-MM-DD", "month": "YYYY-MM"} (UTC)."""
+    now = time.gmtime(now)
+    return {"day": time.strftime("%Y-%m-%d", now), "month": time.strftime("%Y-%m", now)}
+
+
+class SpendBudgets:
+    """
+    Бюджеты расходов на платные модели: для каждого пользователя и общий, на день и на месяц (UTC).
+
+    Расход хранится в памяти: при запуске он загружается из usage_daily, затем пополняется
+    фактической стоимостью завершенных запросов (record). Перед запросом резервируется его
+    максимальная стоимость (reserve), поэтому одновременные запросы не могут вместе превысить
+    бюджет; резерв снимается после завершения генерации (release). Проверка не обращается к БД.
+    """
+
+    def __init__(self, limits):
+        """
+        Args:
+            limits: Бюджеты в долларах: {"user": {"day": 1.0, "month": 10.0}, "global": {...}}
+                (отсутствующий период - без ограничения)
+        """
+        self.limits = limits
+        # (scope, subject_id, period, ключ периода) -> сумма в долларах
+        self.spent = {}
+        self.reserved = {}
+        self.lock = threading.Lock()
+
+    def _keys(self, user_id, periods):
+        for scope, subject_id in (("user", str(user_id)), ("global", "")):
+            for period, limit in self.limits.get(scope, {}).items():
+                yield (scope, subject_id, period, periods[period]), limit
+
+    def _prune(self, periods):
+        # Расход прошедших дней и месяцев больше не нужен
+        for totals in (self.spent, self.reserved):
+            for key in [key for key in totals if key[3] != periods[key[2]]]:
+                del totals[key]
+
+    def load(self, rows):
+        """Загружает расход текущего месяца: список (day, id_user, cost) из usage_daily."""
+        periods = budget_periods()
+        with self.lock:
+            for day, user_id, cost in rows:
+                for period, period_key in (("day", day), ("month", day[:7])):
+                    if period_key != periods[period]:
+                        continue
+                    for key in (("user", str(user_id), period, period_key), ("global", "", period, period_key)):
+                        self.spent[key] = self.spent.get(key, 0.0) + (cost or 0.0)
+
+    def remaining(self, user_id):
+        """
+        Возвращает остаток бюджета пользователя с учетом общего бюджета и резервов.
+
+        Returns:
+            float: Остаток в долларах (None, если бюджеты не ограничены)
+        """
+        periods = budget_periods()
+        with self.lock:
+            remaining = None
+            for key, limit in self._keys(user_id, periods):
+                left = limit - self.spent.get(key, 0.0) - self.reserved.get(key, 0.0)
+                remaining = left if remaining is None else min(remaining, left)
+            return remaining
+
+    def reserve(self, user_id, amount):
+        """
+        Резервирует максимальную стоимость запроса, если она укладывается в бюджеты.
+
+        Returns:
+            list: Зарезервированные ключи (передаются в release), None - бюджет превышен
+        """
+        periods = budget_periods()
+        with self.lock:
+            self._prune(periods)
+            keys = list(self._keys(user_id, periods))
+            for key, limit in keys:
+                if self.spent.get(key, 0.0) + self.reserved.get(key, 0.0) + amount > limit:
+                    return None
+
+            reservation = [(key, amount) for key, _ in keys]
+            for key, _ in reservation:
+                self.reserved[key] = self.reserved.get(key, 0.0) + amount
+            return reservation
+
+    def release(self, reservation):
+        """Снимает резерв завершенного запроса."""
+        with self.lock:
+            for key, amount in reservation:
+                if key in self.reserved:
+                    self.reserved[key] = max(0.0, self.reserved[key] - amount)
+
+    def record(self, user_id, cost):
+        """Учитывает фактическую стоимость завершенного запроса."""
+        if not cost:
+            return
+
+        periods = budget_periods()
+        with self.lock:
+            for key, _ in self._keys(user_id, periods):
+                self.spent[key] = self.spent.get(key, 0.0) + cost
+
+    def summary(self, user_id=None):
+        """
+        Возвращает расход и бюджеты текущих периодов.
+
+        Returns:
+            list: Кортежи (scope, period, потрачено, бюджет) для общего бюджета и бюджета пользователя
+        """
+        periods = budget_periods()
+        with self.lock:
+            return [
+                (key[0], key[2], self.spent.get(key, 0.0), limit)
+                for key, limit in self._keys(user_id, periods)
+                if user_id is not None or key[0] == "global"
+            ]